@@ -9,11 +9,32 @@ import requests
 import json
 import base64
 import uuid
+import threading
 from pathlib import Path
-from typing import Optional, List, Union
+from typing import Awaitable, Optional, List, Union, Dict, Callable
 from PIL import Image
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import asyncio
+import hashlib
 import io
+import time
+
+import metrics
+
+# ============ 连接池配置 ============
+
+HTTP_POOL_SIZE = 16         # 每个 host 的最大连接数（每张图同时占用 SSE + 上传/下载约 2 个连接）
+HTTP_POOL_BLOCK = True      # 连接数达到上限时等待空闲连接，而不是临时新建
+HTTP_MAX_RETRIES = 3        # 连接失败 / 5xx 时的重试次数
+HTTP_BACKOFF_FACTOR = 0.5   # 重试退避系数：0.5s, 1s, 2s ...
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 直存模式下载时每次写盘的块大小
+FILE_REF_TTL = 3600         # 远端文件引用的缓存时间（Gradio 会定期清理上传的临时文件）
+CONTENT_HASH_LEN = 32       # 内容哈希（sha256 十六进制）截取长度，也用作上传文件名
+DOWNLOAD_CONNECT_TIMEOUT = 5  # 下载结果时的建连超时（连不上时尽快放弃，不逐个地址等满 30s）
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
 
 
 def log(msg: str):
@@ -22,23 +43,363 @@ def log(msg: str):
     print(f"[{ts}] {msg}")
 
 
+# ============ 共享 Session 注册表 ============
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def create_session(
+    pool_size: int = HTTP_POOL_SIZE,
+    max_retries: int = HTTP_MAX_RETRIES,
+    backoff_factor: float = HTTP_BACKOFF_FACTOR,
+    pool_block: bool = HTTP_POOL_BLOCK,
+) -> requests.Session:
+    """
+    创建带连接池和重试策略的 Session
+    
+    只对幂等请求（GET/HEAD）以及尚未发出的连接失败做重试，
+    queue/join 这类 POST 不会被重复提交。
+    """
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_size,
+        pool_block=pool_block,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = DEFAULT_USER_AGENT
+    return session
+
+
+def get_session(api_url: str, **kwargs) -> requests.Session:
+    """
+    按 api_url 获取共享 Session（keep-alive 复用 TCP/TLS 连接）
+    
+    同一个 api_url 的所有任务共用一个连接池；kwargs 只在首次创建时生效，参见 create_session。
+    """
+    key = api_url.rstrip('/')
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = create_session(**kwargs)
+            _sessions[key] = session
+            log(f"🔌 已创建连接池: {key}")
+        return session
+
+
+def close_all_sessions():
+    """关闭所有共享 Session（服务关闭时调用）"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+# ============ 错误分类 ============
+
+class BackendError(Exception):
+    """
+    后端调用失败（按所处阶段分类）
+    
+    retryable: 换一个后端或稍后重试是否可能成功。连接失败、超时、5xx、408/429 可以重试；
+    其他 4xx 和上游报告的生成错误重试也不会成功。
+    """
+    phase = "backend"
+    
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class UploadError(BackendError):
+    """上传参考图失败"""
+    phase = "upload"
+
+
+class QueueJoinError(BackendError):
+    """加入 Gradio 队列失败"""
+    phase = "queue_join"
+
+
+class StreamDroppedError(BackendError):
+    """SSE 结果流连接失败或在拿到结果前中断"""
+    phase = "sse"
+
+
+class DownloadError(BackendError):
+    """生成完成但结果下载 / 解析失败"""
+    phase = "download"
+
+
+class GenerationError(BackendError):
+    """上游报告生成失败或返回数据格式错误"""
+    phase = "generation"
+    
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message, retryable)
+
+
+def is_retryable(error: Exception) -> bool:
+    """HTTP / 网络错误是否值得重试（同时适用于 requests 和 httpx 的异常）"""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return status >= 500 or status in (408, 429)
+    # requests 的异常都是 OSError 的子类
+    return isinstance(error, (httpx.TransportError, OSError))
+
+
+def classify_error(error: Exception, error_type: type, message: str) -> BackendError:
+    """把底层异常包装成对应阶段的 BackendError（已分类的原样返回）"""
+    if isinstance(error, BackendError):
+        return error
+    return error_type(f"{message}: {error}", retryable=is_retryable(error))
+
+
+# ============ 同步 / 异步客户端共用的协议细节 ============
+
+MIME_MAP = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.webp': 'image/webp', '.gif': 'image/gif'}
+
+
+class PhaseTimer:
+    """
+    分阶段计时：lap(phase) 把上一个计时点到现在的耗时（秒）累加到 timings[phase]
+    
+    客户端记录的阶段：join 加入队列、queue 上游排队、diffusion 上游生成、download 下载 / 解析结果
+    """
+    
+    def __init__(self, timings: Optional[dict] = None):
+        self.timings = timings if timings is not None else {}
+        self._mark = time.perf_counter()
+    
+    def lap(self, phase: str):
+        now = time.perf_counter()
+        self.timings[phase] = round(self.timings.get(phase, 0) + now - self._mark, 3)
+        self._mark = now
+
+
+def generate_session_hash() -> str:
+    """生成随机 session hash（每次生成独立，避免并发任务共用同一条 SSE 流）"""
+    return uuid.uuid4().hex[:11]
+
+
+def build_generate_payload(
+    prompt: str,
+    images: Optional[List[dict]],
+    seed: int,
+    image_size: str,
+    width: int,
+    height: int,
+    diff_infer_steps: int,
+    enable_safety_checker: bool,
+    session_hash: str,
+) -> dict:
+    """构造 queue/join 请求体（API 只接受 "auto" 或 "custom"，宽高通过单独参数传递）"""
+    return {
+        "data": [
+            prompt,
+            images,           # None = 文生图, List[dict] = 图生图
+            seed,
+            image_size,       # "auto" 或 "custom"
+            width,
+            height,
+            diff_infer_steps,
+            enable_safety_checker
+        ],
+        "fn_index": 1,
+        "trigger_id": int(str(uuid.uuid4().int)[:8]),
+        "session_hash": session_hash
+    }
+
+
+def build_file_ref(api_url: str, remote_path: str, file_path: Path, mime_type: str) -> dict:
+    """构造 Gradio 文件引用"""
+    return {
+        "path": remote_path,
+        "url": f"{api_url}/gradio_api/file={remote_path}",
+        "orig_name": file_path.name,
+        "size": file_path.stat().st_size,
+        "mime_type": mime_type,
+        "meta": {"_type": "gradio.FileData"}
+    }
+
+
+def parse_progress(data: dict) -> Optional[dict]:
+    """
+    把上游 Gradio 的排队 / 进度消息转换为结构化进度
+    
+    Returns:
+        {"stage": "queued" | "started" | "generating", ...}，与进度无关的消息返回 None
+        - queued: rank（前面还有几个）、queue_size、eta（预计秒数）
+        - started: eta
+        - generating: step / steps（有进度数据时）、desc
+    """
+    msg = data.get("msg")
+    if msg == "estimation":
+        return {
+            "stage": "queued",
+            "rank": data.get("rank"),
+            "queue_size": data.get("queue_size"),
+            "eta": data.get("rank_eta"),
+        }
+    if msg == "process_starts":
+        return {"stage": "started", "eta": data.get("eta")}
+    if msg in ("progress", "process_generating"):
+        progress = {"stage": "generating"}
+        # Gradio 4+: progress 消息带 progress_data；部分版本放在 output 里
+        items = data.get("progress_data")
+        output = data.get("output")
+        if items is None and isinstance(output, dict):
+            items = output.get("progress_data")
+        if items:
+            item = items[-1]
+            if item.get("index") is not None:
+                progress["step"] = item.get("index")
+                progress["steps"] = item.get("length")
+            elif item.get("progress") is not None:
+                progress["fraction"] = item.get("progress")
+            if item.get("desc"):
+                progress["desc"] = item.get("desc")
+        return progress
+    return None
+
+
+def handle_sse_message(data: dict, on_progress: Optional[Callable[[dict], None]] = None):
+    """
+    处理一条 SSE 消息
+    
+    Args:
+        data: 解析后的消息
+        on_progress: 进度回调，参数为 parse_progress 的结果
+    
+    Returns:
+        process_completed 时返回输出数据，其他消息返回 None
+    """
+    msg = data.get("msg")
+    if on_progress is not None:
+        progress = parse_progress(data)
+        if progress is not None:
+            try:
+                on_progress(progress)
+            except Exception as e:
+                log(f"⚠️  进度回调异常: {e}")
+    # 打印进度信息
+    if msg == "process_generating":
+        log(f"⏳ 生成中...")
+    elif msg == "process_completed":
+        output = data.get("output", {})
+        if data.get("success") is False:
+            error = output.get("error") if isinstance(output, dict) else None
+            raise GenerationError(f"上游生成失败: {error or '未知错误'}")
+        log(f"✅ 生成完成!")
+        log(f"📦 output keys: {output.keys() if isinstance(output, dict) else type(output)}")
+        if "data" in output:
+            return output["data"]
+        # 兼容其他可能的数据结构
+        if output:
+            log(f"📦 output 完整内容: {str(output)[:500]}")
+            return output
+    elif msg == "estimation":
+        rank = data.get("rank")
+        queue_size = data.get("queue_size")
+        log(f"📊 队列位置: {rank}/{queue_size}")
+    return None
+
+
+def file_download_urls(api_url: str, image_data: dict) -> List[str]:
+    """结果文件的候选下载地址（按优先级排序）"""
+    file_path = image_data["path"]
+    urls = [
+        f"{api_url}/gradio_api/file={file_path}",  # Gradio 标准路径
+        image_data.get("url", ""),
+        f"{api_url}/file={file_path}",
+        f"{api_url}/file{file_path}"
+    ]
+    return [u for u in urls if u]
+
+
+def hash_file(path: Path, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    """分块计算文件的内容哈希（sha256 前 CONTENT_HASH_LEN 位，上传文件按此命名，远端文件引用按此缓存）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()[:CONTENT_HASH_LEN]
+
+
+def open_image_bytes(content: bytes) -> Image.Image:
+    """打开下载到的图像，并保留上游原始字节（upstream_bytes），便于原样落盘"""
+    image = Image.open(io.BytesIO(content))
+    image.upstream_bytes = content
+    return image
+
+
+class DownloadedImage:
+    """
+    已直接写入磁盘、未解码的上游图像（直存模式）
+
+    只读取了文件头，size / format 与 PIL Image 的同名属性一致。
+    """
+
+    def __init__(self, path: Path, size: tuple, format: Optional[str]):
+        self.path = Path(path)
+        self.size = size
+        self.format = format
+
+    def discard(self):
+        """删除临时文件（结果不再需要时调用）"""
+        self.path.unlink(missing_ok=True)
+
+
+def probe_image_file(path: Path) -> tuple:
+    """只读文件头获取 (尺寸, 格式)，不解码像素"""
+    with Image.open(path) as image:
+        return image.size, image.format
+
+
+def new_download_path(download_dir: Path) -> Path:
+    """直存模式的临时文件路径（以 . 开头、.part 结尾，落盘完成后由调用方重命名）"""
+    return Path(download_dir) / f".{uuid.uuid4().hex}.part"
+
+
+def decode_base64_image(img_str: str) -> Image.Image:
+    """解析 base64 / data URI 图像"""
+    if img_str.startswith("data:image"):
+        img_str = img_str.split(",")[1]
+    return open_image_bytes(base64.b64decode(img_str))
+
+
 class HunyuanImageClient:
     """HunyuanImage API 客户端"""
     
-    def __init__(self, api_url: str):
+    def __init__(self, api_url: str, session: Optional[requests.Session] = None):
         """
         初始化客户端
         
         Args:
             api_url: Gradio 服务地址，例如 "https://deployment-11919-melbkyyv-30000.550w.link"
+            session: 自定义 requests.Session，不指定则使用该 api_url 的共享连接池
         """
         self.api_url = api_url.rstrip('/')
+        self.session = session or get_session(self.api_url)
         self.session_hash = self._generate_session_hash()
     
     def _generate_session_hash(self) -> str:
         """生成随机 session hash"""
-        return ''.join([chr(ord('a') + i % 26) if i % 2 == 0 else str(i % 10) 
-                       for i in range(12)])
+        return generate_session_hash()
     
     def upload_file(self, file_path: str) -> dict:
         """
@@ -53,35 +414,30 @@ class HunyuanImageClient:
         file_path = Path(file_path)
         
         # 判断 mime_type
-        suffix = file_path.suffix.lower()
-        mime_map = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.webp': 'image/webp', '.gif': 'image/gif'}
-        mime_type = mime_map.get(suffix, 'image/png')
+        mime_type = MIME_MAP.get(file_path.suffix.lower(), 'image/png')
         
         log(f"📤 上传文件到 Gradio: {file_path.name}")
         
         with open(file_path, 'rb') as f:
-            response = requests.post(
-                f"{self.api_url}/gradio_api/upload",
-                files={"files": (file_path.name, f, mime_type)},
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
-                },
-                timeout=60
-            )
-            response.raise_for_status()
+            try:
+                response = self.session.post(
+                    f"{self.api_url}/gradio_api/upload",
+                    files={"files": (file_path.name, f, mime_type)},
+                    headers={
+                        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
+                    },
+                    timeout=60
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                raise classify_error(e, UploadError, "上传失败") from e
+        metrics.UPLOAD_BYTES.inc(file_path.stat().st_size, backend=self.api_url)
         
         # Gradio 返回的是一个路径数组
         result = response.json()
         remote_path = result[0] if isinstance(result, list) else result
         
-        file_ref = {
-            "path": remote_path,
-            "url": f"{self.api_url}/gradio_api/file={remote_path}",
-            "orig_name": file_path.name,
-            "size": file_path.stat().st_size,
-            "mime_type": mime_type,
-            "meta": {"_type": "gradio.FileData"}
-        }
+        file_ref = build_file_ref(self.api_url, remote_path, file_path, mime_type)
         
         log(f"✅ 上传完成: {remote_path}")
         return file_ref
@@ -96,7 +452,9 @@ class HunyuanImageClient:
         height: int = 1024,
         diff_infer_steps: int = 50,
         enable_safety_checker: bool = True,
-        save_path: Optional[str] = None
+        save_path: Optional[str] = None,
+        on_progress: Optional[Callable[[dict], None]] = None,
+        timings: Optional[dict] = None,
     ) -> tuple[Optional[Image.Image], str]:
         """
         统一生成接口（文生图 / 图生图）
@@ -111,29 +469,20 @@ class HunyuanImageClient:
             diff_infer_steps: 推理步数
             enable_safety_checker: 安全检查
             save_path: 保存路径
+            on_progress: 上游排队 / 进度回调，参数见 parse_progress
+            timings: 指定时写入各阶段耗时（秒），阶段见 PhaseTimer
             
         Returns:
             (生成的图像, 生成信息)
         """
         # 每次生成使用独立的 session_hash，避免并发冲突
         session_hash = self._generate_session_hash()
+        timer = PhaseTimer(timings)
         
-        # API 只接受 "auto" 或 "custom"，宽高通过单独参数传递
-        payload = {
-            "data": [
-                prompt,
-                images,           # None = 文生图, List[dict] = 图生图
-                seed,
-                image_size,       # "auto" 或 "custom"
-                width,
-                height,
-                diff_infer_steps,
-                enable_safety_checker
-            ],
-            "fn_index": 1,
-            "trigger_id": int(str(uuid.uuid4().int)[:8]),
-            "session_hash": session_hash
-        }
+        payload = build_generate_payload(
+            prompt, images, seed, image_size, width, height,
+            diff_infer_steps, enable_safety_checker, session_hash
+        )
         
         mode = "图生图" if images else "文生图"
         log(f"📝 [{mode}] {prompt}")
@@ -142,26 +491,32 @@ class HunyuanImageClient:
         log(f"🎲 Seed: {seed}, 📐 Size: {image_size} ({width}x{height}), 🔄 Steps: {diff_infer_steps}")
         
         try:
-            response = requests.post(
-                f"{self.api_url}/gradio_api/queue/join",
-                json=payload,
-                headers={
-                    "Content-Type": "application/json",
-                    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
-                },
-                timeout=30
-            )
-            response.raise_for_status()
+            try:
+                response = self.session.post(
+                    f"{self.api_url}/gradio_api/queue/join",
+                    json=payload,
+                    headers={
+                        "Content-Type": "application/json",
+                        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
+                    },
+                    timeout=30
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                raise classify_error(e, QueueJoinError, "加入队列失败") from e
+            timer.lap("join")
             
             log(f"✅ 已加入队列 (session: {session_hash[:8]}...)")
             
-            result = self._get_sse_result(session_hash=session_hash)
+            result = self._get_sse_result(session_hash=session_hash, on_progress=on_progress, timer=timer)
+            timer.lap("diffusion")
             
             if result and len(result) >= 1:
                 image_data = result[0]
                 info_text = result[1] if len(result) >= 2 else "生成成功"
                 
                 image = self._parse_image(image_data)
+                timer.lap("download")
                 
                 if save_path and image:
                     image.save(save_path)
@@ -169,7 +524,7 @@ class HunyuanImageClient:
                 
                 return image, info_text
             else:
-                raise Exception("返回数据格式错误")
+                raise GenerationError("返回数据格式错误")
                 
         except Exception as e:
             log(f"❌ 请求失败: {e}")
@@ -227,7 +582,7 @@ class HunyuanImageClient:
         
         try:
             # 1. 加入队列
-            response = requests.post(
+            response = self.session.post(
                 f"{self.api_url}/gradio_api/queue/join",
                 json=payload,
                 headers={
@@ -333,7 +688,7 @@ class HunyuanImageClient:
         
         try:
             # 1. 加入队列
-            response = requests.post(
+            response = self.session.post(
                 f"{self.api_url}/gradio_api/queue/join",
                 json=payload,
                 headers={
@@ -369,15 +724,17 @@ class HunyuanImageClient:
             log(f"❌ 请求失败: {e}")
             raise
     
-    def _get_sse_result(self, session_hash: str = None, timeout: int = 300):
-        """通过 SSE 获取结果"""
+    def _get_sse_result(self, session_hash: str = None, timeout: int = 300,
+                        on_progress: Optional[Callable[[dict], None]] = None,
+                        timer: Optional[PhaseTimer] = None):
+        """通过 SSE 获取结果（指定 timer 时在上游开始生成时记录排队耗时）"""
         session = session_hash or self.session_hash
         url = f"{self.api_url}/gradio_api/queue/data?session_hash={session}"
         
         log(f"🔄 等待生成结果...")
         
         try:
-            response = requests.get(
+            response = self.session.get(
                 url,
                 headers={
                     "Accept": "text/event-stream",
@@ -400,27 +757,16 @@ class HunyuanImageClient:
                             
                             try:
                                 data = json.loads(data_str)
-                                
-                                # 打印进度信息
-                                if data.get("msg") == "process_generating":
-                                    log(f"⏳ 生成中...")
-                                elif data.get("msg") == "process_completed":
-                                    log(f"✅ 生成完成!")
-                                    output = data.get("output", {})
-                                    log(f"📦 output keys: {output.keys() if isinstance(output, dict) else type(output)}")
-                                    if "data" in output:
-                                        return output["data"]
-                                    # 兼容其他可能的数据结构
-                                    if output:
-                                        log(f"📦 output 完整内容: {str(output)[:500]}")
-                                        return output
-                                elif data.get("msg") == "estimation":
-                                    rank = data.get("rank")
-                                    queue_size = data.get("queue_size")
-                                    log(f"📊 队列位置: {rank}/{queue_size}")
-                                
                             except json.JSONDecodeError:
                                 continue
+                            
+                            if timer is not None and data.get("msg") == "process_starts":
+                                timer.lap("queue")
+                            result = handle_sse_message(data, on_progress)
+                            if result is not None:
+                                return result
+            except BackendError:
+                raise
             except Exception as iter_error:
                 # 连接在获取结果后正常关闭，忽略 ChunkedEncodingError 等错误
                 error_msg = str(iter_error)
@@ -431,14 +777,16 @@ class HunyuanImageClient:
                     # 其他错误才打印
                     log(f"⚠️  SSE 流读取中断: {iter_error}")
             
-            raise Exception("未获取到结果")
+            raise StreamDroppedError("SSE 流结束但未获取到结果")
             
+        except BackendError:
+            raise
         except Exception as e:
             log(f"❌ SSE 连接失败: {e}")
-            raise
+            raise classify_error(e, StreamDroppedError, "SSE 连接失败") from e
     
-    def _parse_image(self, image_data) -> Optional[Image.Image]:
-        """解析图像数据"""
+    def _parse_image(self, image_data) -> Image.Image:
+        """解析图像数据，失败时抛出 DownloadError"""
         try:
             if isinstance(image_data, dict):
                 # Gradio 返回的文件格式
@@ -446,58 +794,426 @@ class HunyuanImageClient:
                     # 文件路径格式，需要下载
                     file_path = image_data["path"]
                     
-                    # 尝试多种 URL 格式（按优先级排序）
-                    urls_to_try = [
-                        f"{self.api_url}/gradio_api/file={file_path}",  # Gradio 标准路径
-                        image_data.get("url", ""),
-                        f"{self.api_url}/file={file_path}",
-                        f"{self.api_url}/file{file_path}"
-                    ]
+                    # 尝试多种 URL 格式（按优先级排序）；连不上后端时其余地址也不会成功，直接放弃
+                    last_error = None
+                    for file_url in file_download_urls(self.api_url, image_data):
+                        try:
+                            log(f"📥 尝试下载: {file_url}")
+                            response = self.session.get(file_url, timeout=(DOWNLOAD_CONNECT_TIMEOUT, 30))
+                            response.raise_for_status()
+                            metrics.DOWNLOAD_BYTES.inc(len(response.content), backend=self.api_url)
+                            return open_image_bytes(response.content)
+                        except requests.HTTPError as e:
+                            log(f"⚠️  下载失败: {e}")
+                            # 优先保留可重试的错误（其余候选地址的 404 不代表结果不存在）
+                            if last_error is None or is_retryable(e):
+                                last_error = e
+                        except requests.RequestException as e:
+                            log(f"⚠️  下载失败: {e}")
+                            last_error = e
+                            break
                     
-                    for file_url in urls_to_try:
-                        if not file_url:
+                    log(f"💡 你可以手动访问: {self.api_url}/file={file_path}")
+                    raise classify_error(last_error, DownloadError, f"无法下载图像 {file_path}")
+                
+                # 如果是 base64 编码
+                elif "data" in image_data:
+                    return decode_base64_image(image_data["data"])
+                
+                # 如果是 URL
+                elif "url" in image_data:
+                    response = self.session.get(image_data["url"], timeout=30)
+                    response.raise_for_status()
+                    return open_image_bytes(response.content)
+            
+            elif isinstance(image_data, str):
+                # 直接是 base64 字符串
+                return decode_base64_image(image_data)
+            
+            raise DownloadError(f"无法识别的图像数据: {str(image_data)[:200]}", retryable=False)
+        except BackendError:
+            raise
+        except Exception as e:
+            log(f"❌ 图像解析失败: {e}")
+            raise classify_error(e, DownloadError, "图像解析失败") from e
+
+
+# ============ 异步客户端 ============
+
+_async_sessions: Dict[str, httpx.AsyncClient] = {}
+
+
+def get_async_session(
+    api_url: str,
+    pool_size: int = HTTP_POOL_SIZE,
+    max_retries: int = HTTP_MAX_RETRIES,
+) -> httpx.AsyncClient:
+    """
+    按 api_url 获取共享 httpx.AsyncClient（只能在同一个事件循环内使用）
+    
+    连接池上限与同步 Session 一致；transport 层只重试建连失败，不会重复提交请求。
+    """
+    key = api_url.rstrip('/')
+    client = _async_sessions.get(key)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            headers={"User-Agent": DEFAULT_USER_AGENT},
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            transport=httpx.AsyncHTTPTransport(retries=max_retries),
+            timeout=httpx.Timeout(30.0),
+        )
+        _async_sessions[key] = client
+        log(f"🔌 已创建异步连接池: {key}")
+    return client
+
+
+async def close_all_async_sessions():
+    """关闭所有共享 AsyncClient（服务关闭时调用）"""
+    clients = list(_async_sessions.values())
+    _async_sessions.clear()
+    for client in clients:
+        await client.aclose()
+
+
+class FileRefCache:
+    """
+    (api_url, 内容哈希) -> Gradio 文件引用
+    
+    同一张参考图对同一个后端只上传一次，并发请求共用同一次上传；
+    引用超过 ttl 或被 invalidate 后重新上传。
+    """
+    
+    def __init__(self, ttl: float = FILE_REF_TTL):
+        self.ttl = ttl
+        self._refs: Dict[tuple, tuple] = {}  # key -> (file_ref, 过期时间)
+        self._pending: Dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    async def get_or_upload(self, api_url: str, content_hash: str,
+                            upload: Callable[[], Awaitable[dict]]) -> dict:
+        """命中缓存直接返回引用，否则调用 upload() 上传并缓存结果"""
+        key = (api_url.rstrip('/'), content_hash)
+        cached = self._refs.get(key)
+        if cached is not None:
+            if cached[1] > time.monotonic():
+                self.hits += 1
+                return dict(cached[0])
+            del self._refs[key]
+        pending = self._pending.get(key)
+        if pending is None:
+            self.misses += 1
+            pending = asyncio.ensure_future(upload())
+            self._pending[key] = pending
+            
+            def on_done(fut: asyncio.Future):
+                self._pending.pop(key, None)
+                if not fut.cancelled() and fut.exception() is None:
+                    self._refs[key] = (fut.result(), time.monotonic() + self.ttl)
+            
+            pending.add_done_callback(on_done)
+        # shield：某个等待者被取消不影响其他共用这次上传的请求
+        return dict(await asyncio.shield(pending))
+    
+    def invalidate(self, api_url: str, content_hash: Optional[str] = None):
+        """使某个后端的引用失效（content_hash 为 None 时清空该后端的全部引用）"""
+        key_url = api_url.rstrip('/')
+        for key in [k for k in self._refs if k[0] == key_url and (content_hash is None or k[1] == content_hash)]:
+            del self._refs[key]
+    
+    def clear(self):
+        self._refs.clear()
+
+
+file_ref_cache = FileRefCache()
+
+
+class AsyncHunyuanImageClient:
+    """
+    HunyuanImage 异步 API 客户端
+    
+    上传、入队、SSE 读取、结果下载全部在事件循环上完成，不占用线程。
+    取消调用方的 Task 会立即关闭对应的 SSE 连接。
+    """
+    
+    def __init__(self, api_url: str, session: Optional[httpx.AsyncClient] = None):
+        """
+        初始化客户端
+        
+        Args:
+            api_url: Gradio 服务地址
+            session: 自定义 httpx.AsyncClient，不指定则使用该 api_url 的共享连接池
+        """
+        self.api_url = api_url.rstrip('/')
+        self.session = session or get_async_session(self.api_url)
+    
+    async def upload_file(self, file_path: str, content_hash: Optional[str] = None) -> dict:
+        """
+        上传文件到 Gradio 服务器（按内容哈希去重，同一文件对同一后端只上传一次）
+        
+        Args:
+            file_path: 本地文件路径
+            content_hash: 文件的内容哈希（hash_file），不指定时读取文件计算
+            
+        Returns:
+            Gradio 文件引用 dict，包含 path, url, orig_name, size, mime_type
+        """
+        file_path = Path(file_path)
+        if content_hash is None:
+            content_hash = await asyncio.to_thread(hash_file, file_path)
+        return await file_ref_cache.get_or_upload(
+            self.api_url, content_hash, lambda: self._upload(file_path)
+        )
+    
+    async def _upload(self, file_path: Path) -> dict:
+        """实际上传文件"""
+        mime_type = MIME_MAP.get(file_path.suffix.lower(), 'image/png')
+        
+        log(f"📤 上传文件到 Gradio: {file_path.name}")
+        
+        # 读文件放到线程里，避免大图阻塞事件循环
+        content = await asyncio.to_thread(file_path.read_bytes)
+        try:
+            response = await self.session.post(
+                f"{self.api_url}/gradio_api/upload",
+                files={"files": (file_path.name, content, mime_type)},
+                timeout=60
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise classify_error(e, UploadError, "上传失败") from e
+        metrics.UPLOAD_BYTES.inc(len(content), backend=self.api_url)
+        
+        # Gradio 返回的是一个路径数组
+        result = response.json()
+        remote_path = result[0] if isinstance(result, list) else result
+        
+        file_ref = build_file_ref(self.api_url, remote_path, file_path, mime_type)
+        
+        log(f"✅ 上传完成: {remote_path}")
+        return file_ref
+    
+    async def generate(
+        self,
+        prompt: str,
+        images: Optional[List[dict]] = None,
+        seed: int = 42,
+        image_size: str = "auto",
+        width: int = 1024,
+        height: int = 1024,
+        diff_infer_steps: int = 50,
+        enable_safety_checker: bool = True,
+        on_progress: Optional[Callable[[dict], None]] = None,
+        download_dir: Optional[Path] = None,
+        timings: Optional[dict] = None,
+    ) -> tuple[Union[Image.Image, "DownloadedImage", None], str]:
+        """
+        统一生成接口（文生图 / 图生图），参数同 HunyuanImageClient.generate
+        
+        Args:
+            download_dir: 指定时启用直存模式：结果分块写入该目录下的临时文件，
+                不解码，返回 DownloadedImage
+        
+        Returns:
+            (生成的图像, 生成信息)
+        """
+        session_hash = generate_session_hash()
+        timer = PhaseTimer(timings)
+        payload = build_generate_payload(
+            prompt, images, seed, image_size, width, height,
+            diff_infer_steps, enable_safety_checker, session_hash
+        )
+        
+        mode = "图生图" if images else "文生图"
+        log(f"📝 [{mode}] {prompt}")
+        if images:
+            log(f"🖼️ 参考图: {len(images)} 张")
+        log(f"🎲 Seed: {seed}, 📐 Size: {image_size} ({width}x{height}), 🔄 Steps: {diff_infer_steps}")
+        
+        try:
+            try:
+                response = await self.session.post(
+                    f"{self.api_url}/gradio_api/queue/join",
+                    json=payload,
+                    timeout=30
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                raise classify_error(e, QueueJoinError, "加入队列失败") from e
+            timer.lap("join")
+            
+            log(f"✅ 已加入队列 (session: {session_hash[:8]}...)")
+            
+            result = await self._get_sse_result(session_hash, on_progress=on_progress, timer=timer)
+            timer.lap("diffusion")
+            
+            if result and len(result) >= 1:
+                image_data = result[0]
+                info_text = result[1] if len(result) >= 2 else "生成成功"
+                image = await self._parse_image(image_data, download_dir)
+                timer.lap("download")
+                return image, info_text
+            else:
+                raise GenerationError("返回数据格式错误")
+        
+        except asyncio.CancelledError:
+            log(f"⏹️ 已取消 (session: {session_hash[:8]}...)")
+            raise
+        except Exception as e:
+            log(f"❌ 请求失败: {e}")
+            raise
+    
+    async def _get_sse_result(self, session_hash: str, timeout: int = 300,
+                              on_progress: Optional[Callable[[dict], None]] = None,
+                              timer: Optional[PhaseTimer] = None):
+        """通过 SSE 获取结果（timeout 为两条消息之间的最长等待；指定 timer 时记录排队耗时）"""
+        url = f"{self.api_url}/gradio_api/queue/data?session_hash={session_hash}"
+        
+        log(f"🔄 等待生成结果...")
+        
+        try:
+            async with self.session.stream(
+                "GET", url,
+                headers={"Accept": "text/event-stream"},
+                timeout=httpx.Timeout(timeout, connect=30),
+            ) as response:
+                response.raise_for_status()
+                try:
+                    async for line in response.aiter_lines():
+                        # SSE 格式: data: {...}
+                        if not line.startswith('data: '):
+                            continue
+                        try:
+                            data = json.loads(line[6:])
+                        except json.JSONDecodeError:
                             continue
                         
+                        if timer is not None and data.get("msg") == "process_starts":
+                            timer.lap("queue")
+                        result = handle_sse_message(data, on_progress)
+                        if result is not None:
+                            return result
+                except httpx.RemoteProtocolError:
+                    # 服务端发送完结果后直接断开，属于正常关闭
+                    pass
+                except httpx.ReadError as iter_error:
+                    log(f"⚠️  SSE 流读取中断: {iter_error}")
+            
+            raise StreamDroppedError("SSE 流结束但未获取到结果")
+        
+        except asyncio.CancelledError:
+            raise
+        except BackendError:
+            raise
+        except Exception as e:
+            log(f"❌ SSE 连接失败: {e}")
+            raise classify_error(e, StreamDroppedError, "SSE 连接失败") from e
+    
+    async def _download_to_file(self, url: str, download_dir: Path) -> DownloadedImage:
+        """流式下载到临时文件（分块写盘，不在内存中保留整张图），只读文件头取尺寸"""
+        path = new_download_path(download_dir)
+        try:
+            async with self.session.stream("GET", url, timeout=httpx.Timeout(30, connect=DOWNLOAD_CONNECT_TIMEOUT)) as response:
+                response.raise_for_status()
+                f = await asyncio.to_thread(open, path, "wb")
+                try:
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        await asyncio.to_thread(f.write, chunk)
+                        metrics.DOWNLOAD_BYTES.inc(len(chunk), backend=self.api_url)
+                finally:
+                    await asyncio.to_thread(f.close)
+            size, fmt = await asyncio.to_thread(probe_image_file, path)
+            return DownloadedImage(path, size, fmt)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+    
+    async def _store_bytes(self, content: bytes, download_dir: Path) -> DownloadedImage:
+        """把已在内存中的图像字节（base64 结果）写入临时文件"""
+        path = new_download_path(download_dir)
+        try:
+            await asyncio.to_thread(path.write_bytes, content)
+            size, fmt = await asyncio.to_thread(probe_image_file, path)
+            return DownloadedImage(path, size, fmt)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+    
+    async def _decode_base64(self, img_str: str, download_dir: Optional[Path]):
+        """解析 base64 结果（直存模式下写入临时文件）"""
+        if download_dir is None:
+            return decode_base64_image(img_str)
+        if img_str.startswith("data:image"):
+            img_str = img_str.split(",")[1]
+        return await self._store_bytes(base64.b64decode(img_str), download_dir)
+    
+    async def _parse_image(self, image_data, download_dir: Optional[Path] = None):
+        """解析图像数据（指定 download_dir 时直接落盘，返回 DownloadedImage），失败时抛出 DownloadError"""
+        try:
+            if isinstance(image_data, dict):
+                # Gradio 返回的文件格式
+                if "path" in image_data:
+                    file_path = image_data["path"]
+                    
+                    # 404 时换下一个候选地址；连不上后端时其余地址也不会成功，直接放弃
+                    last_error = None
+                    for file_url in file_download_urls(self.api_url, image_data):
                         try:
                             log(f"📥 尝试下载: {file_url}")
-                            response = requests.get(file_url, timeout=30)
+                            if download_dir is not None:
+                                return await self._download_to_file(file_url, download_dir)
+                            response = await self.session.get(
+                                file_url, timeout=httpx.Timeout(30, connect=DOWNLOAD_CONNECT_TIMEOUT)
+                            )
                             response.raise_for_status()
-                            return Image.open(io.BytesIO(response.content))
-                        except Exception as e:
+                            metrics.DOWNLOAD_BYTES.inc(len(response.content), backend=self.api_url)
+                            return open_image_bytes(response.content)
+                        except httpx.HTTPStatusError as e:
                             log(f"⚠️  下载失败: {e}")
-                            continue
+                            # 优先保留可重试的错误（其余候选地址的 404 不代表结果不存在）
+                            if last_error is None or is_retryable(e):
+                                last_error = e
+                        except (httpx.HTTPError, OSError) as e:
+                            log(f"⚠️  下载失败: {e}")
+                            last_error = e
+                            break
                     
-                    # 所有 URL 都失败，尝试直接返回路径信息
-                    log(f"⚠️  无法下载图像，返回路径: {file_path}")
                     log(f"💡 你可以手动访问: {self.api_url}/file={file_path}")
-                    return None
+                    raise classify_error(last_error, DownloadError, f"无法下载图像 {file_path}")
                 
                 # 如果是 base64 编码
                 elif "data" in image_data:
-                    img_str = image_data["data"]
-                    if img_str.startswith("data:image"):
-                        img_str = img_str.split(",")[1]
-                    img_bytes = base64.b64decode(img_str)
-                    return Image.open(io.BytesIO(img_bytes))
+                    return await self._decode_base64(image_data["data"], download_dir)
                 
                 # 如果是 URL
                 elif "url" in image_data:
-                    response = requests.get(image_data["url"], timeout=30)
-                    return Image.open(io.BytesIO(response.content))
+                    image_url = image_data["url"]
+                    try:
+                        if download_dir is not None:
+                            return await self._download_to_file(image_url, download_dir)
+                        response = await self.session.get(
+                            image_url, timeout=httpx.Timeout(30, connect=DOWNLOAD_CONNECT_TIMEOUT)
+                        )
+                        response.raise_for_status()
+                    except (httpx.HTTPError, OSError) as e:
+                        # 5xx / 超时等按可重试的 DownloadError 交给重试策略，不把错误页当成图像解析
+                        log(f"⚠️  下载失败: {e}")
+                        raise classify_error(e, DownloadError, f"无法下载图像 {image_url}") from e
+                    metrics.DOWNLOAD_BYTES.inc(len(response.content), backend=self.api_url)
+                    return open_image_bytes(response.content)
             
             elif isinstance(image_data, str):
                 # 直接是 base64 字符串
-                if image_data.startswith("data:image"):
-                    image_data = image_data.split(",")[1]
-                img_bytes = base64.b64decode(image_data)
-                return Image.open(io.BytesIO(img_bytes))
+                return await self._decode_base64(image_data, download_dir)
             
-            return None
+            raise DownloadError(f"无法识别的图像数据: {str(image_data)[:200]}", retryable=False)
+        except asyncio.CancelledError:
+            raise
+        except BackendError:
+            raise
         except Exception as e:
             log(f"❌ 图像解析失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            raise classify_error(e, DownloadError, "图像解析失败") from e
 
 
 def main():
@@ -10,17 +10,21 @@ MIT License
 import sys
 import json
 import uuid
+import argparse
 import asyncio
-import aiosqlite
+import hashlib
+import os
+import socket
+import sqlite3
 import time
 import traceback
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, UploadFile, File
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 
@@ -28,7 +32,46 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 # api_client.py 在同目录下
 import sys
 sys.path.insert(0, str(Path(__file__).parent))
-from api_client import HunyuanImageClient
+from api_client import (
+    AsyncHunyuanImageClient, BackendError, DownloadedImage, PhaseTimer, CONTENT_HASH_LEN, file_ref_cache,
+    hash_file, probe_image_file, close_all_sessions, close_all_async_sessions,
+)
+from job_broker import SQLiteJobBroker
+from job_queue import JobQueue
+from job_store import ACTIVE_STATUSES, JobStore
+from metrics import (
+    BACKEND_ERRORS, CONTENT_TYPE, DB_WRITE, GENERATION, IMAGES, JOBS, QUEUE_WAIT, REGISTRY, merge_snapshots,
+    monitor_event_loop,
+)
+from retry_policy import RetryPolicy
+from result_cache import CachedResult, ResultCache, link_or_copy, result_key
+from backend_pool import PoolRegistry
+from db_pool import DBPool
+from derivatives import DERIVATIVE_MEDIA_TYPE, DERIVATIVE_SIZES, FULL_SIZE, DerivativeCache, derivative_urls
+from image_encoder import ImageEncoder, ORIGINAL_FORMAT, OUTPUT_EXTENSIONS, resolve_format, supported_formats
+
+# ============ 运行环境 ============
+
+# asyncio.Task.cancelling() 需要 Python 3.11；共享队列领取任务用的 UPDATE ... RETURNING 需要 SQLite 3.35
+MIN_PYTHON = (3, 11)
+MIN_SQLITE = (3, 35, 0)
+
+
+def check_runtime():
+    """版本不满足时直接退出，避免运行到一半才在取消任务或领取任务时出错"""
+    problems = []
+    if sys.version_info < MIN_PYTHON:
+        problems.append(f"需要 Python >= {'.'.join(map(str, MIN_PYTHON))}，当前为 {sys.version.split()[0]}")
+    if sqlite3.sqlite_version_info < MIN_SQLITE:
+        problems.append(f"需要 SQLite >= {'.'.join(map(str, MIN_SQLITE))}，当前为 {sqlite3.sqlite_version}"
+                        "（Python 的 sqlite3 模块链接的版本）")
+    if problems:
+        for problem in problems:
+            print(f"❌ {problem}")
+        sys.exit(1)
+
+
+check_runtime()
 
 # ============ 路径 & 常量 ============
 
@@ -37,6 +80,8 @@ STATIC_DIR = SCRIPT_DIR / "static"
 OUTPUT_DIR = SCRIPT_DIR / "output"
 UPLOADS_DIR = SCRIPT_DIR / "uploads"
 DB_PATH = SCRIPT_DIR / "data.db"
+CACHE_DIR = SCRIPT_DIR / "cache"  # 缩略图 / 预览图缓存
+DB_READERS = 3  # 读连接数（另有一个独占写连接）
 
 for d in (OUTPUT_DIR, STATIC_DIR, UPLOADS_DIR):
     d.mkdir(parents=True, exist_ok=True)
@@ -44,12 +89,115 @@ for d in (OUTPUT_DIR, STATIC_DIR, UPLOADS_DIR):
 PORT = 8849
 BJT = timezone(timedelta(hours=8))  # 北京时间
 
+# 调度并发：全局最多同时执行的任务数，以及每个 api_url 后端的默认并发上限
+MAX_CONCURRENT_JOBS = 4
+MAX_JOBS_PER_BACKEND = 1
+BACKEND_CONCURRENCY: Dict[str, int] = {}  # 按 api_url 单独覆盖并发上限
+
+# 多后端负载均衡：api_url 填写多个地址（逗号分隔）或下面注册的池名时，单张图片按最少在途请求分配到各后端
+BACKEND_POOLS: Dict[str, List[dict]] = {}  # 池名 -> [{"url": ..., "weight": 1}]
+backend_pools = PoolRegistry()
+
+# 单张图片的重试 / 对冲策略（只重试加入队列失败、SSE 中断、下载失败等可恢复错误）
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0    # 指数退避基数（秒），实际等待带随机抖动
+RETRY_MAX_DELAY = 20.0
+HEDGE_AFTER_SEC = 0       # 多后端时单张超过该秒数仍未完成就在另一个后端上对冲，0 表示不对冲
+retry_policy = RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, HEDGE_AFTER_SEC)
+
 # 任务队列系统
-active_jobs: Dict[str, Dict[str, Any]] = {}
-task_queue: asyncio.PriorityQueue = None  # 在 lifespan 中初始化，使用优先级队列
-queue_worker_task = None
+# 队列实现：local（单进程内存队列）/ sqlite（多个进程或副本共用 data.db 中的 jobs 表，见 job_broker.py）
+# 用 --workers 启动多个 uvicorn 进程时自动使用 sqlite；worker 进程重新导入本模块，因此通过环境变量传递
+JOB_BROKER = os.environ.get("HUNYUAN_JOB_BROKER", "local")
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"  # 共享队列中领取任务的进程标识
+REMOTE_JOB_TTL = 600  # 其他进程执行的任务结束后，本进程保留其状态的时间（秒），供轮询的客户端读取
+STALE_TEMP_SEC = 3600  # 共享队列模式下启动时只清理这么久以前的临时文件（其他进程可能正在写）
+METRICS_PUBLISH_SEC = 5  # 共享队列模式下各进程写入指标快照的间隔（秒）
+METRICS_STALE_SEC = 30   # 超过这么久没有更新的指标快照视为进程已退出，不再输出
+job_broker: Optional[SQLiteJobBroker] = None  # sqlite 模式下在 lifespan 中创建
+active_jobs: Dict[str, Dict[str, Any]] = {}  # 共享队列模式下也包含其他进程执行的任务（remote=True，从 jobs 表同步）
+backend_queues: Dict[str, JobQueue] = {}  # api_url -> 该后端的优先级队列（带 job_id 索引；共享模式下为 SharedJobQueue）
+backend_workers: Dict[str, List[asyncio.Task]] = {}  # api_url -> 该后端的 worker
+global_slots: asyncio.Semaphore = None  # 在 lifespan 中初始化，限制全局并发
 queue_counter = 0  # 用于保证相同优先级时按入队顺序执行
 
+db_pool = DBPool(DB_PATH, readers=DB_READERS, on_write=DB_WRITE.observe)  # 在 lifespan 中打开
+IMAGE_COLUMNS: List[str] = []  # images 表的列名，init_db 后填充
+# 任务状态持久化（jobs 表）：重启后恢复未完成的任务；已结束的任务保留一段时间后清理
+job_store = JobStore(db_pool)
+JOB_RETENTION_SEC = 7 * 86400
+LIST_EXCLUDED_COLUMNS = ("info",)  # 列表视图不返回的大字段
+# 单张图片的分阶段耗时（image_timings 表中对应 {phase}_sec 列）：
+# 上传参考图、加入队列、上游排队、上游生成、下载结果、编码落盘（含结果缓存）、写数据库
+TIMING_PHASES = ("upload", "join", "queue", "diffusion", "download", "encode", "db")
+HISTORY_PAGE_MAX = 500
+SORT_GAP = 1024  # 重新编号时相邻 sort_order 的间隔，留出单行移动的空位
+job_tasks: Dict[str, set] = {}  # job_id -> 正在运行的单张生成 Task，取消时直接 cancel
+inflight_jobs: Dict[tuple, str] = {}  # 确定性任务的参数签名 -> 正在排队 / 执行的主任务 job_id（相同请求合并）
+
+# 上传 / 导入：分块写盘，不在内存中缓存整个文件
+UPLOAD_MAX_BYTES = 50 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 结果编码：png / webp（无损）/ jpeg / avif / original（原样保存上游字节）
+# original 为直存模式：下载时分块写盘，只读文件头取尺寸，不解码也不重新编码
+OUTPUT_FORMAT = "png"
+ENCODE_WORKERS = 2  # 编码线程数，编码不占用事件循环
+image_encoder = ImageEncoder(workers=ENCODE_WORKERS)
+
+# 画廊缩略图缓存（/derived/{thumb|preview|full}/{filename}）
+# 使用独立的线程池：打开画廊时大量缩略图排队生成，不能挤占生成结果的编码和落盘
+DERIVATIVE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DERIVATIVE_MAX_AGE = 86400
+DERIVATIVE_WORKERS = 1
+derivative_renderer = ImageEncoder(workers=DERIVATIVE_WORKERS, name="derive")
+derivative_cache = DerivativeCache(OUTPUT_DIR, CACHE_DIR, DERIVATIVE_CACHE_MAX_BYTES, run=derivative_renderer.run)
+
+# 生成结果缓存：seed >= 0 时相同参数直接复用已有结果，不调用后端（0 表示关闭）
+RESULT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+result_cache = ResultCache(CACHE_DIR / "results", RESULT_CACHE_MAX_BYTES, run=image_encoder.run)
+
+# 任务事件推送（/api/events）
+EVENT_QUEUE_SIZE = 256  # 单个订阅者最多积压的事件数，超过则断开（客户端重连后收到快照）
+EVENT_KEEPALIVE_SEC = 15
+event_subscribers: set = set()  # 每个订阅者一个 asyncio.Queue
+
+# /metrics 抓取时才计算的状态量（热路径上不维护）
+JOB_OUTCOMES = {"finished": "completed", "failed": "failed", "cancelled": "cancelled"}  # 结束事件 -> 指标标签
+
+
+def _count_by(values) -> Dict[tuple, int]:
+    counts: Dict[tuple, int] = {}
+    for value in values:
+        counts[(value,)] = counts.get((value,), 0) + 1
+    return counts
+
+
+def _unique_backends():
+    """所有后端池中的后端（同一 URL 可能属于多个池，只算一次）"""
+    return {b.url: b for pool in backend_pools.pools() for b in pool.backends}.values()
+
+
+REGISTRY.gauge("queue_depth", "各后端队列中排队的任务数", ("backend",),
+               collect=lambda: {(url,): len(q) for url, q in backend_queues.items()})
+REGISTRY.gauge("active_jobs", "内存中的任务数（按状态）", ("status",),
+               collect=lambda: _count_by(info.get("status") for info in active_jobs.values()))
+REGISTRY.gauge("event_subscribers", "/api/events 订阅者数",
+               collect=lambda: {(): len(event_subscribers)})
+REGISTRY.gauge("backend_outstanding", "各后端的在途请求数", ("backend",),
+               collect=lambda: {(b.url,): b.outstanding for b in _unique_backends()})
+REGISTRY.gauge("backend_up", "后端是否可用（健康且未熔断）", ("backend",),
+               collect=lambda: {(b.url,): int(b.available) for b in _unique_backends()})
+ENCODER_POOLS = (image_encoder, derivative_renderer)  # pool 标签：encode（生成结果）/ derive（缩略图）
+REGISTRY.gauge("encoder_busy", "编码线程池中正在执行的任务数", ("pool",),
+               collect=lambda: {(e.name,): min(e.inflight, e.workers) for e in ENCODER_POOLS})
+REGISTRY.gauge("encoder_queued", "编码线程池中等待线程的任务数", ("pool",),
+               collect=lambda: {(e.name,): max(e.inflight - e.workers, 0) for e in ENCODER_POOLS})
+REGISTRY.gauge("encoder_workers", "编码线程数", ("pool",),
+               collect=lambda: {(e.name,): e.workers for e in ENCODER_POOLS})
+REGISTRY.gauge("result_cache_lookups", "结果缓存查询次数（启动以来）", ("result",),
+               collect=lambda: {("hit",): result_cache.hits, ("miss",): result_cache.misses})
+
 
 def now_bjt() -> str:
     """返回北京时间 ISO 字符串"""
@@ -58,73 +206,270 @@ def now_bjt() -> str:
 
 # ============ 数据库 ============
 
+async def _table_columns(db, table: str) -> List[str]:
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in await cursor.fetchall()]
+
+
+async def _migrate_create_images(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            prompt TEXT,
+            seed INTEGER DEFAULT 42,
+            image_size TEXT DEFAULT 'auto',
+            width INTEGER DEFAULT 1024,
+            height INTEGER DEFAULT 1024,
+            steps INTEGER DEFAULT 50,
+            api_url TEXT,
+            status TEXT DEFAULT 'completed',
+            error TEXT,
+            info TEXT,
+            duration_sec REAL DEFAULT 0,
+            batch_count INTEGER DEFAULT 1,
+            batch_total_sec REAL DEFAULT 0,
+            parallel INTEGER DEFAULT 1,
+            ref_images TEXT,
+            created_at TEXT,
+            sort_order INTEGER DEFAULT 0
+        )
+    """)
+
+
+async def _migrate_ref_images(db):
+    # 旧数据库可能没有 ref_images 字段
+    if "ref_images" not in await _table_columns(db, "images"):
+        await db.execute("ALTER TABLE images ADD COLUMN ref_images TEXT")
+
+
+async def _migrate_sort_order(db):
+    # 旧数据库可能没有 sort_order 字段
+    if "sort_order" in await _table_columns(db, "images"):
+        return
+    await db.execute("ALTER TABLE images ADD COLUMN sort_order INTEGER DEFAULT 0")
+    # 初始化 sort_order：按 created_at 倒序赋值（窗口函数一次排序，O(n log n)）
+    await db.execute("""
+        UPDATE images SET sort_order = ranked.rn
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (ORDER BY created_at DESC, id DESC) - 1 AS rn
+            FROM images
+        ) AS ranked
+        WHERE images.id = ranked.id
+    """)
+
+
+async def _migrate_indexes(db):
+    # get_history 按 sort_order 排序，update_batch_total 按 job_id 过滤，api_import 按 filename 查找
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_images_sort_order ON images(sort_order)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_images_job_id ON images(job_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_images_filename ON images(filename)")
+
+
+async def _migrate_revisions(db):
+    # 增量同步：每次插入 / 修改 / 删除都会把全局 revision + 1，并记在行上（删除记在 image_tombstones）
+    # 用触发器维护，所有写入路径（包括批量排序）都不会漏记
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            revision INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await db.execute("INSERT OR IGNORE INTO sync_state (id, revision) VALUES (1, 0)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS image_tombstones (
+            id INTEGER PRIMARY KEY,
+            revision INTEGER NOT NULL
+        )
+    """)
+    if "revision" not in await _table_columns(db, "images"):
+        await db.execute("ALTER TABLE images ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_images_revision ON images(revision)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tombstones_revision ON image_tombstones(revision)")
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_images_insert_rev AFTER INSERT ON images
+        BEGIN
+            UPDATE sync_state SET revision = revision + 1 WHERE id = 1;
+            UPDATE images SET revision = (SELECT revision FROM sync_state WHERE id = 1) WHERE id = NEW.id;
+        END
+    """)
+    # WHEN 条件排除触发器自己对 revision 的更新，避免递归
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_images_update_rev AFTER UPDATE ON images
+        WHEN NEW.revision = OLD.revision
+        BEGIN
+            UPDATE sync_state SET revision = revision + 1 WHERE id = 1;
+            UPDATE images SET revision = (SELECT revision FROM sync_state WHERE id = 1) WHERE id = NEW.id;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_images_delete_rev AFTER DELETE ON images
+        BEGIN
+            UPDATE sync_state SET revision = revision + 1 WHERE id = 1;
+            INSERT OR REPLACE INTO image_tombstones (id, revision)
+                VALUES (OLD.id, (SELECT revision FROM sync_state WHERE id = 1));
+        END
+    """)
+
+
+async def _migrate_timings(db):
+    # 每张图片一行分阶段耗时，随 images 行删除
+    phase_columns = ", ".join(f"{phase}_sec REAL" for phase in TIMING_PHASES)
+    await db.execute(f"""
+        CREATE TABLE IF NOT EXISTS image_timings (
+            image_id INTEGER PRIMARY KEY,
+            attempts INTEGER DEFAULT 1,
+            {phase_columns}
+        )
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_images_delete_timings AFTER DELETE ON images
+        BEGIN
+            DELETE FROM image_timings WHERE image_id = OLD.id;
+        END
+    """)
+
+
+async def _migrate_jobs(db):
+    # 任务状态持久化，info / job_data 为 JSON
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            priority INTEGER DEFAULT 1,
+            counter INTEGER,
+            api_url TEXT,
+            queued_ts REAL,
+            started_ts REAL,
+            finished_ts REAL,
+            error TEXT,
+            info TEXT,
+            job_data TEXT NOT NULL,
+            updated_ts REAL
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, priority, counter)")
+
+
+async def _migrate_shared_queue(db):
+    # 多进程共享队列：所属后端队列、领取任务的进程和租约；批次耗时供其他进程转发 finished 事件
+    columns = await _table_columns(db, "jobs")
+    for column, decl in (("queue_key", "TEXT"), ("owner", "TEXT"), ("lease_until", "REAL"), ("batch_total", "REAL")):
+        if column not in columns:
+            await db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {decl}")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(queue_key, status, priority, counter)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs(updated_ts)")
+
+
+async def _migrate_metric_snapshots(db):
+    # 多进程部署时各进程的指标快照，/metrics 合并输出（body 为 metrics.Registry.snapshot() 的 JSON）
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS metric_snapshots (
+            worker TEXT PRIMARY KEY,
+            updated_ts REAL,
+            body TEXT
+        )
+    """)
+
+
+# 数据库迁移步骤：(版本号, 说明, 迁移函数)
+# 当前版本记录在 PRAGMA user_version 中，只追加、不修改已发布的步骤。
+# 旧版本创建的数据库 user_version 为 0，因此前几步需要兼容已存在的表和字段。
+MIGRATIONS = [
+    (1, "创建 images 表", _migrate_create_images),
+    (2, "添加 ref_images 字段", _migrate_ref_images),
+    (3, "添加 sort_order 字段", _migrate_sort_order),
+    (4, "添加 sort_order / job_id / filename 索引", _migrate_indexes),
+    (5, "添加 revision 增量同步", _migrate_revisions),
+    (6, "添加 image_timings 分阶段耗时", _migrate_timings),
+    (7, "添加 jobs 任务持久化", _migrate_jobs),
+    (8, "添加 jobs 共享队列字段", _migrate_shared_queue),
+    (9, "添加 metric_snapshots 多进程指标快照", _migrate_metric_snapshots),
+]
+
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                job_id TEXT NOT NULL,
-                filename TEXT NOT NULL,
-                prompt TEXT,
-                seed INTEGER DEFAULT 42,
-                image_size TEXT DEFAULT 'auto',
-                width INTEGER DEFAULT 1024,
-                height INTEGER DEFAULT 1024,
-                steps INTEGER DEFAULT 50,
-                api_url TEXT,
-                status TEXT DEFAULT 'completed',
-                error TEXT,
-                info TEXT,
-                duration_sec REAL DEFAULT 0,
-                batch_count INTEGER DEFAULT 1,
-                batch_total_sec REAL DEFAULT 0,
-                parallel INTEGER DEFAULT 1,
-                ref_images TEXT,
-                created_at TEXT,
-                sort_order INTEGER DEFAULT 0
-            )
-        """)
-        await db.commit()
-        
-        # 检查是否需要添加字段（旧数据库升级）
-        cursor = await db.execute("PRAGMA table_info(images)")
-        columns = [row[1] for row in await cursor.fetchall()]
-        if "ref_images" not in columns:
-            await db.execute("ALTER TABLE images ADD COLUMN ref_images TEXT")
-            await db.commit()
-            print("✅ 数据库已升级：添加 ref_images 字段")
-        if "sort_order" not in columns:
-            await db.execute("ALTER TABLE images ADD COLUMN sort_order INTEGER DEFAULT 0")
-            await db.commit()
-            # 初始化 sort_order：按 created_at 倒序赋值
-            await db.execute("""
-                UPDATE images SET sort_order = (
-                    SELECT COUNT(*) FROM images AS i2 
-                    WHERE i2.created_at > images.created_at OR 
-                          (i2.created_at = images.created_at AND i2.id > images.id)
-                )
-            """)
-            await db.commit()
-            print("✅ 数据库已升级：添加 sort_order 字段")
+    """
+    按 user_version 依次执行未完成的迁移步骤，每一步在独立事务中完成
+    
+    版本在写锁内读取：多个进程同时启动时，每一步只有一个进程执行
+    """
+    async with db_pool.write() as db:
+        for step_version, desc, migrate in MIGRATIONS:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                version = (await (await db.execute("PRAGMA user_version")).fetchone())[0]
+                if step_version <= version:
+                    await db.rollback()
+                    continue
+                await migrate(db)
+                await db.execute(f"PRAGMA user_version = {step_version}")
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+            print(f"✅ 数据库已升级到 v{step_version}：{desc}")
+        IMAGE_COLUMNS[:] = await _table_columns(db, "images")
     print("✅ 数据库已初始化")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global task_queue, queue_worker_task
+    global global_slots, job_broker
     # 启动时初始化
+    loop_monitor = asyncio.create_task(monitor_event_loop())
+    for name, backends in BACKEND_POOLS.items():
+        backend_pools.register(name, backends).start_probing()
+    await db_pool.open()
     await init_db()
-    task_queue = asyncio.PriorityQueue()  # 使用优先级队列
-    queue_worker_task = asyncio.create_task(queue_worker())
-    print("✅ 任务队列已启动")
+    if JOB_BROKER == "sqlite":
+        job_broker = SQLiteJobBroker(job_store, WORKER_ID, on_sync=sync_remote_jobs)
+    global_slots = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+    metrics_publisher = asyncio.create_task(publish_metrics_loop()) if job_broker is not None else None
+    image_encoder.start()
+    derivative_renderer.start()
+    # 清理上次异常退出时残留的下载 / 上传 / 编码临时文件
+    for f in (*OUTPUT_DIR.glob(".*"), *UPLOADS_DIR.glob(".*")):
+        if f.is_file() and f.suffix in (".part", ".tmp"):
+            if job_broker is None or time.time() - f.stat().st_mtime > STALE_TEMP_SEC:
+                f.unlink(missing_ok=True)
+    # 多进程共用缓存目录：按整个目录的大小淘汰，不误删其他进程正在写入的文件
+    derivative_cache.shared = result_cache.shared = job_broker is not None
+    derivative_cache.load()
+    result_cache.load()
+    await job_store.prune(JOB_RETENTION_SEC)
+    await recover_jobs()
+    if job_broker is not None:
+        job_broker.start()
+        print(f"✅ 共享任务队列: {DB_PATH} (进程 {WORKER_ID})")
+    print(f"✅ 结果编码: {resolve_format(OUTPUT_FORMAT)} (可选 {', '.join(supported_formats())})")
+    print(f"✅ 任务队列已启动 (全局并发 {MAX_CONCURRENT_JOBS}, 单后端并发 {MAX_JOBS_PER_BACKEND})")
     yield
     # 关闭时清理
-    if queue_worker_task:
-        queue_worker_task.cancel()
-        try:
-            await queue_worker_task
-        except asyncio.CancelledError:
-            pass
+    loop_monitor.cancel()
+    if metrics_publisher is not None:
+        metrics_publisher.cancel()
+    for subscriber in list(event_subscribers):
+        close_subscriber(subscriber)
+    workers = [w for ws in backend_workers.values() for w in ws]
+    for w in workers:
+        w.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    if job_broker is not None:
+        await job_broker.close()  # 执行中的任务交还共享队列，由其他进程继续
+        job_broker = None
+        async with db_pool.write() as db:
+            await db.execute("DELETE FROM metric_snapshots WHERE worker = ?", (WORKER_ID,))
+    await job_store.close()  # 单进程模式下被中断的任务保持 generating，下次启动时恢复
+    backend_workers.clear()
+    backend_queues.clear()
+    await backend_pools.close()
+    close_all_sessions()
+    await close_all_async_sessions()
+    image_encoder.shutdown()
+    derivative_renderer.shutdown()
+    await db_pool.close()
 
 
 app = FastAPI(title="HunyuanImage API 测试工具", lifespan=lifespan)
@@ -134,108 +479,419 @@ app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
 
-async def get_next_sort_order():
-    """获取下一个 sort_order 值（最小值 - 1，确保新图片排在最前面）"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT MIN(sort_order) FROM images")
-        row = await cursor.fetchone()
-        min_order = row[0] if row[0] is not None else 0
-        return min_order - 1
+# 下一个 sort_order（最小值 - 1，确保新图片排在最前面）
+# 作为 INSERT 的子查询在写事务内求值，走 idx_images_sort_order 索引，并发写入也不会重复
+NEXT_SORT_ORDER_SQL = "(SELECT COALESCE(MIN(sort_order), 0) - 1 FROM images)"
 
 
 async def save_image_record(*, job_id, filename, prompt, seed, image_size, width, height,
                             steps, api_url, status="completed", error=None, info=None,
                             duration_sec=0, batch_count=1, batch_total_sec=0, parallel=True,
-                            ref_images=None):
+                            ref_images=None, timings=None, attempts=1) -> int:
+    """
+    写入一条图片记录，返回 id
+    
+    timings: 分阶段耗时（TIMING_PHASES），指定时随后写入 image_timings，
+             其中 db 阶段（等待写连接 + INSERT + 提交）在这里补上
+    """
     # ref_images 是文件名列表，存储为 JSON 字符串
     ref_images_str = json.dumps(ref_images) if ref_images else None
-    sort_order = await get_next_sort_order()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    timer = PhaseTimer(timings) if timings is not None else None
+    async with db_pool.write() as db:
+        cursor = await db.execute(f"""
             INSERT INTO images (job_id, filename, prompt, seed, image_size, width, height, steps, api_url, status, error, info, duration_sec, batch_count, batch_total_sec, parallel, ref_images, created_at, sort_order)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (job_id, filename, prompt, seed, image_size, width, height, steps, api_url, status, error, info, duration_sec, batch_count, batch_total_sec, 1 if parallel else 0, ref_images_str, now_bjt(), sort_order))
-        await db.commit()
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {NEXT_SORT_ORDER_SQL})
+        """, (job_id, filename, prompt, seed, image_size, width, height, steps, api_url, status, error, info, duration_sec, batch_count, batch_total_sec, 1 if parallel else 0, ref_images_str, now_bjt()))
+        image_id = cursor.lastrowid
+    if timer is not None:
+        # db 阶段包含提交，所以耗时记录只能在提交之后另起一个事务写入
+        timer.lap("db")
+        columns = ", ".join(f"{phase}_sec" for phase in TIMING_PHASES)
+        async with db_pool.write() as db:
+            await db.execute(
+                f"INSERT OR REPLACE INTO image_timings (image_id, attempts, {columns}) "
+                f"VALUES (?, ?, {', '.join('?' * len(TIMING_PHASES))})",
+                (image_id, attempts, *(timings.get(phase) for phase in TIMING_PHASES))
+            )
+    return image_id
+
+
+def timing_row(row: dict) -> dict:
+    """image_timings 行 -> {"attempts": n, "phases": {phase: 秒}}"""
+    return {
+        "attempts": row["attempts"],
+        "phases": {phase: row[f"{phase}_sec"] for phase in TIMING_PHASES},
+    }
+
+
+async def get_image_timings(image_id: int) -> Optional[dict]:
+    async with db_pool.read() as db:
+        row = await (await db.execute(
+            "SELECT t.*, i.api_url, i.duration_sec FROM image_timings t JOIN images i ON i.id = t.image_id "
+            "WHERE t.image_id = ?", (image_id,)
+        )).fetchone()
+    if row is None:
+        return None
+    row = dict(row)
+    return {"image_id": image_id, "api_url": row["api_url"], "duration_sec": row["duration_sec"], **timing_row(row)}
+
+
+def summarize_phase(values: List[float]) -> dict:
+    """均值和 p50 / p95（秒）"""
+    values = sorted(values)
+    n = len(values)
+    return {
+        "n": n,
+        "mean": round(sum(values) / n, 3),
+        "p50": values[(n - 1) // 2],
+        "p95": values[min(int(n * 0.95), n - 1)],
+    }
+
+
+async def get_timing_summary(limit: int, api_url: Optional[str] = None) -> List[dict]:
+    """最近 limit 张图片按后端汇总的分阶段耗时"""
+    sql = ("SELECT t.*, i.api_url FROM image_timings t JOIN images i ON i.id = t.image_id"
+           + (" WHERE i.api_url = ?" if api_url else "") + " ORDER BY t.image_id DESC LIMIT ?")
+    params = (api_url.rstrip('/'), limit) if api_url else (limit,)
+    async with db_pool.read() as db:
+        rows = [dict(row) for row in await (await db.execute(sql, params)).fetchall()]
+    by_backend: Dict[str, List[dict]] = {}
+    for row in rows:
+        by_backend.setdefault(row["api_url"] or "", []).append(row)
+    summary = []
+    for backend, group in by_backend.items():
+        phases = {}
+        for phase in TIMING_PHASES:
+            values = [r[f"{phase}_sec"] for r in group if r[f"{phase}_sec"] is not None]
+            if values:
+                phases[phase] = summarize_phase(values)
+        summary.append({
+            "api_url": backend,
+            "images": len(group),
+            "retried": sum(1 for r in group if (r["attempts"] or 1) > 1),
+            "phases": phases,
+        })
+    return summary
+
+
+def result_index(filename: str) -> Optional[int]:
+    """结果文件名 {时间}_{job_id}_{序号}.{扩展名} 中的图片序号"""
+    suffix = Path(filename).stem.rsplit("_", 1)[-1]
+    return int(suffix) if suffix.isdigit() else None
+
+
+async def get_job_results(job_ids: List[str]) -> Dict[str, List[dict]]:
+    """已经写入画廊的结果（恢复任务用），格式与 execute_generation 推送的 result 一致"""
+    if not job_ids:
+        return {}
+    async with db_pool.read() as db:
+        rows = await (await db.execute(
+            f"SELECT job_id, filename, seed, width, height, duration_sec, info FROM images "
+            f"WHERE job_id IN ({', '.join('?' * len(job_ids))}) ORDER BY id",
+            job_ids,
+        )).fetchall()
+    results: Dict[str, List[dict]] = {}
+    for row in rows:
+        idx = result_index(row["filename"])
+        if idx is None:
+            continue
+        results.setdefault(row["job_id"], []).append({
+            "index": idx,
+            "filename": row["filename"],
+            "url": f"/output/{row['filename']}",
+            "urls": derivative_urls(row["filename"]),
+            "duration": row["duration_sec"],
+            "seed": row["seed"],
+            "info": row["info"] or "",
+            "cached": False,
+            "width": row["width"],
+            "height": row["height"],
+        })
+    return results
 
 
 async def update_batch_total(job_id: str, batch_total_sec: float):
     """批次结束后回填总耗时"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.write() as db:
         await db.execute(
             "UPDATE images SET batch_total_sec = ? WHERE job_id = ?",
             (batch_total_sec, job_id)
         )
-        await db.commit()
 
 
-async def get_history(limit: int = 100):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM images ORDER BY sort_order ASC LIMIT ?", (limit,))
-        rows = await cursor.fetchall()
-        return [dict(row) for row in rows]
+def history_columns(fields: Optional[str]) -> str:
+    """
+    解析列投影参数
+    
+    fields: None / "all" 返回全部列；"list" 返回除 info 外的列（画廊列表用）；
+            也可以传逗号分隔的列名。id / sort_order / revision 总是包含（分页和同步需要）。
+    """
+    if not fields or fields == "all":
+        return "*"
+    if fields == "list":
+        cols = [c for c in IMAGE_COLUMNS if c not in LIST_EXCLUDED_COLUMNS]
+    else:
+        requested = {f.strip() for f in fields.split(",")}
+        cols = [c for c in IMAGE_COLUMNS if c in requested or c in ("id", "sort_order", "revision")]
+    return ", ".join(cols)
+
+
+def encode_cursor(sort_order: int, image_id: int) -> str:
+    return f"{sort_order}:{image_id}"
+
+
+def decode_cursor(cursor: str) -> tuple:
+    sort_order, image_id = cursor.split(":")
+    return int(sort_order), int(image_id)
+
+
+def add_derivative_urls(rows: List[dict]) -> List[dict]:
+    """为每条记录附上缩略图 / 预览图 / 原图地址（urls 字段）"""
+    for row in rows:
+        if row.get("filename"):
+            row["urls"] = derivative_urls(row["filename"])
+    return rows
+
+
+async def get_history(limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None):
+    """
+    按 (sort_order, id) 键集分页读取画廊
+    
+    Returns:
+        (记录列表, 下一页游标)，没有下一页时游标为 None
+    """
+    cols = history_columns(fields)
+    async with db_pool.read() as db:
+        if cursor:
+            after = decode_cursor(cursor)
+            sql = f"SELECT {cols} FROM images WHERE (sort_order, id) > (?, ?) ORDER BY sort_order, id LIMIT ?"
+            params = (*after, limit + 1)
+        else:
+            sql = f"SELECT {cols} FROM images ORDER BY sort_order, id LIMIT ?"
+            params = (limit + 1,)
+        rows = [dict(row) for row in await (await db.execute(sql, params)).fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["sort_order"], rows[-1]["id"])
+    return add_derivative_urls(rows), next_cursor
+
+
+async def get_current_revision() -> int:
+    async with db_pool.read() as db:
+        row = await (await db.execute("SELECT revision FROM sync_state WHERE id = 1")).fetchone()
+        return row[0] if row else 0
+
+
+async def get_history_changes(since: int, limit: int = 100, fields: Optional[str] = None):
+    """
+    读取 revision > since 的变更（新增 / 修改 / 排序变化的行，以及被删除的 id）
+    
+    Returns:
+        (变更行, 删除的 id 列表, 本次同步到的 revision, 是否还有更多变更)
+    """
+    cols = history_columns(fields)
+    async with db_pool.read() as db:
+        # 先读当前 revision 再按它截断：两次读取之间提交的写入留给下一次同步，不会被跳过
+        row = await (await db.execute("SELECT revision FROM sync_state WHERE id = 1")).fetchone()
+        upto = row[0] if row else 0
+        rows = [dict(row) for row in await (await db.execute(
+            f"SELECT {cols} FROM images WHERE revision > ? AND revision <= ? ORDER BY revision LIMIT ?",
+            (since, upto, limit + 1)
+        )).fetchall()]
+        has_more = len(rows) > limit
+        if has_more:
+            rows = rows[:limit]
+            upto = rows[-1]["revision"]
+        deleted = [row[0] for row in await (await db.execute(
+            "SELECT id FROM image_tombstones WHERE revision > ? AND revision <= ? ORDER BY revision",
+            (since, upto)
+        )).fetchall()]
+    return add_derivative_urls(rows), deleted, upto, has_more
 
 
 async def delete_image_record(image_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.write() as db:
         cursor = await db.execute("SELECT filename FROM images WHERE id = ?", (image_id,))
         row = await cursor.fetchone()
         if row and row[0]:
             fp = OUTPUT_DIR / row[0]
             if fp.exists():
                 fp.unlink()
+            derivative_cache.invalidate(row[0])
         await db.execute("DELETE FROM images WHERE id = ?", (image_id,))
-        await db.commit()
 
 
 async def clear_all_records():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.write() as db:
         await db.execute("DELETE FROM images")
-        await db.commit()
     for f in OUTPUT_DIR.iterdir():
-        if f.is_file() and f.suffix in ('.png', '.jpg', '.webp'):
+        if f.is_file() and f.suffix in OUTPUT_EXTENSIONS:
             f.unlink()
+    derivative_cache.clear()
+
+
+# ============ 任务事件 ============
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def close_subscriber(subscriber: asyncio.Queue):
+    """断开订阅者：清空积压事件并放入结束标记"""
+    event_subscribers.discard(subscriber)
+    while not subscriber.empty():
+        subscriber.get_nowait()
+    subscriber.put_nowait(None)
+
+
+def publish_event(event: str, data: dict, relayed: bool = False):
+    """
+    向所有 /api/events 订阅者推送任务事件（无订阅者时零开销，消息只序列化一次）
+    
+    relayed: 转发其他进程的事件，不计入本进程的指标
+    """
+    if event in JOB_OUTCOMES and not relayed:
+        JOBS.inc(outcome=JOB_OUTCOMES[event])
+    if not event_subscribers:
+        return
+    payload = format_sse(event, data)
+    for subscriber in list(event_subscribers):
+        try:
+            subscriber.put_nowait(payload)
+        except asyncio.QueueFull:
+            # 消费过慢，直接断开
+            close_subscriber(subscriber)
+
+
+def publish_positions(api_url: str):
+    """推送某个后端队列中所有排队任务的最新位置"""
+    if not event_subscribers:
+        return
+    queue = backend_queues.get(backend_key(api_url))
+    if queue is not None:
+        publish_event("positions", {"positions": queue.positions()})
+
+
+def job_summary(job_id: str, info: dict) -> dict:
+    """任务状态摘要（/api/jobs 与事件快照共用）"""
+    return {
+        "job_id": job_id,
+        "prompt": info.get("prompt", ""),
+        "count": info.get("count", 1),
+        "completed": info.get("completed", 0),
+        "status": info.get("status", "pending"),
+        "queued_ts": info.get("queued_ts"),
+        "started_ts": info.get("started_ts"),  # None 表示还在排队
+        "parallel": info.get("parallel", True),
+        "results": info.get("results", []),
+        "batch_total": info.get("batch_total"),
+        "error": info.get("error"),
+        "ratio": info.get("ratio", "auto"),
+        "actual_width": info.get("actual_width"),
+        "actual_height": info.get("actual_height"),
+        "ref_images": info.get("ref_images", []),
+        "queue_position": queue_position(job_id, info),
+        "progress": info.get("progress", {}),  # 每张图的上游进度，key 为图片序号
+        "coalesced_with": info.get("leader"),  # 合并到的主任务
+    }
 
 
 # ============ 队列 Worker ============
 
-async def queue_worker():
-    """后台任务处理 worker，按优先级执行队列中的任务"""
+def backend_key(api_url: str) -> str:
+    """后端标识（规范化的 api_url；多后端时为池名或逗号连接的地址列表）"""
+    return backend_pools.resolve_key(api_url)
+
+
+def get_backend_queue(api_url: str) -> JobQueue:
+    """获取后端的优先级队列，首次使用时按并发上限启动对应的 worker"""
+    key = backend_key(api_url)
+    queue = backend_queues.get(key)
+    if queue is None:
+        pool = backend_pools.get(key)
+        pool.start_probing()
+        limit = BACKEND_CONCURRENCY.get(key, MAX_JOBS_PER_BACKEND * pool.size)
+        # 共享队列的并发上限对所有进程合计生效（领取时检查），本进程按同样数量启动 worker
+        queue = job_broker.queue(key, limit) if job_broker is not None else JobQueue()
+        backend_queues[key] = queue
+        backend_workers[key] = [asyncio.create_task(queue_worker(key)) for _ in range(limit)]
+        print(f"[{now_bjt()}] 🧵 后端队列已创建: {key} (并发 {limit})")
+    return queue
+
+
+def pending_count() -> int:
+    """所有后端队列中排队的任务总数"""
+    return sum(q.qsize() for q in backend_queues.values())
+
+
+def queue_position(job_id: str, job: dict):
+    """任务在其后端队列中的当前位置（从 1 开始），不在排队中返回 None；合并的任务返回主任务的位置"""
+    job_id = job.get("leader") or job_id
+    queue = backend_queues.get(backend_key(job.get("api_url", "")))
+    return queue.position(job_id) if queue else None
+
+
+async def queue_worker(api_url: str):
+    """后台任务处理 worker，按优先级执行某个后端队列中的任务，受全局并发上限约束"""
+    task_queue = backend_queues[api_url]
     while True:
         try:
             # 从优先级队列获取任务，格式为 (priority, counter, job)
             priority, counter, job = await task_queue.get()
             job_id = job["job_id"]
+            publish_positions(api_url)
+            if job_broker is not None:
+                # 共享队列领到的任务可能由其他进程提交或从退出的进程接手：从数据库重建状态
+                job = await adopt_job(job_id)
+                if job is None:
+                    task_queue.task_done()
+                    continue
             
-            # 检查任务是否已被取消（从队列取出时可能已被标记取消）
-            if job_id not in active_jobs:
-                print(f"[{now_bjt()}] ⏭️ 跳过已取消的任务: {job_id}")
-                task_queue.task_done()
-                continue
-            
-            # 检查状态是否为 cancelled
-            if active_jobs[job_id].get("status") == "cancelled":
-                print(f"[{now_bjt()}] ⏭️ 跳过已取消的任务: {job_id}")
-                active_jobs.pop(job_id, None)
-                task_queue.task_done()
-                continue
-            
-            # 标记开始执行
-            active_jobs[job_id]["status"] = "generating"
-            active_jobs[job_id]["started_ts"] = time.time()
-            
-            print(f"[{now_bjt()}] 🚀 开始执行任务: {job_id} (优先级: {priority})")
-            
-            try:
-                await execute_generation(job)
-            except Exception as e:
-                print(f"[{now_bjt()}] ❌ 任务执行失败: {job_id}, {e}")
-                traceback.print_exc()
-                if job_id in active_jobs:
-                    active_jobs[job_id]["status"] = "error"
-                    active_jobs[job_id]["error"] = str(e)
-            finally:
-                task_queue.task_done()
+            # 先取任务再占全局名额，避免空闲后端的 worker 占着名额不放
+            async with global_slots:
+                # 检查任务是否已被取消（等待名额期间可能已被取消）
+                if job_id not in active_jobs:
+                    print(f"[{now_bjt()}] ⏭️ 跳过已取消的任务: {job_id}")
+                    task_queue.task_done()
+                    continue
+                
+                # 检查状态是否为 cancelled
+                if active_jobs[job_id].get("status") == "cancelled":
+                    print(f"[{now_bjt()}] ⏭️ 跳过已取消的任务: {job_id}")
+                    active_jobs.pop(job_id, None)
+                    task_queue.task_done()
+                    continue
+                
+                # 标记开始执行
+                active_jobs[job_id]["status"] = "generating"
+                active_jobs[job_id]["started_ts"] = time.time()
+                if active_jobs[job_id].get("queued_ts"):  # 置顶后为 0
+                    QUEUE_WAIT.observe(active_jobs[job_id]["started_ts"] - active_jobs[job_id]["queued_ts"], backend=api_url)
+                publish_event("started", {"job_id": job_id, "started_ts": active_jobs[job_id]["started_ts"]})
+                if job_broker is None:
+                    job_store.update(job_id, status="generating", started_ts=active_jobs[job_id]["started_ts"])
+                else:
+                    # 领取时已经标记为 generating；不再写 status，以免覆盖其他进程随后写入的 cancelled
+                    job_store.update(job_id, started_ts=active_jobs[job_id]["started_ts"])
+                start_followers(job_id)
+                
+                print(f"[{now_bjt()}] 🚀 开始执行任务: {job_id} (优先级: {priority}, 后端: {api_url})")
+                
+                try:
+                    await execute_generation(job)
+                except Exception as e:
+                    print(f"[{now_bjt()}] ❌ 任务执行失败: {job_id}, {e}")
+                    traceback.print_exc()
+                    if job_id in active_jobs:
+                        active_jobs[job_id]["status"] = "error"
+                        active_jobs[job_id]["error"] = str(e)
+                        publish_event("failed", {"job_id": job_id, "error": str(e)})
+                        job_store.update(job_id, status="error", error=str(e))
+                        fail_followers(job_id, str(e))
+                finally:
+                    forget_inflight(job_id)
+                    task_queue.task_done()
                 
         except asyncio.CancelledError:
             break
@@ -244,6 +900,185 @@ async def queue_worker():
             traceback.print_exc()
 
 
+# ============ 相同请求合并 ============
+
+def coalesce_key(job: dict) -> Optional[tuple]:
+    """确定性任务（seed >= 0）的参数签名，随机 seed、不使用缓存或共享队列模式（主任务可能在其他进程执行）时返回 None"""
+    if job["seed"] < 0 or not job.get("use_cache", True) or job_broker is not None:
+        return None
+    return (
+        backend_key(job["api_url"]), job["prompt"], job["seed"], job["image_size"],
+        job["width"], job["height"], job["steps"], tuple(job["ref_images"] or ()), job.get("output_format"),
+    )
+
+
+def forget_inflight(job_id: str):
+    """主任务结束（完成 / 失败 / 取消）后不再接受合并"""
+    for key in [k for k, v in inflight_jobs.items() if v == job_id]:
+        del inflight_jobs[key]
+
+
+async def submit_job(job_id: str, job_data: dict, priority: int = 1, counter: Optional[int] = None):
+    """
+    提交任务：已有相同参数的确定性任务在排队 / 执行、且张数不少于本任务时，
+    挂到该任务上共享结果；否则加入后端队列
+    
+    Returns:
+        (队列位置, 合并到的主任务 job_id 或 None)
+    """
+    job = active_jobs[job_id]
+    key = coalesce_key(job_data)
+    leader_id = inflight_jobs.get(key) if key else None
+    leader = active_jobs.get(leader_id) if leader_id else None
+    if (leader is not None and leader.get("status") in ("pending", "generating")
+            and leader["count"] >= job_data["count"]):
+        await attach_follower(leader_id, job_id, job_data)
+        return queue_position(leader_id, leader), leader_id
+    
+    if counter is None:
+        counter = next_counter()
+    job.pop("leader", None)
+    job.update(status="pending", priority=priority, counter=counter, followers=[])
+    if job_broker is not None:
+        job["remote"] = True  # 由领取到它的进程执行（可能就是本进程），状态从 jobs 表同步
+    job_store.update(job_id, status="pending", priority=priority, counter=counter, job_data=job_data)
+    task_queue = get_backend_queue(job_data["api_url"])
+    task_queue.put_nowait(job_id, priority, counter, job_data)
+    if key:
+        inflight_jobs[key] = job_id
+    return task_queue.position(job_id), None
+
+
+def next_counter() -> int:
+    """入队顺序：单进程时为递增计数；共享队列时为微秒时间戳，不同进程提交的任务也按先后排序"""
+    global queue_counter
+    if job_broker is not None:
+        return time.time_ns() // 1000
+    counter = queue_counter
+    queue_counter += 1
+    return counter
+
+
+async def attach_follower(leader_id: str, job_id: str, job_data: dict):
+    """挂到主任务上，并补发主任务已经完成的图片"""
+    leader = active_jobs[leader_id]
+    follower = active_jobs[job_id]
+    follower.update(
+        leader=leader_id, job_data=job_data,
+        status=leader["status"], started_ts=leader.get("started_ts"),
+    )
+    leader.setdefault("followers", []).append(job_id)
+    done = [r for r in leader["results"] if r["index"] < follower["count"]]
+    print(f"[{now_bjt()}] 🔗 任务已合并: {job_id} -> {leader_id}（已完成 {len(done)} 张）")
+    for result in done:
+        await deliver_result(job_id, result)
+
+
+def detach_follower(job_id: str):
+    """合并的任务被取消：从主任务上摘下"""
+    follower = active_jobs.get(job_id)
+    leader = active_jobs.get(follower.get("leader")) if follower else None
+    if leader and job_id in leader.get("followers", ()):
+        leader["followers"].remove(job_id)
+
+
+def start_followers(leader_id: str):
+    """主任务开始执行，合并的任务同步为 generating"""
+    leader = active_jobs.get(leader_id, {})
+    for fid in leader.get("followers", ()):
+        follower = active_jobs.get(fid)
+        if follower is not None:
+            follower.update(status="generating", started_ts=leader.get("started_ts"))
+            publish_event("started", {"job_id": fid, "started_ts": follower["started_ts"]})
+            job_store.update(fid, status="generating", started_ts=follower["started_ts"])
+
+
+async def deliver_result(follower_id: str, result: dict):
+    """把主任务的一张结果复制给合并的任务（硬链接文件，并写入独立的画廊记录）"""
+    follower = active_jobs.get(follower_id)
+    idx = result["index"]
+    if follower is None or follower.get("status") == "cancelled" or idx >= follower["count"]:
+        return
+    source = OUTPUT_DIR / result["filename"]
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{ts}_{follower_id}_{idx}{source.suffix}"
+    try:
+        await image_encoder.run(link_or_copy, source, OUTPUT_DIR / filename)
+    except OSError as e:
+        print(f"[{now_bjt()}] ⚠️ 合并任务结果复制失败: {follower_id} 第 {idx+1} 张 ({e})")
+        return
+    await save_image_record(
+        job_id=follower_id, filename=filename, prompt=follower["prompt"], seed=result["seed"],
+        image_size=follower["image_size"], width=result["width"], height=result["height"],
+        steps=follower["steps"], api_url=follower["api_url"], status="completed",
+        info=result["info"], duration_sec=result["duration"],
+        batch_count=follower["count"], batch_total_sec=0, parallel=follower["parallel"],
+        ref_images=follower["ref_images"]
+    )
+    entry = {**result, "filename": filename, "url": f"/output/{filename}",
+             "urls": derivative_urls(filename), "coalesced": True}
+    follower["completed"] = follower.get("completed", 0) + 1
+    follower["results"].append(entry)
+    follower.setdefault("progress", {})[str(idx)] = {"stage": "completed", "updated_ts": time.time()}
+    publish_event("image", {"job_id": follower_id, "completed": follower["completed"], "result": entry})
+    if follower["completed"] >= follower["count"]:
+        await finish_follower(follower_id)
+
+
+async def fan_out_result(leader_id: str, result: dict):
+    """主任务完成一张后分发给所有合并的任务"""
+    for fid in list(active_jobs.get(leader_id, {}).get("followers", ())):
+        await deliver_result(fid, result)
+
+
+async def finish_follower(follower_id: str):
+    follower = active_jobs.get(follower_id)
+    if follower is None or follower.get("status") in ("completed", "cancelled", "error"):
+        return
+    detach_follower(follower_id)
+    batch_total = round(time.time() - (follower.get("started_ts") or follower["queued_ts"]), 1)
+    await update_batch_total(follower_id, batch_total)
+    follower.update(status="completed", batch_total=batch_total)
+    publish_event("finished", {"job_id": follower_id, "batch_total": batch_total})
+    job_store.update(follower_id, status="completed", batch_total=batch_total)
+
+
+def fail_followers(leader_id: str, error: str):
+    leader = active_jobs.get(leader_id, {})
+    followers, leader["followers"] = leader.get("followers", []), []
+    for fid in followers:
+        follower = active_jobs.get(fid)
+        if follower is not None and follower.get("status") not in ("completed", "cancelled"):
+            follower.update(status="error", error=error)
+            publish_event("failed", {"job_id": fid, "error": error})
+            job_store.update(fid, status="error", error=error)
+
+
+async def release_followers(leader_id: str):
+    """
+    主任务被取消：合并的任务改为独立执行（第一个接替主任务在队列中的位置，其余再合并到它上面），
+    已经收到的图片不再重复生成
+    """
+    forget_inflight(leader_id)
+    leader = active_jobs.get(leader_id, {})
+    followers, leader["followers"] = leader.get("followers", []), []
+    for fid in followers:
+        follower = active_jobs.get(fid)
+        if follower is None or follower.get("status") in ("completed", "cancelled", "error"):
+            continue
+        job_data = follower.pop("job_data")
+        job_data["skip_indices"] = sorted(r["index"] for r in follower["results"])
+        position, new_leader = await submit_job(
+            fid, job_data, priority=leader.get("priority", 1), counter=leader.get("counter"),
+        )
+        print(f"[{now_bjt()}] 🔓 合并任务改为独立执行: {fid}" + (f" -> {new_leader}" if new_leader else ""))
+        if new_leader is None:
+            follower["started_ts"] = None
+            publish_event("queued", job_summary(fid, follower))
+    if leader.get("api_url"):
+        publish_positions(backend_key(leader["api_url"]))
+
+
 async def execute_generation(job: dict):
     """执行单个生成任务"""
     job_id = job["job_id"]
@@ -257,62 +1092,140 @@ async def execute_generation(job: dict):
     count = job["count"]
     ref_images = job["ref_images"]
     parallel = job["parallel"]
+    skip = set(job.get("skip_indices", ()))  # 合并时已经拿到的图片
+    indices = [i for i in range(count) if i not in skip]
+    output_format = job.get("output_format", OUTPUT_FORMAT)
+    download_dir = OUTPUT_DIR if output_format == ORIGINAL_FORMAT else None
+    use_cache = seed >= 0 and job.get("use_cache", True) and result_cache.enabled
     
-    loop = asyncio.get_event_loop()
     batch_start = time.time()
+    # 每张图片从后端池中选择一个后端；同一后端的客户端在批次内共用，底层复用该后端的共享连接池
+    pool = backend_pools.get(api_url)
+    clients: Dict[str, AsyncHunyuanImageClient] = {}
+    image_backends: Dict[int, str] = {}  # 图片序号 -> 实际生成它的后端
+    image_timings: Dict[int, dict] = {}  # 图片序号 -> 成功那次尝试的分阶段耗时
+    image_attempts: Dict[int, int] = {}  # 图片序号 -> 尝试次数（含重试和对冲）
+    
+    # 参考图内容哈希：上传去重和结果缓存共用，每个批次只算一次
+    ref_hashes: Dict[str, str] = {}
+    for fname in ref_images or []:
+        if fname and (UPLOADS_DIR / fname).exists():
+            ref_hashes[fname] = upload_hash(fname) or await asyncio.to_thread(hash_file, UPLOADS_DIR / fname)
+    cache_keys: Dict[int, str] = {}
     
-    def do_generate_one(idx: int):
-        """同步生成单张"""
+    def record_progress(idx: int, progress: dict):
+        """记录上游排队位置 / ETA / 步数进度，并推送 progress 事件"""
+        job_state = active_jobs.get(job_id)
+        if job_state is None:
+            return
+        progress = {**progress, "updated_ts": time.time()}
+        for jid in (job_id, *job_state.get("followers", ())):
+            state = active_jobs.get(jid)
+            if state is not None and idx < state["count"]:
+                state.setdefault("progress", {})[str(idx)] = progress
+                publish_event("progress", {"job_id": jid, "index": idx, **progress})
+    
+    async def run_one(idx: int):
+        """生成单张（Task 被 cancel 时 SSE 连接会立即关闭）"""
         t0 = time.time()
-        client = HunyuanImageClient(api_url)
+        cur_seed = seed + idx if seed >= 0 else seed
         
-        gradio_images = None
-        if ref_images:
-            gradio_images = []
-            for fname in ref_images:
-                if not fname:
-                    continue
-                lp = UPLOADS_DIR / fname
-                if lp.exists():
-                    gradio_images.append(client.upload_file(str(lp)))
+        if use_cache:
+            key = cache_keys[idx] = result_key(
+                backend_key(api_url), prompt, list(ref_hashes.values()), cur_seed, image_size, width, height, steps
+            )
+            cached = result_cache.lookup(key)
+            if cached is not None:
+                image_timings[idx] = {}
+                image_attempts[idx] = 0
+                return idx, cached, cached.info, round(time.time() - t0, 1), cur_seed
         
-        cur_seed = seed + idx if seed >= 0 else seed
+        tried = set()  # 本张已经试过的后端，重试 / 对冲时优先换一个
         
-        image, info = client.generate(
-            prompt=prompt, images=gradio_images, seed=cur_seed,
-            image_size=image_size, width=width, height=height,
-            diff_infer_steps=steps,
-        )
+        async def attempt():
+            backend = pool.acquire(avoid=tried)
+            tried.add(backend.url)
+            image_attempts[idx] = image_attempts.get(idx, 0) + 1
+            timings = {}
+            timer = PhaseTimer(timings)
+            client = clients.get(backend.url)
+            if client is None:
+                client = clients[backend.url] = AsyncHunyuanImageClient(backend.url)
+            t1 = time.time()
+            ok = None
+            gradio_images = None
+            try:
+                if ref_images:
+                    gradio_images = []
+                    for fname in ref_images:
+                        if fname in ref_hashes:
+                            # 同一参考图对同一后端只上传一次，批次内各张共用远端引用
+                            gradio_images.append(await client.upload_file(str(UPLOADS_DIR / fname), content_hash=ref_hashes[fname]))
+                    timer.lap("upload")
+                
+                result = await client.generate(
+                    prompt=prompt, images=gradio_images, seed=cur_seed,
+                    image_size=image_size, width=width, height=height,
+                    diff_infer_steps=steps,
+                    on_progress=lambda progress: record_progress(idx, progress),
+                    download_dir=download_dir,
+                    timings=timings,
+                )
+                ok = True
+                GENERATION.observe(time.time() - t1, backend=backend.url)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                BACKEND_ERRORS.inc(backend=backend.url, phase=getattr(e, "phase", None) or "other")
+                # 不可重试的错误（参数错误、上游报告生成失败）说明后端本身是正常的，不计入熔断
+                ok = isinstance(e, BackendError) and not e.retryable
+                # 远端文件可能已被 Gradio 清理，下次重新上传参考图
+                if gradio_images:
+                    file_ref_cache.invalidate(backend.url)
+                raise
+            finally:
+                pool.release(backend, ok, time.time() - t1)
+            image_backends[idx] = backend.url
+            image_timings[idx] = timings
+            return result
+        
+        image, info = await retry_policy.run(attempt, hedge=pool.size > 1, label=f"{job_id} 第 {idx+1} 张 ",
+                                             discard=lambda result: discard_result(result[0]))
         duration = round(time.time() - t0, 1)
         return idx, image, info, duration, cur_seed
     
-    async def run_one(idx: int):
-        """执行单张生成，支持取消检查"""
-        future = loop.run_in_executor(None, do_generate_one, idx)
-        
-        # 周期性检查是否被取消
-        while True:
-            # 每 2 秒检查一次取消状态
-            done, pending = await asyncio.wait({future}, timeout=2.0)
-            
-            if done:
-                # 任务完成
-                return future.result()
-            
-            # 检查是否被取消
-            if job_id not in active_jobs or active_jobs.get(job_id, {}).get("status") == "cancelled":
-                # 任务已取消，尝试取消 future（虽然可能不会立即停止线程中的操作）
-                future.cancel()
-                raise asyncio.CancelledError(f"任务 {job_id} 已取消")
+    running = job_tasks.setdefault(job_id, set())
+    
+    def spawn(idx: int) -> asyncio.Task:
+        """创建单张生成 Task 并登记，便于取消接口直接 cancel"""
+        task = asyncio.ensure_future(run_one(idx))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        return task
     
     async def save_result(idx, image, info, duration, cur_seed):
         """保存结果"""
         if image:
+            save_start = time.time()
+            timings = image_timings.get(idx, {})
+            timer = PhaseTimer(timings)
             ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{ts}_{job_id}_{idx}.png"
-            image.save(OUTPUT_DIR / filename, format="PNG")
-            
+            stem = f"{ts}_{job_id}_{idx}"
             info_str = str(info) if info else ""
+            cached = isinstance(image, CachedResult)
+            if cached:
+                filename = await result_cache.materialize(image, OUTPUT_DIR, stem, output_format)
+                print(f"[{now_bjt()}] ♻️ 命中结果缓存: 第 {idx+1}/{count} 张")
+            else:
+                filename = await image_encoder.save(image, OUTPUT_DIR, stem, output_format)
+                if idx in cache_keys:
+                    try:
+                        await result_cache.store(cache_keys[idx], OUTPUT_DIR / filename, image.size, info_str)
+                    except OSError as e:
+                        print(f"[{now_bjt()}] ⚠️ 结果缓存写入失败: {e}")
+            
+            timer.lap("encode")
+            IMAGES.inc(outcome="cached" if cached else "success")
             
             # 从实际图片获取尺寸
             actual_width, actual_height = image.size
@@ -320,22 +1233,37 @@ async def execute_generation(job: dict):
             await save_image_record(
                 job_id=job_id, filename=filename, prompt=prompt, seed=cur_seed,
                 image_size=image_size, width=actual_width, height=actual_height,
-                steps=steps, api_url=api_url, status="completed",
+                steps=steps, api_url=image_backends.get(idx, api_url), status="completed",
                 info=info_str, duration_sec=duration,
                 batch_count=count, batch_total_sec=0, parallel=parallel,
-                ref_images=ref_images
+                ref_images=ref_images, timings=timings, attempts=image_attempts.get(idx, 1),
             )
             
             # 更新任务进度
             if job_id in active_jobs:
-                active_jobs[job_id]["completed"] = active_jobs[job_id].get("completed", 0) + 1
-                active_jobs[job_id]["results"].append({
+                result = {
+                    "index": idx,
                     "filename": filename,
                     "url": f"/output/{filename}",
+                    "urls": derivative_urls(filename),
                     "duration": duration,
+                    "save_sec": round(time.time() - save_start, 3),  # 编码落盘 + 写记录
+                    "timings": timings,
                     "seed": cur_seed,
                     "info": info_str,
+                    "cached": cached,
+                    "width": actual_width,
+                    "height": actual_height,
+                }
+                active_jobs[job_id]["completed"] = active_jobs[job_id].get("completed", 0) + 1
+                active_jobs[job_id]["results"].append(result)
+                active_jobs[job_id].setdefault("progress", {})[str(idx)] = {"stage": "completed", "updated_ts": time.time()}
+                publish_event("image", {
+                    "job_id": job_id,
+                    "completed": active_jobs[job_id]["completed"],
+                    "result": result,
                 })
+                await fan_out_result(job_id, result)
             
             print(f"[{now_bjt()}] ✅ 完成第 {idx+1}/{count} 张: {filename}")
             return True
@@ -343,53 +1271,90 @@ async def execute_generation(job: dict):
             print(f"[{now_bjt()}] ❌ 第 {idx+1} 张未返回图像")
             return False
     
+    def discard_result(image):
+        """丢弃不再保存的结果（直存模式下删除已下载的临时文件）"""
+        if isinstance(image, DownloadedImage):
+            image.discard()
+    
     def is_cancelled():
         """检查任务是否已被取消"""
         return job_id not in active_jobs or active_jobs.get(job_id, {}).get("status") == "cancelled"
     
+    def outer_cancelled() -> bool:
+        """execute_generation 自身被取消（服务关闭），而不是用户取消了任务"""
+        current = asyncio.current_task()
+        return current is not None and current.cancelling() > 0
+    
     # 执行生成
-    if parallel and count > 1:
-        # 并发模式
-        tasks = [asyncio.ensure_future(run_one(i)) for i in range(count)]
-        for coro in asyncio.as_completed(tasks):
-            # 检查是否已取消
-            if is_cancelled():
-                print(f"[{now_bjt()}] ⏹️ 任务已取消，停止处理: {job_id}")
-                # 取消剩余的 task
-                for t in tasks:
-                    if not t.done():
+    try:
+        if parallel and len(indices) > 1:
+            # 并发模式
+            tasks = [spawn(i) for i in indices]
+            for coro in asyncio.as_completed(tasks):
+                try:
+                    idx, image, info, duration, cur_seed = await coro
+                except asyncio.CancelledError:
+                    if outer_cancelled():
+                        raise
+                    IMAGES.inc(outcome="cancelled")
+                    continue  # task 被取消，跳过
+                except Exception as e:
+                    IMAGES.inc(outcome="error")
+                    print(f"[{now_bjt()}] ❌ 生成失败: {e}")
+                    traceback.print_exc()
+                    continue
+                # 检查是否已取消
+                if is_cancelled():
+                    discard_result(image)
+                    print(f"[{now_bjt()}] ⏹️ 任务已取消，停止处理: {job_id}")
+                    # 其余的 task 可能已经完成（还没从 as_completed 读出）或在取消生效前完成：
+                    # 等它们全部结束，丢弃拿到的结果（直存模式下删除 output 中的 .part 临时文件）
+                    for t in tasks:
                         t.cancel()
-                return
-            try:
-                idx, image, info, duration, cur_seed = await coro
-                await save_result(idx, image, info, duration, cur_seed)
-            except asyncio.CancelledError:
-                pass  # task 被取消，跳过
-            except Exception as e:
-                print(f"[{now_bjt()}] ❌ 生成失败: {e}")
-                traceback.print_exc()
-    else:
-        # 顺序模式
-        for i in range(count):
-            # 检查是否已取消
-            if is_cancelled():
-                print(f"[{now_bjt()}] ⏹️ 任务已取消，停止处理: {job_id}")
-                return
-            try:
-                idx, image, info, duration, cur_seed = await run_one(i)
-                await save_result(idx, image, info, duration, cur_seed)
-            except asyncio.CancelledError:
-                print(f"[{now_bjt()}] ⏹️ 任务已取消，停止处理: {job_id}")
-                return
-            except Exception as e:
-                print(f"[{now_bjt()}] ❌ 第 {i+1} 张生成失败: {e}")
-                traceback.print_exc()
+                    for result in await asyncio.gather(*tasks, return_exceptions=True):
+                        if isinstance(result, tuple):
+                            discard_result(result[1])
+                    break
+                try:
+                    await save_result(idx, image, info, duration, cur_seed)
+                except Exception as e:
+                    # 单张保存失败（编码 / 落盘 / 写库）不影响同批次的其他图片
+                    discard_result(image)
+                    IMAGES.inc(outcome="error")
+                    print(f"[{now_bjt()}] ❌ 第 {idx+1} 张保存失败: {e}")
+                    traceback.print_exc()
+        else:
+            # 顺序模式
+            for i in indices:
+                # 检查是否已取消
+                if is_cancelled():
+                    print(f"[{now_bjt()}] ⏹️ 任务已取消，停止处理: {job_id}")
+                    break
+                try:
+                    idx, image, info, duration, cur_seed = await spawn(i)
+                    await save_result(idx, image, info, duration, cur_seed)
+                except asyncio.CancelledError:
+                    if outer_cancelled():
+                        raise
+                    IMAGES.inc(outcome="cancelled")
+                    print(f"[{now_bjt()}] ⏹️ 任务已取消，停止处理: {job_id}")
+                    break
+                except Exception as e:
+                    IMAGES.inc(outcome="error")
+                    print(f"[{now_bjt()}] ❌ 第 {i+1} 张生成失败: {e}")
+                    traceback.print_exc()
+    finally:
+        # 取消剩余的 task（用户取消或服务关闭）
+        for t in list(running):
+            t.cancel()
+        job_tasks.pop(job_id, None)
     
     # 批次结束
     batch_total = round(time.time() - batch_start, 1)
     
     # 如果任务已被取消，清理并退出
     if job_id not in active_jobs or active_jobs.get(job_id, {}).get("status") == "cancelled":
+        await release_followers(job_id)
         active_jobs.pop(job_id, None)
         print(f"[{now_bjt()}] 🗑️ 已清理取消的任务: {job_id}")
         return
@@ -398,12 +1363,164 @@ async def execute_generation(job: dict):
     
     active_jobs[job_id]["status"] = "completed"
     active_jobs[job_id]["batch_total"] = batch_total
+    publish_event("finished", {"job_id": job_id, "batch_total": batch_total})
+    job_store.update(job_id, status="completed", batch_total=batch_total)
+    forget_inflight(job_id)
+    # 合并的任务里个别图片失败时，随主任务一起结束
+    for fid in list(active_jobs[job_id].get("followers", ())):
+        await finish_follower(fid)
     
     print(f"[{now_bjt()}] 🎉 任务完成: {job_id}, 耗时 {batch_total}s")
 
 
 # ============ 启动 ============
 
+async def restore_job(row: dict, results: List[dict]) -> Optional[dict]:
+    """
+    按 jobs 行和已经写入画廊的图片在 active_jobs 中重建任务，返回待执行的 job_data（skip_indices 为已完成的图片）；
+    全部图片都已生成、只差收尾的任务直接补上 batch_total_sec 并标记完成，返回 None
+    """
+    job_id, job_data = row["job_id"], row["job_data"]
+    completed = {r["index"] for r in results}
+    info = {
+        **row["info"],
+        "status": "pending", "started_ts": None, "error": None,
+        "priority": row["priority"], "counter": row["counter"],
+        "completed": len(completed), "results": results,
+    }
+    if len(completed) >= job_data["count"]:
+        # 最后一张已保存，进程在回填批次耗时之前退出；批次耗时按最后一次状态更新估算
+        end = row["updated_ts"] or time.time()
+        batch_total = round(end - (row["started_ts"] or row["queued_ts"] or end), 1)
+        await update_batch_total(job_id, batch_total)
+        active_jobs[job_id] = {**info, "status": "completed", "batch_total": batch_total}
+        job_store.update(job_id, status="completed", batch_total=batch_total)
+        publish_event("finished", {"job_id": job_id, "batch_total": batch_total})
+        return None
+    active_jobs[job_id] = info
+    return {**job_data, "skip_indices": sorted(completed)}
+
+
+async def recover_jobs():
+    """
+    恢复上次进程退出时未完成的任务（pending / generating）：按原优先级和入队顺序重新排队
+    
+    共享队列模式下排队中和租约过期的任务由各进程直接领取，这里只处理单进程模式留下的任务
+    """
+    global queue_counter
+    jobs = await job_store.load_active(unqueued_only=job_broker is not None)
+    queue_counter = max(queue_counter, await job_store.max_counter() + 1)
+    if not jobs:
+        return
+    done = await get_job_results([job["job_id"] for job in jobs])
+    resumed = finished = 0
+    for row in jobs:
+        job_data = await restore_job(row, done.get(row["job_id"], []))
+        if job_data is None:
+            finished += 1
+            continue
+        await submit_job(row["job_id"], job_data, priority=row["priority"], counter=row["counter"])
+        resumed += 1
+    print(f"♻️ 已恢复上次未完成的任务: 重新排队 {resumed} 个，补全 {finished} 个")
+
+
+async def adopt_job(job_id: str) -> Optional[dict]:
+    """
+    共享队列领取到任务后在本进程重建状态，返回待执行的 job_data；
+    已无需执行（领取后被取消、被其他进程接手或已完成）时返回 None
+    """
+    row = await job_broker.owned(job_id)
+    if row is None:
+        print(f"[{now_bjt()}] ⏭️ 任务已不归本进程执行，跳过: {job_id}")
+        return None
+    results = (await get_job_results([job_id])).get(job_id, [])
+    return await restore_job(row, results)
+
+
+# ============ 多进程状态同步 ============
+
+def remote_job_info(row: dict) -> dict:
+    """其他进程执行的任务在本进程的状态副本"""
+    return {
+        **row["info"],
+        "remote": True,
+        "status": row["status"], "started_ts": row["started_ts"], "error": row["error"],
+        "priority": row["priority"], "counter": row["counter"],
+        "completed": 0, "results": [],
+    }
+
+
+def drop_remote_job(job_id: str):
+    if active_jobs.get(job_id, {}).get("remote"):
+        active_jobs.pop(job_id, None)
+
+
+async def deliver_remote_results(job_ids: List[str]):
+    """把其他进程新保存的图片推送给本进程的订阅者"""
+    for job_id, results in (await get_job_results(job_ids)).items():
+        info = active_jobs.get(job_id)
+        if info is None:
+            continue
+        for result in results[len(info["results"]):]:
+            info["results"].append(result)
+            info["completed"] = len(info["results"])
+            publish_event("image", {"job_id": job_id, "completed": info["completed"], "result": result}, relayed=True)
+
+
+async def sync_remote_jobs(rows: List[dict]):
+    """
+    共享队列同步回调（幂等，同一行可能被多次传入）：
+    - 本进程执行的任务被其他进程取消时停止生成
+    - 其他进程提交或执行的任务在本进程保留状态副本，并把状态变化转发给本进程的 /api/events 订阅者
+    """
+    # 其他进程提交到本进程还没有队列的后端
+    for key in job_broker.keys - set(backend_queues):
+        get_backend_queue(key)
+    finished = []
+    for row in rows:
+        job_id, status = row["job_id"], row["status"]
+        info = active_jobs.get(job_id)
+        if row["owner"] == job_broker.worker_id:
+            if status == "cancelled" and info is not None and info.get("status") != "cancelled":
+                cancel_running(job_id)
+                print(f"[{now_bjt()}] ❌ 生成任务已被其他进程取消: {job_id}")
+            continue
+        if info is None:
+            if status not in ACTIVE_STATUSES:
+                continue
+            info = active_jobs[job_id] = remote_job_info(row)
+            publish_event("queued", job_summary(job_id, info), relayed=True)
+            if status == "generating":
+                publish_event("started", {"job_id": job_id, "started_ts": info["started_ts"]}, relayed=True)
+            continue
+        if not info.get("remote") or info["status"] == status:
+            continue
+        info.update(status=status, started_ts=row["started_ts"], error=row["error"], priority=row["priority"])
+        if status == "pending":
+            # 执行它的进程退出后交还队列
+            publish_event("queued", job_summary(job_id, info), relayed=True)
+        elif status == "generating":
+            publish_event("started", {"job_id": job_id, "started_ts": info["started_ts"]}, relayed=True)
+        elif status == "cancelled":
+            active_jobs.pop(job_id, None)
+            publish_event("cancelled", {"job_id": job_id}, relayed=True)
+        else:
+            finished.append(row)
+    generating = [jid for jid, info in active_jobs.items() if info.get("remote") and info["status"] == "generating"]
+    await deliver_remote_results(generating + [row["job_id"] for row in finished])
+    loop = asyncio.get_running_loop()
+    for row in finished:
+        job_id = row["job_id"]
+        if row["status"] == "completed":
+            active_jobs[job_id]["batch_total"] = row["batch_total"]
+            publish_event("finished", {"job_id": job_id, "batch_total": row["batch_total"]}, relayed=True)
+        else:
+            publish_event("failed", {"job_id": job_id, "error": row["error"]}, relayed=True)
+        loop.call_later(REMOTE_JOB_TTL, drop_remote_job, job_id)
+    if rows:
+        for key in list(backend_queues):
+            publish_positions(key)
+
 
 
 # ============ 页面 ============
@@ -417,54 +1534,246 @@ async def index():
 # ============ API ============
 
 @app.get("/api/history")
-async def api_history():
-    history = await get_history()
-    return JSONResponse({"success": True, "data": history})
+async def api_history(limit: int = 100, cursor: Optional[str] = None,
+                      since: Optional[int] = None, fields: Optional[str] = None):
+    """
+    画廊记录
+    
+    - 分页：按 sort_order 排序，传入上一页返回的 next_cursor 获取下一页
+    - 增量同步：传入 since=<revision>，只返回该 revision 之后新增 / 修改 / 排序变化的行和被删除的 id
+    - 列投影：fields=list 不返回 info 等大字段，也可以传逗号分隔的列名
+    """
+    limit = min(max(limit, 1), HISTORY_PAGE_MAX)
+    if since is not None:
+        rows, deleted, revision, has_more = await get_history_changes(since, limit, fields)
+        return JSONResponse({
+            "success": True, "data": rows, "deleted": deleted,
+            "revision": revision, "has_more": has_more,
+        })
+    try:
+        revision = await get_current_revision()
+        history, next_cursor = await get_history(limit, cursor, fields)
+    except ValueError:
+        return JSONResponse({"success": False, "error": "无效的 cursor"}, status_code=400)
+    return JSONResponse({"success": True, "data": history, "next_cursor": next_cursor, "revision": revision})
+
+
+@app.get("/derived/{size}/{filename}")
+async def derived_image(size: str, filename: str, request: Request):
+    """
+    画廊图片的派生尺寸：thumb / preview 首次访问时生成并缓存，full 为原图
+    
+    带强 ETag，浏览器重新验证时返回 304。
+    """
+    if size != FULL_SIZE and size not in DERIVATIVE_SIZES:
+        return JSONResponse({"success": False, "error": "不支持的尺寸"}, status_code=404)
+    try:
+        found = await derivative_cache.get(filename, size)
+    except OSError as e:
+        print(f"[{now_bjt()}] ❌ 缩略图生成失败: {filename} ({e})")
+        found = None
+    if found is None:
+        return JSONResponse({"success": False, "error": "图片不存在"}, status_code=404)
+    path, etag = found
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={DERIVATIVE_MAX_AGE}"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    media_type = None if size == FULL_SIZE else DERIVATIVE_MEDIA_TYPE
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+@app.get("/api/events")
+async def api_events():
+    """
+    任务事件流（SSE）
+    
+    连接后先推送 snapshot（当前全部任务），之后推送 queued / positions / started / image /
+    finished / cancelled / failed 事件。空闲时只有定期的 keepalive 注释。
+    """
+    subscriber: asyncio.Queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+    # 先订阅再生成快照，两者之间没有 await，不会漏事件
+    event_subscribers.add(subscriber)
+    snapshot = format_sse("snapshot", {"jobs": [job_summary(jid, info) for jid, info in active_jobs.items()]})
+    
+    async def stream():
+        try:
+            yield snapshot
+            while True:
+                try:
+                    payload = await asyncio.wait_for(subscriber.get(), timeout=EVENT_KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if payload is None:
+                    break
+                yield payload
+        finally:
+            event_subscribers.discard(subscriber)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/api/backends")
+async def api_backends():
+    """各后端池的状态：在途请求、健康状态、摘除情况、延迟"""
+    return JSONResponse({"success": True, "data": [pool.snapshot() for pool in backend_pools.pools()]})
+
+
+@app.post("/api/backends")
+async def api_register_backends(request: Request):
+    """注册 / 更新命名后端池：{"name": "...", "backends": [{"url": "...", "weight": 1}, ...]}"""
+    data = await request.json()
+    name = (data.get("name") or "").strip()
+    backends = [b for b in data.get("backends", []) if b.get("url")]
+    if not name or not backends:
+        return JSONResponse({"success": False, "error": "缺少 name 或 backends"}, status_code=400)
+    for pool in backend_pools.pools():
+        if pool.key == name:
+            await pool.stop_probing()
+    pool = backend_pools.register(name, backends)
+    pool.start_probing()
+    print(f"[{now_bjt()}] 🧭 后端池已注册: {name} ({len(backends)} 个后端)")
+    return JSONResponse({"success": True, "data": pool.snapshot()})
+
+
+async def publish_metrics():
+    """把本进程的指标快照写入数据库，并清理已退出进程的快照"""
+    now = time.time()
+    async with db_pool.write() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO metric_snapshots (worker, updated_ts, body) VALUES (?, ?, ?)",
+            (WORKER_ID, now, REGISTRY.snapshot(WORKER_ID)),
+        )
+        await db.execute("DELETE FROM metric_snapshots WHERE updated_ts < ?", (now - METRICS_STALE_SEC,))
+
+
+async def publish_metrics_loop():
+    while True:
+        await asyncio.sleep(METRICS_PUBLISH_SEC)
+        try:
+            await publish_metrics()
+        except Exception as e:
+            print(f"⚠️ 指标快照写入失败: {e}")
+
+
+@app.get("/metrics")
+async def api_metrics():
+    """
+    Prometheus 文本格式指标
+    
+    共享队列模式下合并所有进程的快照，样本带 worker 标签（计数器按 worker 求和；
+    队列深度等状态量各进程看到的是同一个共享队列，取 max 即可）
+    """
+    if job_broker is None:
+        return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+    await publish_metrics()
+    async with db_pool.read() as db:
+        rows = await (await db.execute(
+            "SELECT body FROM metric_snapshots WHERE updated_ts >= ? ORDER BY worker",
+            (time.time() - METRICS_STALE_SEC,),
+        )).fetchall()
+    return Response(merge_snapshots(row[0] for row in rows), media_type=CONTENT_TYPE)
+
+
+@app.get("/api/cache")
+async def api_cache_stats():
+    """结果缓存 / 缩略图缓存 / 远端文件引用缓存的统计"""
+    return JSONResponse({
+        "success": True,
+        "result": result_cache.stats(),
+        "derivatives": derivative_cache.stats(),
+        "file_refs": {"hits": file_ref_cache.hits, "misses": file_ref_cache.misses},
+    })
 
 
 @app.get("/api/jobs")
 async def api_jobs():
     """获取当前进行中的任务列表（不含已完成的）"""
     jobs = [
-        {
-            "job_id": jid,
-            "prompt": info.get("prompt", ""),
-            "count": info.get("count", 1),
-            "completed": info.get("completed", 0),
-            "status": info.get("status", "pending"),
-            "queued_ts": info.get("queued_ts"),
-            "started_ts": info.get("started_ts"),  # None 表示还在排队
-            "parallel": info.get("parallel", True),
-            "results": info.get("results", []),
-            "batch_total": info.get("batch_total"),
-            "error": info.get("error"),
-            "ratio": info.get("ratio", "auto"),
-            "actual_width": info.get("actual_width"),
-            "actual_height": info.get("actual_height"),
-            "ref_images": info.get("ref_images", []),
-        }
+        job_summary(jid, info)
         for jid, info in active_jobs.items()
         if info.get("status") not in ("completed", "error")  # 只返回进行中的
     ]
-    return JSONResponse({"success": True, "data": jobs, "queue_size": task_queue.qsize()})
+    return JSONResponse({"success": True, "data": jobs, "queue_size": pending_count()})
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def _write_chunk(f, digest, chunk: bytes):
+    digest.update(chunk)
+    f.write(chunk)
+
+
+async def ingest_upload(file: UploadFile, directory: Path) -> tuple:
+    """
+    把上传内容分块写入 directory 下的临时文件，同时计算内容哈希
+    
+    写盘和哈希都在线程中完成；超过 UPLOAD_MAX_BYTES 时删除临时文件并抛出 UploadTooLarge。
+    
+    Returns:
+        (临时文件路径, 内容哈希, 字节数)，由调用方重命名或删除临时文件
+    """
+    tmp = directory / f".{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    size = 0
+    f = await asyncio.to_thread(open, tmp, "wb")
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                raise UploadTooLarge()
+            await asyncio.to_thread(_write_chunk, f, digest, chunk)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        tmp.unlink(missing_ok=True)
+        raise
+    await asyncio.to_thread(f.close)
+    return tmp, digest.hexdigest()[:CONTENT_HASH_LEN], size
+
+
+def upload_too_large() -> JSONResponse:
+    return JSONResponse(
+        {"success": False, "error": f"文件过大（上限 {UPLOAD_MAX_BYTES // (1024 * 1024)} MB）"},
+        status_code=413,
+    )
+
+
+def upload_hash(filename: str) -> Optional[str]:
+    """按内容哈希命名的上传文件直接从文件名取哈希，旧文件返回 None（由客户端读取文件计算）"""
+    stem = Path(filename).stem
+    if len(stem) == CONTENT_HASH_LEN and all(c in "0123456789abcdef" for c in stem):
+        return stem
+    return None
 
 
 @app.post("/api/upload")
 async def api_upload(file: UploadFile = File(...)):
-    ext = Path(file.filename).suffix or '.png'
-    local_name = f"{uuid.uuid4().hex[:8]}{ext}"
+    """上传参考图（按内容哈希命名，相同文件只存一份）"""
+    ext = (Path(file.filename).suffix or '.png').lower()
+    try:
+        tmp, content_hash, size = await ingest_upload(file, UPLOADS_DIR)
+    except UploadTooLarge:
+        return upload_too_large()
+    local_name = f"{content_hash}{ext}"
     local_path = UPLOADS_DIR / local_name
-    content = await file.read()
-    with open(local_path, 'wb') as f:
-        f.write(content)
-    print(f"📤 图片已保存: {local_name} ({len(content)} bytes)")
-    return JSONResponse({"success": True, "filename": local_name, "url": f"/uploads/{local_name}", "size": len(content)})
+    if local_path.exists():
+        tmp.unlink(missing_ok=True)
+        print(f"📤 图片已存在: {local_name} ({size} bytes)")
+    else:
+        os.replace(tmp, local_path)
+        print(f"📤 图片已保存: {local_name} ({size} bytes)")
+    return JSONResponse({
+        "success": True, "filename": local_name, "url": f"/uploads/{local_name}",
+        "size": size, "hash": content_hash,
+    })
 
 
 @app.post("/api/generate")
 async def api_generate(request: Request):
     """提交生成任务到队列"""
-    global queue_counter
     data = await request.json()
 
     api_url = data.get("api_url", "").strip()
@@ -480,6 +1789,7 @@ async def api_generate(request: Request):
     count = int(data.get("count", 1))
     ref_images: List[str] = data.get("ref_images", [])
     parallel = data.get("parallel", True)
+    output_format = resolve_format(data.get("output_format"), resolve_format(OUTPUT_FORMAT))
 
     if not api_url:
         return JSONResponse({"success": False, "error": "请输入 API 地址"}, status_code=400)
@@ -489,13 +1799,6 @@ async def api_generate(request: Request):
     count = min(max(count, 1), 4)
     job_id = str(uuid.uuid4())[:8]
     queued_ts = time.time()
-    
-    # 计算队列位置
-    queue_position = task_queue.qsize() + 1
-    
-    # 获取当前计数器值并递增
-    current_counter = queue_counter
-    queue_counter += 1
 
     # 注册任务（pending 状态，started_ts 为 None）
     active_jobs[job_id] = {
@@ -508,9 +1811,8 @@ async def api_generate(request: Request):
         "started_ts": None,  # 开始执行时更新
         "completed": 0,
         "results": [],
-        "queue_position": queue_position,
         "priority": 1,  # 默认优先级为 1（普通任务）
-        "counter": current_counter,  # 记录入队顺序
+        "counter": None,  # 入队顺序，submit_job 时分配
         "api_url": api_url,
         "seed": seed,
         "image_size": image_size,
@@ -537,18 +1839,29 @@ async def api_generate(request: Request):
         "count": count,
         "ref_images": ref_images,
         "parallel": parallel,
+        "output_format": output_format,
+        "use_cache": bool(data.get("use_cache", True)),
     }
-    await task_queue.put((1, current_counter, job_data))  # 默认优先级 1
+    # 先落盘再入队：接口返回后即使进程退出，任务也会在下次启动时恢复
+    await job_store.add(job_id, active_jobs[job_id], job_data)
+    # 默认优先级 1；相同的确定性请求正在排队 / 执行时直接合并，不重复入队
+    position, leader_id = await submit_job(job_id, job_data)
     
     mode = "图生图" if ref_images else "文生图"
     mode_label = "并发" if parallel else "顺序"
-    print(f"[{now_bjt()}] 📥 任务入队: {job_id} ({mode}, {count}张, {mode_label}), 队列位置: {queue_position}")
+    if leader_id:
+        print(f"[{now_bjt()}] 📥 任务已合并: {job_id} ({mode}, {count}张) -> {leader_id}")
+    else:
+        print(f"[{now_bjt()}] 📥 任务入队: {job_id} ({mode}, {count}张, {mode_label}), 队列位置: {position}")
+    if job_id in active_jobs:
+        publish_event("queued", job_summary(job_id, active_jobs[job_id]))
 
     return JSONResponse({
         "success": True,
         "job_id": job_id,
-        "queue_position": queue_position,
-        "message": f"任务已加入队列，位置 #{queue_position}"
+        "queue_position": position,
+        "coalesced_with": leader_id,
+        "message": f"任务已加入队列，位置 #{position}" if position else "任务已合并到相同的进行中任务"
     })
 
 
@@ -573,6 +1886,9 @@ async def api_job_status(job_id: str):
             "batch_total": job.get("batch_total"),
             "results": job.get("results", []),
             "error": job.get("error"),
+            "queue_position": queue_position(job_id, job),
+            "progress": job.get("progress", {}),
+            "coalesced_with": job.get("leader"),
         }
     })
 
@@ -595,40 +1911,54 @@ async def api_cancel_job(job_id: str):
     if job.get("status") != "pending":
         return JSONResponse({"success": False, "error": "只能取消排队中的任务"}, status_code=400)
     
-    # 从队列中移除该任务
-    temp_queue = []
-    found = False
-    
-    while not task_queue.empty():
-        try:
-            priority, counter, job_data = task_queue.get_nowait()
-            if job_data["job_id"] != job_id:
-                temp_queue.append((priority, counter, job_data))
-            else:
-                found = True
-        except asyncio.QueueEmpty:
-            break
-    
-    # 重新放回队列
-    for item in temp_queue:
-        await task_queue.put(item)
+    if job.get("leader"):
+        # 合并的任务：只从主任务上摘下
+        detach_follower(job_id)
+    else:
+        # 从该后端的队列中移除该任务（按 job_id 索引删除），合并到它的任务改为独立排队
+        get_backend_queue(job["api_url"]).remove(job_id)
+        await release_followers(job_id)
     
     # 标记为已取消
     active_jobs[job_id]["status"] = "cancelled"
     active_jobs.pop(job_id, None)
+    publish_event("cancelled", {"job_id": job_id})
+    job_store.update(job_id, status="cancelled")
+    publish_positions(job["api_url"])
     print(f"[{now_bjt()}] ❌ 任务已取消: {job_id}")
     return JSONResponse({"success": True})
 
 
+def cancel_running(job_id: str):
+    """
+    取消本进程正在执行的任务：标记为已取消，worker 检测到后会跳过
+    注意：不立即删除，让 execute_generation 检测到取消后自行退出
+    """
+    active_jobs[job_id]["status"] = "cancelled"
+    # 直接取消正在进行的生成，SSE 连接随之关闭
+    for task in list(job_tasks.get(job_id, ())):
+        task.cancel()
+    publish_event("cancelled", {"job_id": job_id})
+
+
 @app.post("/api/job/{job_id}/cancel")
 async def api_cancel_generating(job_id: str):
     """取消正在生成的任务（标记为取消，让 worker 跳过）"""
     if job_id not in active_jobs:
         return JSONResponse({"success": False, "error": "任务不存在"}, status_code=404)
     
-    # 标记为已取消，worker 检测到后会跳过
-    # 注意：不立即删除，让 execute_generation 检测到取消后自行退出
-    active_jobs[job_id]["status"] = "cancelled"
+    if active_jobs[job_id].get("leader") or active_jobs[job_id].get("remote"):
+        # 合并的任务没有自己的生成，摘下即可，主任务继续为其他请求生成；
+        # 其他进程执行的任务记为 cancelled，执行它的进程同步时停止生成
+        detach_follower(job_id)
+        active_jobs.pop(job_id, None)
+        publish_event("cancelled", {"job_id": job_id})
+        job_store.update(job_id, status="cancelled")
+        print(f"[{now_bjt()}] ❌ 任务已取消: {job_id}")
+        return JSONResponse({"success": True})
+    
+    cancel_running(job_id)
+    job_store.update(job_id, status="cancelled")
     print(f"[{now_bjt()}] ❌ 生成任务已取消: {job_id}")
     return JSONResponse({"success": True})
 
@@ -643,95 +1973,209 @@ async def api_priority_job(job_id: str):
     if job.get("status") != "pending":
         return JSONResponse({"success": False, "error": "只能置顶排队中的任务"}, status_code=400)
     
-    # 从队列中取出所有任务，找到目标任务并提升优先级
-    temp_queue = []
-    found = False
-    
-    # 取出所有任务
-    while not task_queue.empty():
-        try:
-            priority, counter, job_data = task_queue.get_nowait()
-            if job_data["job_id"] == job_id:
-                # 找到目标任务，设置优先级为 0（最高）
-                temp_queue.append((0, counter, job_data))
-                found = True
-                print(f"[{now_bjt()}] ⬆️ 任务已置顶: {job_id}")
-            else:
-                temp_queue.append((priority, counter, job_data))
-        except asyncio.QueueEmpty:
-            break
-    
-    # 重新放回队列
-    for item in temp_queue:
-        await task_queue.put(item)
+    # 在该后端的队列中原地提升优先级为 0（最高），保留原入队顺序；合并的任务置顶其主任务
+    found = get_backend_queue(job["api_url"]).set_priority(job.get("leader") or job_id, 0)
     
     if found:
+        print(f"[{now_bjt()}] ⬆️ 任务已置顶: {job_id}")
+        publish_positions(job["api_url"])
         # 更新任务状态
         active_jobs[job_id]["priority"] = 0
         active_jobs[job_id]["queued_ts"] = 0  # 前端显示用
+        job_store.update(job.get("leader") or job_id, priority=0)
         return JSONResponse({"success": True, "message": "任务已置顶"})
     else:
         return JSONResponse({"success": False, "error": "任务未在队列中找到"}, status_code=404)
 
 
+def parse_image_id(value) -> Optional[int]:
+    """请求中的图片 id（整数或数字字符串），None 原样返回；格式不对时抛出 ValueError"""
+    if value is None:
+        return None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    raise ValueError(f"无效的图片 id: {value!r}")
+
+
+async def reorder_images(order: List[int]) -> int:
+    """
+    按 id 顺序数组批量设置 sort_order = 下标 * SORT_GAP
+    
+    order 可以只包含部分记录（分页时客户端只有已加载的几页）：未列出的记录保持原有相对顺序，排在列出的记录之后。
+    顺序写入临时表后用一条 UPDATE ... FROM 连接更新，只改动位置真正变化的行；
+    重新编号后相邻记录之间留有 SORT_GAP 的空位，之后的单行移动不需要再整体重新编号。
+    
+    Returns:
+        实际修改的行数
+    """
+    async with db_pool.write() as db:
+        await db.execute("CREATE TEMP TABLE IF NOT EXISTS reorder_tmp (id INTEGER PRIMARY KEY, pos INTEGER NOT NULL)")
+        await db.execute("DELETE FROM reorder_tmp")
+        await db.executemany(
+            "INSERT OR IGNORE INTO reorder_tmp (id, pos) VALUES (?, ?)",
+            ((int(image_id), idx) for idx, image_id in enumerate(order))
+        )
+        cursor = await db.execute("""
+            UPDATE images SET sort_order = ranked.pos * :gap
+            FROM (
+                SELECT images.id AS id, COALESCE(
+                    reorder_tmp.pos,
+                    :listed + ROW_NUMBER() OVER (
+                        PARTITION BY reorder_tmp.pos IS NULL ORDER BY images.sort_order, images.id
+                    ) - 1
+                ) AS pos
+                FROM images LEFT JOIN reorder_tmp ON reorder_tmp.id = images.id
+            ) AS ranked
+            WHERE images.id = ranked.id AND images.sort_order IS NOT ranked.pos * :gap
+        """, {"gap": SORT_GAP, "listed": len(order)})
+        changed = cursor.rowcount
+        await db.execute("DELETE FROM reorder_tmp")
+    return changed
+
+
+async def move_image(image_id: int, after_id: Optional[int], before_id: Optional[int]):
+    """
+    把一张图片移动到 after_id 和 before_id 之间（任一侧为 None 表示移到最前 / 最后）
+    
+    两侧 sort_order 之间有空位时只写一行；没有空位时先把全部记录按 SORT_GAP 间隔重新编号，
+    之后的移动又可以只写一行。
+    
+    Returns:
+        (新的 sort_order, 是否重新编号)，图片不存在时返回 (None, False)
+    
+    Raises:
+        ValueError: 两侧都未指定、after / before 不存在或是图片自身，或 after 不在 before 之前（在修改任何记录之前检查）
+    """
+    if after_id is None and before_id is None:
+        raise ValueError("after 和 before 至少指定一个")
+    if image_id in (after_id, before_id):
+        raise ValueError("不能以图片自身作为移动位置")
+    async with db_pool.write() as db:
+        async def order_of(target_id):
+            if target_id is None:
+                return None
+            row = await (await db.execute("SELECT sort_order, id FROM images WHERE id = ?", (target_id,))).fetchone()
+            return (row[0], row[1]) if row else None
+        
+        if await order_of(image_id) is None:
+            return None, False
+        lo, hi = await order_of(after_id), await order_of(before_id)
+        if after_id is not None and lo is None:
+            raise ValueError(f"after 图片不存在: {after_id}")
+        if before_id is not None and hi is None:
+            raise ValueError(f"before 图片不存在: {before_id}")
+        if lo is not None and hi is not None and lo >= hi:
+            # 排序按 (sort_order, id)，与重新编号时的 ROW_NUMBER 顺序一致
+            raise ValueError("after 必须排在 before 之前")
+        
+        def pick(lo, hi):
+            if lo is None and hi is None:
+                return None
+            if lo is None:
+                return hi[0] - SORT_GAP
+            if hi is None:
+                return lo[0] + SORT_GAP
+            if hi[0] - lo[0] > 1:
+                return (lo[0] + hi[0]) // 2
+            return None
+        
+        new_order = pick(lo, hi)
+        rebalanced = False
+        if new_order is None and lo is not None and hi is not None:
+            # 相邻两行之间没有空位：整体按间隔重新编号（摊还后很少发生）
+            await db.execute("""
+                UPDATE images SET sort_order = ranked.rn * ?
+                FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY sort_order, id) AS rn FROM images) AS ranked
+                WHERE images.id = ranked.id AND images.sort_order != ranked.rn * ?
+            """, (SORT_GAP, SORT_GAP))
+            rebalanced = True
+            lo, hi = await order_of(after_id), await order_of(before_id)
+            new_order = pick(lo, hi)
+        if new_order is None:
+            return None, rebalanced
+        await db.execute("UPDATE images SET sort_order = ? WHERE id = ?", (new_order, image_id))
+    return new_order, rebalanced
+
+
 @app.post("/api/reorder")
 async def api_reorder(request: Request):
-    """重新排序图片，接收完整的 id 顺序数组"""
+    """
+    重新排序图片
+    
+    - {"order": [id1, id2, ...]}：完整 id 顺序数组，只更新位置变化的行
+    - {"move": {"id": X, "after": A, "before": B}}：把 X 移到 A 和 B 之间（A / B 可为 null），通常只写一行
+    """
     data = await request.json()
+    move = data.get("move")
+    
+    if move:
+        if not isinstance(move, dict) or "id" not in move:
+            return JSONResponse({"success": False, "error": "move 缺少 id"}, status_code=400)
+        try:
+            image_id, after_id, before_id = (
+                parse_image_id(move["id"]), parse_image_id(move.get("after")), parse_image_id(move.get("before"))
+            )
+            if image_id is None:
+                raise ValueError("move 缺少 id")
+            new_order, rebalanced = await move_image(image_id, after_id, before_id)
+        except ValueError as e:
+            return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+        if new_order is None:
+            return JSONResponse({"success": False, "error": "图片不存在"}, status_code=404)
+        print(f"[{now_bjt()}] 🔄 图片已移动: {move['id']} -> {new_order}" + ("（已重新编号）" if rebalanced else ""))
+        return JSONResponse({"success": True, "sort_order": new_order, "rebalanced": rebalanced})
+    
     order = data.get("order", [])  # [id1, id2, id3, ...]
     
     if not order:
         return JSONResponse({"success": False, "error": "缺少 order 参数"}, status_code=400)
+    if not isinstance(order, list):
+        return JSONResponse({"success": False, "error": "order 必须是 id 数组"}, status_code=400)
+    try:
+        order = [parse_image_id(image_id) for image_id in order]
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+    if None in order:
+        return JSONResponse({"success": False, "error": "order 中不能有 null"}, status_code=400)
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 批量更新 sort_order
-        for idx, image_id in enumerate(order):
-            await db.execute(
-                "UPDATE images SET sort_order = ? WHERE id = ?",
-                (idx, image_id)
-            )
-        await db.commit()
+    changed = await reorder_images(order)
     
-    print(f"[{now_bjt()}] 🔄 画廊已重新排序，共 {len(order)} 张图片")
-    return JSONResponse({"success": True})
+    print(f"[{now_bjt()}] 🔄 画廊已重新排序，共 {len(order)} 张图片，{changed} 张位置变化")
+    return JSONResponse({"success": True, "changed": changed})
 
 
 @app.post("/api/import")
 async def api_import(file: UploadFile = File(...)):
     """导入外部图片到画廊"""
-    from PIL import Image
-    import io
-    
-    # 读取文件内容
-    content = await file.read()
+    # 分块写入临时文件
+    try:
+        tmp, _, _ = await ingest_upload(file, OUTPUT_DIR)
+    except UploadTooLarge:
+        return upload_too_large()
     
-    # 获取图片尺寸
+    # 获取图片尺寸（只读文件头，不解码）
     try:
-        img = Image.open(io.BytesIO(content))
-        width, height = img.size
+        (width, height), _ = await asyncio.to_thread(probe_image_file, tmp)
     except Exception:
+        tmp.unlink(missing_ok=True)
         return JSONResponse({"success": False, "error": "无法读取图片"}, status_code=400)
     
     # 保存到 output 目录
     ext = Path(file.filename).suffix.lower() or '.png'
-    if ext not in ('.png', '.jpg', '.jpeg', '.webp'):
+    if ext not in OUTPUT_EXTENSIONS:
         ext = '.png'
     
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"{ts}_import_{uuid.uuid4().hex[:6]}{ext}"
-    filepath = OUTPUT_DIR / filename
+    os.replace(tmp, OUTPUT_DIR / filename)
     
-    with open(filepath, 'wb') as f:
-        f.write(content)
-    
-    # 获取下一个 sort_order
-    sort_order = await get_next_sort_order()
-    
-    # 写入数据库
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    # 写入数据库（sort_order 在同一条 INSERT 中原子分配）
+    async with db_pool.write() as db:
+        cursor = await db.execute(f"""
             INSERT INTO images (job_id, filename, prompt, seed, image_size, width, height, steps, api_url, status, created_at, sort_order)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {NEXT_SORT_ORDER_SQL})
         """, (
             f"import_{uuid.uuid4().hex[:8]}",
             filename,
@@ -744,17 +2188,12 @@ async def api_import(file: UploadFile = File(...)):
             "",
             "imported",
             now_bjt(),
-            sort_order
         ))
-        last_id = (await db.execute("SELECT last_insert_rowid()")).fetchone()
-        await db.commit()
         
         # 获取插入的记录
-        cursor = await db.execute("SELECT * FROM images WHERE filename = ?", (filename,))
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT * FROM images WHERE filename = ?", (filename,))
+        cursor = await db.execute("SELECT * FROM images WHERE id = ?", (cursor.lastrowid,))
         row = await cursor.fetchone()
-        record = dict(row) if row else None
+        record = add_derivative_urls([dict(row)])[0] if row else None
     
     print(f"[{now_bjt()}] 📥 图片已导入: {filename} ({width}x{height})")
     
@@ -764,6 +2203,22 @@ async def api_import(file: UploadFile = File(...)):
     })
 
 
+@app.get("/api/images/{image_id}/timings")
+async def api_image_timings(image_id: int):
+    """单张图片的分阶段耗时"""
+    data = await get_image_timings(image_id)
+    if data is None:
+        return JSONResponse({"success": False, "error": "没有该图片的耗时记录"}, status_code=404)
+    return JSONResponse({"success": True, "data": data})
+
+
+@app.get("/api/timings")
+async def api_timings(limit: int = 500, api_url: Optional[str] = None):
+    """最近 limit 张图片按后端汇总的分阶段耗时（均值 / p50 / p95），用于判断该优化哪个阶段"""
+    limit = min(max(limit, 1), 10000)
+    return JSONResponse({"success": True, "phases": TIMING_PHASES, "data": await get_timing_summary(limit, api_url)})
+
+
 @app.delete("/api/images/{image_id}")
 async def api_delete_image(image_id: int):
     await delete_image_record(image_id)
@@ -779,11 +2234,29 @@ async def api_clear_all():
 # ============ main ============
 
 def main():
+    global JOB_BROKER
+    parser = argparse.ArgumentParser(description="HunyuanImage API 测试工具")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn 进程数，大于 1 时使用 sqlite 共享队列")
+    parser.add_argument("--broker", choices=("local", "sqlite"), default=JOB_BROKER,
+                        help="任务队列：local 单进程内存队列；sqlite 多个进程 / 副本共用 data.db")
+    args = parser.parse_args()
+    JOB_BROKER = "sqlite" if args.workers > 1 else args.broker
+    os.environ["HUNYUAN_JOB_BROKER"] = JOB_BROKER
+    
     print(f"\n{'='*60}")
     print(f"🎨 HunyuanImage API 测试工具")
-    print(f"✅ http://localhost:{PORT}")
+    print(f"✅ http://localhost:{args.port}")
+    if args.workers > 1 or JOB_BROKER != "local":
+        print(f"✅ {args.workers} 个进程，共享任务队列 ({JOB_BROKER})")
     print(f"{'='*60}\n")
-    uvicorn.run(app, host="0.0.0.0", port=PORT, access_log=False)
+    if args.workers > 1:
+        # 多进程需要以导入路径启动，每个 worker 进程各自导入本模块
+        uvicorn.run("app:app", host=args.host, port=args.port, workers=args.workers,
+                    access_log=False, app_dir=str(SCRIPT_DIR))
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, access_log=False)
 
 if __name__ == "__main__":
     main()
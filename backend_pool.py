@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多后端负载均衡
+
+多个部署相同模型的 Gradio 后端组成一个池，单张图片按"最少在途请求"路由：
+- 每个后端有权重，选择 (在途请求数 + 1) / 权重 最小的健康后端
+- 主动健康检查：定期请求 HEALTH_PATH，连续失败 PROBE_FAILURES 次标记为不健康，恢复后重新加入
+- 熔断：每个后端一个 CircuitBreaker（见 retry_policy），连续请求失败后在冷却期内不再分配
+- 健康检查都失败时仍按最少在途请求路由到未熔断的后端；所有后端都熔断时快速失败
+
+api_url 写成逗号 / 空白分隔的多个地址即为一个临时池；也可以按名字预先注册。
+"""
+
+import asyncio
+import random
+import re
+from typing import Collection, Dict, List, Optional
+
+import httpx
+
+from retry_policy import CircuitBreaker, CircuitOpenError
+
+HEALTH_PATH = "/config"
+PROBE_INTERVAL = 15       # 秒
+PROBE_TIMEOUT = 5
+PROBE_FAILURES = 2        # 连续探测失败几次标记为不健康
+LATENCY_ALPHA = 0.2       # 延迟 EWMA 平滑系数
+
+
+def parse_backend_urls(api_url: str) -> List[str]:
+    """把 api_url 拆成后端地址列表（逗号 / 空白分隔，去掉末尾的 /，去重保序）"""
+    urls = []
+    for part in re.split(r"[\s,]+", api_url or ""):
+        part = part.strip().rstrip('/')
+        if part and part not in urls:
+            urls.append(part)
+    return urls
+
+
+class Backend:
+    """池中的单个后端"""
+
+    def __init__(self, url: str, weight: float = 1.0, breaker: Optional[CircuitBreaker] = None):
+        self.url = url
+        self.weight = max(weight, 0.01)
+        self.outstanding = 0
+        self.healthy = True          # 主动探测结果
+        self.probe_failures = 0
+        self.breaker = breaker or CircuitBreaker()
+        self.latency: Optional[float] = None  # 成功请求耗时的 EWMA（秒）
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.breaker.allows()
+
+    def load(self) -> float:
+        return (self.outstanding + 1) / self.weight
+
+    def snapshot(self) -> dict:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "healthy": self.healthy,
+            "breaker": self.breaker.snapshot(),
+            "latency": round(self.latency, 2) if self.latency is not None else None,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+class BackendPool:
+    """一组等价后端"""
+
+    def __init__(self, key: str, backends: List[Backend]):
+        self.key = key
+        self.backends = backends
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.backends)
+
+    def acquire(self, avoid: Collection[str] = ()) -> Backend:
+        """
+        选择在途请求最少（按权重）的可用后端，并计入在途请求
+
+        Args:
+            avoid: 尽量避开的后端地址（重试 / 对冲时避开已经试过的后端）
+        """
+        available = [b for b in self.backends if b.available]
+        candidates = (
+            [b for b in available if b.url not in avoid] or available
+            or [b for b in self.backends if b.breaker.allows()]
+        )
+        if not candidates:
+            raise CircuitOpenError(f"后端均已熔断: {self.key}")
+        best = min(b.load() for b in candidates)
+        backend = random.choice([b for b in candidates if b.load() == best])
+        backend.breaker.on_acquire()
+        backend.outstanding += 1
+        backend.requests += 1
+        return backend
+
+    def release(self, backend: Backend, ok: Optional[bool], latency: Optional[float] = None):
+        """
+        请求结束：更新在途数、延迟和熔断器
+
+        ok 为 None 表示请求被取消，不计入成功或失败。
+        """
+        backend.outstanding = max(backend.outstanding - 1, 0)
+        if backend.breaker.record(ok):
+            print(f"⚠️ 后端已熔断 {backend.breaker.snapshot()['retry_in']}s: {backend.url}")
+        if ok is None:
+            return
+        if ok:
+            if latency is not None:
+                backend.latency = latency if backend.latency is None else (
+                    LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * backend.latency
+                )
+            return
+        backend.errors += 1
+
+    # ---------- 主动健康检查 ----------
+
+    def start_probing(self):
+        """多于一个后端时启动后台健康检查"""
+        if self.size > 1 and self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop_probing(self):
+        task, self._probe_task = self._probe_task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _probe_loop(self):
+        async with httpx.AsyncClient(timeout=PROBE_TIMEOUT) as client:
+            while True:
+                await asyncio.gather(*(self._probe(client, b) for b in self.backends))
+                await asyncio.sleep(PROBE_INTERVAL)
+
+    async def _probe(self, client: httpx.AsyncClient, backend: Backend):
+        try:
+            response = await client.get(f"{backend.url}{HEALTH_PATH}")
+            ok = response.status_code < 500
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            if not backend.healthy:
+                print(f"✅ 后端已恢复: {backend.url}")
+            backend.healthy = True
+            backend.probe_failures = 0
+        else:
+            backend.probe_failures += 1
+            if backend.healthy and backend.probe_failures >= PROBE_FAILURES:
+                backend.healthy = False
+                print(f"⚠️ 后端健康检查失败，已停止分配: {backend.url}")
+
+    def snapshot(self) -> dict:
+        return {"key": self.key, "backends": [b.snapshot() for b in self.backends]}
+
+
+class PoolRegistry:
+    """按 key 管理后端池：预先注册的命名池，以及 api_url 自动生成的池"""
+
+    def __init__(self):
+        self._pools: Dict[str, BackendPool] = {}
+        self._named: set = set()  # 命名池的名字（同时也是其 key）
+        self._breakers: Dict[str, CircuitBreaker] = {}  # 同一地址在不同池中共用一个熔断器
+
+    def _backend(self, url: str, weight: float = 1.0) -> Backend:
+        url = url.rstrip('/')
+        breaker = self._breakers.get(url)
+        if breaker is None:
+            breaker = self._breakers[url] = CircuitBreaker()
+        return Backend(url, weight, breaker)
+
+    def register(self, name: str, backends: List[dict]) -> BackendPool:
+        """注册命名池，backends 为 [{"url": ..., "weight": ...}]；同名池已存在时替换（调用方负责停止旧池的探测）"""
+        pool = BackendPool(name, [self._backend(b["url"], float(b.get("weight", 1))) for b in backends])
+        self._pools[name] = pool
+        self._named.add(name)
+        return pool
+
+    def resolve_key(self, api_url: str) -> str:
+        """api_url 对应的池 key（命名池直接用名字，否则为规范化后的地址列表）"""
+        api_url = (api_url or "").strip()
+        if api_url in self._named:
+            return api_url
+        return ",".join(parse_backend_urls(api_url))
+
+    def get(self, api_url: str) -> BackendPool:
+        """获取（必要时创建）api_url 对应的池"""
+        key = self.resolve_key(api_url)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = BackendPool(key, [self._backend(url) for url in parse_backend_urls(key)])
+            self._pools[key] = pool
+        return pool
+
+    def pools(self) -> List[BackendPool]:
+        return list(self._pools.values())
+
+    async def close(self):
+        for pool in self._pools.values():
+            await pool.stop_probing()
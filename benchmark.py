@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+端到端吞吐压测
+
+按目标速率向 app.py 的 /api/generate 提交任务，通过 /api/events 跟踪每个任务，结束后报告：
+- 吞吐：任务 / 秒、图片 / 秒
+- 端到端延迟（提交到 finished 事件）的 p50 / p95 / p99
+- 分阶段耗时：排队等待（queued -> started）、生成（单张 duration）、保存（单张 save_sec）
+
+配合 fake_gradio.py 可以完全离线运行：
+
+    python fake_gradio.py --port 7860 --latency 2 --concurrency 4
+    python app.py
+    python benchmark.py --app http://localhost:8849 --backend http://localhost:7860 --jobs 50 --rate 2
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import unicodedata
+from typing import Dict, List, Optional
+
+import httpx
+
+TERMINAL_EVENTS = ("finished", "failed", "cancelled")
+PHASES = ("upload", "join", "queue", "diffusion", "download", "encode", "db")  # 与 app.TIMING_PHASES 一致
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """线性插值百分位数（p 取 0-100）"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(values: List[float]) -> dict:
+    """均值和 p50 / p95 / p99（秒）"""
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(max(values), 3),
+    }
+
+
+class JobTrace:
+    """单个任务在客户端看到的时间线"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.job_id: Optional[str] = None
+        self.submitted = 0.0         # 客户端提交时间
+        self.finished: Optional[float] = None
+        self.status: Optional[str] = None
+        self.queued_ts: Optional[float] = None   # 以下为服务端时间戳
+        self.started_ts: Optional[float] = None
+        self.images: List[dict] = []
+        self.error: Optional[str] = None
+        self.done = asyncio.Event()
+
+
+class Benchmark:
+    def __init__(self, app_url: str, backend: str, jobs: int, rate: float, count: int,
+                 parallel: bool, prompt: str, seed: int, poisson: bool, timeout: float,
+                 output_format: Optional[str] = None):
+        self.app_url = app_url.rstrip('/')
+        self.backend = backend
+        self.jobs = jobs
+        self.rate = rate
+        self.count = count
+        self.parallel = parallel
+        self.prompt = prompt
+        self.seed = seed
+        self.poisson = poisson
+        self.timeout = timeout
+        self.output_format = output_format
+        self.traces: List[JobTrace] = []
+        self._by_id: Dict[str, JobTrace] = {}
+        self._early: Dict[str, List[tuple]] = {}  # 提交接口返回前就收到的事件
+
+    # ---------- 事件 ----------
+
+    async def watch_events(self, client: httpx.AsyncClient, ready: asyncio.Event):
+        async with client.stream("GET", f"{self.app_url}/api/events", timeout=None) as response:
+            response.raise_for_status()
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[7:]
+                elif line.startswith("data: ") and event:
+                    if event == "snapshot":
+                        ready.set()
+                    else:
+                        self.on_event(event, json.loads(line[6:]), time.time())
+                    event = None
+
+    def on_event(self, event: str, data: dict, received: float):
+        job_id = data.get("job_id")
+        if not job_id:
+            return
+        trace = self._by_id.get(job_id)
+        if trace is None:
+            self._early.setdefault(job_id, []).append((event, data, received))
+            return
+        if event == "queued":
+            trace.queued_ts = data.get("queued_ts") or trace.queued_ts
+        elif event == "started":
+            trace.started_ts = data.get("started_ts")
+        elif event == "image":
+            trace.images.append(data.get("result", {}))
+        elif event in TERMINAL_EVENTS and trace.finished is None:
+            trace.finished = received
+            trace.status = "completed" if event == "finished" else event
+            trace.error = data.get("error")
+            trace.done.set()
+
+    # ---------- 提交 ----------
+
+    async def submit(self, client: httpx.AsyncClient, trace: JobTrace):
+        payload = {
+            "api_url": self.backend, "prompt": f"{self.prompt} #{trace.index}",
+            "count": self.count, "parallel": self.parallel, "seed": self.seed,
+        }
+        if self.output_format:
+            payload["output_format"] = self.output_format
+        trace.submitted = time.time()
+        try:
+            response = await client.post(f"{self.app_url}/api/generate", json=payload)
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            data = {"success": False, "error": str(e)}
+        if not data.get("success"):
+            trace.status, trace.error, trace.finished = "rejected", data.get("error"), time.time()
+            trace.done.set()
+            return
+        trace.job_id = data["job_id"]
+        trace.queued_ts = trace.submitted
+        self._by_id[trace.job_id] = trace
+        for event, event_data, received in self._early.pop(trace.job_id, []):
+            self.on_event(event, event_data, received)
+
+    async def run(self) -> dict:
+        limits = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+        async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+            ready = asyncio.Event()
+            watcher = asyncio.create_task(self.watch_events(client, ready))
+            waiter = asyncio.create_task(ready.wait())
+            await asyncio.wait({watcher, waiter}, timeout=10, return_when=asyncio.FIRST_COMPLETED)
+            if not ready.is_set():
+                waiter.cancel()
+                if watcher.done():
+                    watcher.result()  # 连接 /api/events 失败，抛出原始异常
+                watcher.cancel()
+                raise TimeoutError("等待 /api/events 快照超时")
+
+            start = time.time()
+            submits = []
+            for i in range(self.jobs):
+                trace = JobTrace(i)
+                self.traces.append(trace)
+                submits.append(asyncio.create_task(self.submit(client, trace)))
+                if i + 1 < self.jobs and self.rate > 0:
+                    await asyncio.sleep(random.expovariate(self.rate) if self.poisson else 1 / self.rate)
+            submit_elapsed = time.time() - start
+            await asyncio.gather(*submits)
+
+            try:
+                await asyncio.wait_for(asyncio.gather(*(t.done.wait() for t in self.traces)), self.timeout)
+            except asyncio.TimeoutError:
+                print(f"⚠️ 超过 {self.timeout}s 仍有任务未结束")
+            end = time.time()
+
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+            # 清理 active_jobs
+            await asyncio.gather(*(
+                client.post(f"{self.app_url}/api/job/{t.job_id}/ack") for t in self.traces if t.job_id
+            ), return_exceptions=True)
+        return self.report(start, end, submit_elapsed)
+
+    # ---------- 报告 ----------
+
+    def report(self, start: float, end: float, submit_elapsed: float) -> dict:
+        completed = [t for t in self.traces if t.status == "completed"]
+        images = [img for t in completed for img in t.images]
+        last_finish = max((t.finished for t in completed), default=end)
+        elapsed = max(last_finish - start, 1e-9)
+        statuses: Dict[str, int] = {}
+        for t in self.traces:
+            statuses[t.status or "timeout"] = statuses.get(t.status or "timeout", 0) + 1
+        return {
+            "jobs": self.jobs,
+            "target_rate": self.rate,
+            "offered_rate": round(self.jobs / submit_elapsed, 3) if self.rate > 0 and submit_elapsed > 0 else None,
+            "statuses": statuses,
+            "images": len(images),
+            "images_expected": len(completed) * self.count,
+            "elapsed": round(elapsed, 3),
+            "jobs_per_sec": round(len(completed) / elapsed, 3),
+            "images_per_sec": round(len(images) / elapsed, 3),
+            "latency": summarize([t.finished - t.submitted for t in completed]),
+            "queue_wait": summarize([t.started_ts - t.queued_ts for t in completed if t.started_ts and t.queued_ts]),
+            "generation": summarize([img["duration"] for img in images if img.get("duration") is not None]),
+            "save": summarize([img["save_sec"] for img in images if img.get("save_sec") is not None]),
+            # 服务端记录的单张分阶段耗时（见 /api/timings）
+            "phases": {
+                phase: summarize([img["timings"][phase] for img in images if phase in img.get("timings", {})])
+                for phase in PHASES
+            },
+        }
+
+
+def pad(text: str, width: int) -> str:
+    """按终端显示宽度补齐（中文字符占两格）"""
+    shown = sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
+    return text + " " * max(width - shown, 0)
+
+
+def print_report(report: dict):
+    print(f"\n{'='*60}")
+    rate = f"目标 {report['target_rate']}/s，实际提交 {report['offered_rate']}/s" if report["offered_rate"] else "一次性提交"
+    print(f"📊 任务 {report['jobs']}（{rate}）"
+          f"  状态: {report['statuses']}")
+    print(f"🖼️ 图片 {report['images']}/{report['images_expected']}，耗时 {report['elapsed']}s")
+    print(f"🚀 吞吐: {report['jobs_per_sec']} 任务/s, {report['images_per_sec']} 图片/s")
+    print(f"{'':<12}{'n':>6}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = [(label, report[key]) for key, label in (
+        ("latency", "端到端"), ("queue_wait", "排队等待"), ("generation", "生成"), ("save", "保存"),
+    )]
+    rows += [(f"  {phase}", s) for phase, s in report["phases"].items() if s["n"]]
+    for label, s in rows:
+        if not s["n"]:
+            print(f"{pad(label, 12)}{0:>6}")
+            continue
+        print(f"{pad(label, 12)}{s['n']:>6}" + "".join(f"{s[k]:>10.3f}" for k in ("mean", "p50", "p95", "p99", "max")))
+    print(f"{'='*60}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HunyuanImage Playground 端到端压测")
+    parser.add_argument("--app", default="http://localhost:8849", help="app.py 地址")
+    parser.add_argument("--backend", default="http://127.0.0.1:7860", help="提交任务时的 api_url（可以是 fake_gradio.py）")
+    parser.add_argument("--jobs", type=int, default=20, help="提交的任务数")
+    parser.add_argument("--rate", type=float, default=1.0, help="目标提交速率（任务/秒），0 表示一次性全部提交")
+    parser.add_argument("--poisson", action="store_true", help="按泊松过程提交（间隔服从指数分布）")
+    parser.add_argument("--count", type=int, default=1, help="每个任务的图片数")
+    parser.add_argument("--sequential", action="store_true", help="任务内顺序生成（默认并发）")
+    parser.add_argument("--prompt", default="benchmark")
+    parser.add_argument("--seed", type=int, default=-1, help="固定 seed 会命中结果缓存 / 合并，默认随机")
+    parser.add_argument("--format", dest="output_format", default=None, help="输出格式（png / webp / jpeg / original）")
+    parser.add_argument("--timeout", type=float, default=600, help="等待全部任务结束的最长时间（秒）")
+    parser.add_argument("--json", dest="json_path", default=None, help="同时把报告写入 JSON 文件")
+    args = parser.parse_args()
+
+    bench = Benchmark(
+        args.app, args.backend, args.jobs, args.rate, args.count, not args.sequential,
+        args.prompt, args.seed, args.poisson, args.timeout, args.output_format,
+    )
+    try:
+        report = asyncio.run(bench.run())
+    except (httpx.HTTPError, TimeoutError) as e:
+        print(f"❌ 无法连接 {args.app}: {e}")
+        sys.exit(1)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+画廊缩略图 / 预览图缓存
+
+- 尺寸：thumb（画廊卡片）、preview（大图预览）、full（原图）
+- 首次请求时生成并写入磁盘缓存，缓存总大小有上限，超出后按 LRU 淘汰
+- 缓存文件名包含源文件的大小和修改时间，源文件变化后自动失效；ETag 由同样的信息生成（强校验）
+- 多进程共用缓存目录时（shared），命中时更新文件修改时间作为各进程共同的 LRU 顺序，
+  并定期重新扫描目录，按整个目录的大小淘汰
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image, features
+
+DERIVATIVE_SIZES = {"thumb": 384, "preview": 1280}  # 长边像素
+FULL_SIZE = "full"
+DERIVATIVE_QUALITY = 82
+DERIVATIVE_VERSION = 1  # 调整生成参数时递增，使旧缓存和旧 ETag 失效
+DERIVATIVE_FORMAT, DERIVATIVE_EXT = ("WEBP", ".webp") if features.check("webp") else ("JPEG", ".jpg")
+DERIVATIVE_MEDIA_TYPE = "image/webp" if DERIVATIVE_FORMAT == "WEBP" else "image/jpeg"
+SHARED_RESCAN_SEC = 30   # shared 模式下重新扫描目录的最短间隔（其他进程写入的文件要扫描后才计入总大小）
+TEMP_GRACE_SEC = 600     # shared 模式下临时文件超过这个时间才当作残留清理（其他进程可能正在生成）
+
+
+def derivative_urls(filename: str) -> dict:
+    """各尺寸的访问地址"""
+    urls = {size: f"/derived/{size}/{filename}" for size in DERIVATIVE_SIZES}
+    urls[FULL_SIZE] = f"/derived/{FULL_SIZE}/{filename}"
+    return urls
+
+
+def render_derivative(source: Path, target: Path, max_side: int) -> int:
+    """生成缩略图并原子写入 target（阻塞，在线程池中调用），返回文件大小"""
+    tmp = target.with_name(f".{target.name}.tmp")
+    try:
+        with Image.open(source) as image:
+            # JPEG 源可以在解码时直接降采样，省掉大部分解码开销
+            image.draft("RGB", (max_side, max_side))
+            image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            if DERIVATIVE_FORMAT == "JPEG" and image.mode != "RGB":
+                image = image.convert("RGB")
+            image.save(tmp, format=DERIVATIVE_FORMAT, quality=DERIVATIVE_QUALITY)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return target.stat().st_size
+
+
+class DerivativeCache:
+    """
+    按 (文件名, 尺寸) 缓存缩略图，总大小超过 max_bytes 时淘汰最久未访问的文件
+
+    run: 执行阻塞函数的协程（通常是缩略图专用的线程池），不指定时使用 asyncio.to_thread
+    shared: 缓存目录是否与其他进程共用
+    """
+
+    def __init__(self, source_dir: Path, cache_dir: Path, max_bytes: int,
+                 run: Optional[Callable[..., Awaitable]] = None, shared: bool = False):
+        self.source_dir = Path(source_dir)
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._run = run or asyncio.to_thread
+        self._entries: "OrderedDict[Path, int]" = OrderedDict()  # 缓存文件 -> 大小，按访问顺序
+        self._total = 0
+        self._pending: Dict[Path, asyncio.Future] = {}
+        self._scanned = 0.0  # 上次扫描目录的时间（monotonic）
+
+    def _scan(self) -> List[Tuple[Path, int]]:
+        """扫描缓存目录（阻塞），返回按修改时间排序的 (文件, 大小)，并清理残留的临时文件"""
+        files = []
+        now = time.time()
+        for size in DERIVATIVE_SIZES:
+            directory = self.cache_dir / size
+            directory.mkdir(parents=True, exist_ok=True)
+            for f in directory.iterdir():
+                try:
+                    st = f.stat()
+                except FileNotFoundError:  # 被其他进程淘汰
+                    continue
+                if not f.is_file():
+                    continue
+                if f.name.startswith("."):
+                    if not self.shared or now - st.st_mtime > TEMP_GRACE_SEC:
+                        f.unlink(missing_ok=True)
+                    continue
+                files.append((st.st_mtime, f, st.st_size))
+        return [(f, nbytes) for _, f, nbytes in sorted(files)]
+
+    def _apply_scan(self, files: List[Tuple[Path, int]]):
+        self._entries.clear()
+        self._total = 0
+        for f, nbytes in files:
+            self._entries[f] = nbytes
+            self._total += nbytes
+        self._scanned = time.monotonic()
+
+    def load(self):
+        """扫描已有缓存（按修改时间恢复 LRU 顺序），并清理残留的临时文件"""
+        self._apply_scan(self._scan())
+        self._evict()
+
+    def source_path(self, filename: str) -> Optional[Path]:
+        """校验文件名并返回源文件路径，不存在（或文件名不合法）时返回 None"""
+        if not filename or Path(filename).name != filename or filename.startswith("."):
+            return None
+        path = self.source_dir / filename
+        return path if path.is_file() else None
+
+    @staticmethod
+    def etag(source_stat: os.stat_result, size: str) -> str:
+        return f'"{size}-v{DERIVATIVE_VERSION}-{source_stat.st_size:x}-{source_stat.st_mtime_ns:x}"'
+
+    def _cache_path(self, filename: str, size: str, source_stat: os.stat_result) -> Path:
+        stamp = f"{source_stat.st_size:x}-{source_stat.st_mtime_ns:x}-v{DERIVATIVE_VERSION}"
+        return self.cache_dir / size / f"{filename}.{stamp}{DERIVATIVE_EXT}"
+
+    async def get(self, filename: str, size: str) -> Optional[Tuple[Path, str]]:
+        """
+        获取派生图，返回 (文件路径, ETag)；源文件不存在时返回 None
+
+        full 直接返回源文件；同一张图的并发请求只生成一次。
+        """
+        source = self.source_path(filename)
+        if source is None:
+            return None
+        st = source.stat()
+        if size == FULL_SIZE:
+            return source, self.etag(st, size)
+        path = self._cache_path(filename, size, st)
+        if path in self._entries:
+            if self._touch(path):
+                self._entries.move_to_end(path)
+                return path, self.etag(st, size)
+            self._forget(path)
+        elif self.shared and path.is_file():
+            # 其他进程生成的，下次扫描前先按本进程的索引计入
+            self._add(path, path.stat().st_size)
+            return path, self.etag(st, size)
+        pending = self._pending.get(path)
+        if pending is None:
+            pending = asyncio.ensure_future(self._render(source, path, DERIVATIVE_SIZES[size]))
+            self._pending[path] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(path, None))
+        await asyncio.shield(pending)
+        return path, self.etag(st, size)
+
+    async def _render(self, source: Path, path: Path, max_side: int):
+        nbytes = await self._run(render_derivative, source, path, max_side)
+        self._add(path, nbytes)
+        if self.shared and time.monotonic() - self._scanned >= SHARED_RESCAN_SEC:
+            self._scanned = time.monotonic()
+            self._apply_scan(await self._run(self._scan))
+        self._evict(keep=path)
+
+    def _add(self, path: Path, nbytes: int):
+        self._forget(path)
+        self._entries[path] = nbytes
+        self._total += nbytes
+
+    def _forget(self, path: Path):
+        """只从索引中移除（文件已不存在）"""
+        nbytes = self._entries.pop(path, None)
+        if nbytes is not None:
+            self._total -= nbytes
+
+    def _touch(self, path: Path) -> bool:
+        """shared 模式下把访问时间记到文件修改时间上（各进程扫描时据此恢复 LRU 顺序）；文件已被删除时返回 False"""
+        if not self.shared:
+            return True
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _evict(self, keep: Optional[Path] = None):
+        while self._total > self.max_bytes and self._entries:
+            path, nbytes = next(iter(self._entries.items()))
+            if path == keep:
+                break
+            self._drop(path)
+
+    def _drop(self, path: Path):
+        if path in self._entries:
+            self._forget(path)
+            path.unlink(missing_ok=True)
+
+    def invalidate(self, filename: str):
+        """源文件被删除时清理它的所有派生图"""
+        prefix = f"{filename}."
+        for path in [p for p in self._entries if p.name.startswith(prefix)]:
+            self._drop(path)
+
+    def clear(self):
+        for path in list(self._entries):
+            self._drop(path)
+
+    def stats(self) -> dict:
+        return {"files": len(self._entries), "bytes": self._total, "max_bytes": self.max_bytes}
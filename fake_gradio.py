@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟 HunyuanImage Gradio 后端（离线压测 / 调试用）
+
+实现 app.py 用到的 Gradio 接口：
+- POST /gradio_api/upload
+- POST /gradio_api/queue/join
+- GET  /gradio_api/queue/data   SSE：estimation -> process_starts -> progress -> process_completed
+- GET  /gradio_api/file=<path>
+
+可配置生成耗时（含抖动）、并发数、队列上限、失败率和结果图片大小，例如：
+
+    python fake_gradio.py --port 7860 --latency 5 --concurrency 2 --fail-rate 0.05 --image-size 1024x1024
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import time
+import uuid
+from typing import Dict
+
+import uvicorn
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from PIL import Image
+
+FAIL_MODES = ("join", "sse", "download")
+ESTIMATION_INTERVAL = 1.0   # 排队时推送 estimation 的间隔（秒）
+SESSION_TTL = 600           # join 之后多久没有读取结果就丢弃
+
+
+def render_image(width: int, height: int, fmt: str) -> bytes:
+    """生成一张带噪声的图片（压缩率接近真实生成结果），启动时生成一次，所有结果共用"""
+    noise = Image.effect_noise((width, height), 64).convert("L")
+    image = Image.merge("RGB", (
+        noise,
+        Image.linear_gradient("L").resize((width, height)),
+        noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+    ))
+    buf = io.BytesIO()
+    image.save(buf, fmt.upper())
+    return buf.getvalue()
+
+
+class FakeBackend:
+    """
+    模拟的生成服务
+
+    Args:
+        latency: 单张平均生成耗时（秒）
+        jitter: 耗时抖动比例，实际耗时在 latency * [1 - jitter, 1 + jitter] 内均匀分布
+        concurrency: 同时生成的数量（Gradio 的 concurrency_limit）
+        max_queue: 排队上限，超过时 queue/join 返回 503；0 表示不限
+        fail_rate: 每个阶段注入失败的概率
+        fail_modes: 注入失败的阶段：join（503）、sse（结果前断流）、download（结果文件第一次请求返回 500）
+        steps: 每张推送的进度条数
+    """
+
+    def __init__(self, latency: float = 5.0, jitter: float = 0.2, concurrency: int = 1,
+                 max_queue: int = 0, fail_rate: float = 0.0, fail_modes=FAIL_MODES,
+                 steps: int = 8, image: bytes = b"", image_format: str = "png"):
+        self.latency = latency
+        self.jitter = jitter
+        self.max_queue = max_queue
+        self.fail_rate = fail_rate
+        self.fail_modes = list(fail_modes)
+        self.steps = max(steps, 1)
+        self.image = image
+        self.image_format = image_format
+        self._slots = asyncio.Semaphore(max(concurrency, 1))
+        self._sessions: Dict[str, float] = {}   # session_hash -> join 时间
+        self._waiting: list = []                # 排队中的 session_hash（FIFO）
+        self._broken_files: set = set()         # 注入下载失败的结果文件
+        self.stats = {"joined": 0, "completed": 0, "rejected": 0, "failed": 0}
+
+    def should_fail(self, mode: str) -> bool:
+        if mode in self.fail_modes and random.random() < self.fail_rate:
+            self.stats["failed"] += 1
+            return True
+        return False
+
+    def _duration(self) -> float:
+        return max(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter), 0)
+
+    def join(self, session_hash: str) -> bool:
+        now = time.time()
+        for key in [k for k, t in self._sessions.items() if now - t > SESSION_TTL]:
+            del self._sessions[key]
+        if self.max_queue and len(self._sessions) >= self.max_queue:
+            self.stats["rejected"] += 1
+            return False
+        self._sessions[session_hash] = now
+        self.stats["joined"] += 1
+        return True
+
+    async def events(self, session_hash: str):
+        """单个 session 的 SSE 消息"""
+        if self._sessions.pop(session_hash, None) is None:
+            yield {"msg": "unexpected_error", "message": "Session not found."}
+            return
+        self._waiting.append(session_hash)
+        acquire = asyncio.ensure_future(self._slots.acquire())
+        try:
+            while True:
+                rank = self._waiting.index(session_hash)
+                yield {"msg": "estimation", "rank": rank, "queue_size": len(self._waiting),
+                       "rank_eta": round(self.latency * (rank + 1), 1)}
+                done, _ = await asyncio.wait({acquire}, timeout=ESTIMATION_INTERVAL)
+                if done:
+                    break
+        except BaseException:
+            acquire.cancel()
+            if acquire.done() and not acquire.cancelled():
+                self._slots.release()
+            raise
+        finally:
+            self._waiting.remove(session_hash)
+        try:
+            duration = self._duration()
+            yield {"msg": "process_starts", "eta": round(duration, 1)}
+            for step in range(self.steps):
+                await asyncio.sleep(duration / self.steps)
+                yield {"msg": "progress", "progress_data": [
+                    {"index": step + 1, "length": self.steps, "unit": "steps", "desc": "Sampling"}
+                ]}
+                if step == self.steps // 2 and self.should_fail("sse"):
+                    return
+            path = f"/tmp/gradio/{uuid.uuid4().hex}/image.{self.image_format}"
+            if self.should_fail("download"):
+                self._broken_files.add(path)
+            self.stats["completed"] += 1
+            yield {"msg": "process_completed", "success": True, "output": {
+                "data": [{"path": path, "orig_name": f"image.{self.image_format}"}, f"生成完成，耗时 {duration:.1f}s"],
+            }}
+        finally:
+            self._slots.release()
+
+    def file(self, path: str):
+        if path in self._broken_files:
+            self._broken_files.discard(path)
+            return None
+        return self.image
+
+
+def create_app(backend: FakeBackend) -> FastAPI:
+    app = FastAPI(title="Fake HunyuanImage Gradio")
+    media_type = f"image/{backend.image_format}"
+
+    @app.get("/config")
+    async def config():
+        return {"version": "fake", "stats": backend.stats}
+
+    @app.post("/gradio_api/upload")
+    async def upload(files: UploadFile = File(...)):
+        await files.read()
+        return JSONResponse([f"/tmp/gradio/{uuid.uuid4().hex}/{files.filename}"])
+
+    @app.post("/gradio_api/queue/join")
+    async def queue_join(request: Request):
+        data = await request.json()
+        if backend.should_fail("join"):
+            return JSONResponse({"error": "injected failure"}, status_code=503)
+        if not backend.join(data.get("session_hash", "")):
+            return JSONResponse({"error": "Queue is full."}, status_code=503)
+        return {"event_id": uuid.uuid4().hex}
+
+    @app.get("/gradio_api/queue/data")
+    async def queue_data(session_hash: str):
+        async def stream():
+            async for message in backend.events(session_hash):
+                yield f"data: {json.dumps(message, ensure_ascii=False)}\n\n"
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/gradio_api/file={path:path}")
+    async def file(path: str):
+        content = backend.file(path)
+        if content is None:
+            return Response("injected failure", status_code=500)
+        return Response(content, media_type=media_type)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟 HunyuanImage Gradio 后端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency", type=float, default=5.0, help="单张平均生成耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="耗时抖动比例")
+    parser.add_argument("--concurrency", type=int, default=1, help="同时生成的数量")
+    parser.add_argument("--max-queue", type=int, default=0, help="排队上限，0 表示不限")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="每个阶段注入失败的概率")
+    parser.add_argument("--fail-modes", default=",".join(FAIL_MODES), help="注入失败的阶段，逗号分隔：join,sse,download")
+    parser.add_argument("--steps", type=int, default=8, help="每张推送的进度条数")
+    parser.add_argument("--image-size", default="1024x1024", help="结果图片尺寸 WxH")
+    parser.add_argument("--image-format", default="png", choices=("png", "jpeg", "webp"))
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    image = render_image(width, height, args.image_format)
+    backend = FakeBackend(
+        latency=args.latency, jitter=args.jitter, concurrency=args.concurrency,
+        max_queue=args.max_queue, fail_rate=args.fail_rate,
+        fail_modes=[m for m in args.fail_modes.split(",") if m in FAIL_MODES],
+        steps=args.steps, image=image, image_format=args.image_format,
+    )
+    print(f"🧪 模拟后端: http://{args.host}:{args.port}  "
+          f"耗时 {args.latency}s±{args.jitter:.0%}, 并发 {args.concurrency}, "
+          f"失败率 {args.fail_rate:.0%}, 图片 {width}x{height} {args.image_format} ({len(image) // 1024} KB)")
+    uvicorn.run(create_app(backend), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成结果的编码与落盘
+
+- 编码在独立线程池中执行，不阻塞事件循环（Pillow 编码时会释放 GIL）
+- 支持多种输出格式：PNG（可调压缩级别）、无损 WebP、高质量 JPEG / AVIF，
+  以及 original（直接写入上游返回的原始字节，不做任何重新编码）
+- original 配合客户端的直存模式（DownloadedImage）：下载时已分块落盘，这里只做重命名
+- 先写临时文件再原子替换，/output 不会暴露写了一半的图片
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+from PIL import Image, features
+
+from api_client import DownloadedImage
+
+PNG_COMPRESS_LEVEL = 6   # 0-9，越大越小越慢
+JPEG_QUALITY = 95
+AVIF_QUALITY = 90
+AVIF_SPEED = 6           # 0-10，越大越快
+
+# 格式名 -> (Pillow 格式, 扩展名, save 参数)
+OUTPUT_FORMATS: Dict[str, Tuple[str, str, dict]] = {
+    "png": ("PNG", ".png", {"compress_level": PNG_COMPRESS_LEVEL}),
+    "webp": ("WEBP", ".webp", {"lossless": True, "quality": 80, "method": 4}),
+    "jpeg": ("JPEG", ".jpg", {"quality": JPEG_QUALITY, "subsampling": 0, "optimize": True}),
+    "avif": ("AVIF", ".avif", {"quality": AVIF_QUALITY, "speed": AVIF_SPEED}),
+}
+ORIGINAL_FORMAT = "original"
+# 上游原始格式 -> 扩展名（original 模式使用）
+FORMAT_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp", "AVIF": ".avif"}
+OUTPUT_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.avif')
+
+
+def supported_formats() -> list:
+    """当前 Pillow 构建支持的输出格式"""
+    names = ["png"]
+    if features.check("webp"):
+        names.append("webp")
+    if features.check("jpg"):
+        names.append("jpeg")
+    if features.check("avif"):
+        names.append("avif")
+    names.append(ORIGINAL_FORMAT)
+    return names
+
+
+def resolve_format(name: Optional[str], default: str = "png") -> str:
+    """校验格式名，不支持时回退到 default"""
+    name = (name or default).lower()
+    if name == "jpg":
+        name = "jpeg"
+    return name if name in supported_formats() else default
+
+
+def _prepare(image: Image.Image, pil_format: str) -> Image.Image:
+    """按目标格式转换色彩模式（JPEG 不支持透明通道）"""
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        return image.convert("RGB")
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        return image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    return image
+
+
+def transcode_file(source: Path, directory: Path, stem: str, fmt: str) -> str:
+    """把已有图片文件重新编码为 fmt 格式写入 directory/stem.<ext>，返回文件名"""
+    with Image.open(source) as decoded:
+        return encode_to_file(decoded, directory, stem, fmt)
+
+
+def _save_downloaded(image: DownloadedImage, directory: Path, stem: str, fmt: str) -> str:
+    """直存模式的结果：original 直接重命名临时文件，其他格式才需要解码后重新编码"""
+    if fmt != ORIGINAL_FORMAT:
+        try:
+            return transcode_file(image.path, directory, stem, fmt)
+        finally:
+            image.discard()
+    filename = f"{stem}{FORMAT_EXTENSIONS.get(image.format or '', '.png')}"
+    os.replace(image.path, Path(directory) / filename)
+    return filename
+
+
+def encode_to_file(image: Union[Image.Image, DownloadedImage], directory: Path, stem: str, fmt: str) -> str:
+    """
+    编码并写入 directory/stem.<ext>（阻塞，在线程池中调用），返回文件名
+
+    original 模式下若图像带有上游原始字节（upstream_bytes），直接写入，跳过编码。
+    """
+    if isinstance(image, DownloadedImage):
+        return _save_downloaded(image, directory, stem, fmt)
+    raw = getattr(image, "upstream_bytes", None) if fmt == ORIGINAL_FORMAT else None
+    if raw is not None:
+        ext = FORMAT_EXTENSIONS.get(image.format or "", ".png")
+    else:
+        pil_format, ext, params = OUTPUT_FORMATS.get(fmt, OUTPUT_FORMATS["png"])
+    filename = f"{stem}{ext}"
+    target = Path(directory) / filename
+    tmp = target.with_name(f".{filename}.tmp")
+    try:
+        if raw is not None:
+            with open(tmp, "wb") as f:
+                f.write(raw)
+        else:
+            _prepare(image, pil_format).save(tmp, format=pil_format, **params)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return filename
+
+
+class ImageEncoder:
+    """编码线程池：save() 在后台线程完成编码和写盘"""
+
+    def __init__(self, workers: int = 2, name: str = "encode"):
+        self.workers = workers
+        self.name = name  # 线程名前缀，也用作指标的 pool 标签
+        self.inflight = 0  # 已提交未完成的任务数（超过 workers 的部分在排队）
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def run(self, func, *args):
+        """在线程池中执行阻塞函数"""
+        self.start()
+        loop = asyncio.get_running_loop()
+        self.inflight += 1
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.inflight -= 1
+
+    async def save(self, image: Union[Image.Image, DownloadedImage], directory: Path, stem: str, fmt: str) -> str:
+        return await self.run(encode_to_file, image, directory, stem, fmt)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+跨进程任务队列（SQLite）
+
+多个 uvicorn worker / 同一台机器上的多个副本共用 data.db 中的 jobs 表作为任务队列：
+- 入队：jobs 行写入 queue_key（所属后端队列），状态为 pending
+- 领取：BEGIN IMMEDIATE 写事务中取 (priority, counter) 最小的一条改为 generating，记下 owner 和租约；
+  同一条 UPDATE 里检查该后端在所有进程中的执行数，后端并发上限对整个集群生效
+- 租约：owner 进程每次同步时续约；进程崩溃后租约过期，任意进程重新领取，从缺少的图片继续
+- 取消：任何进程都可以把任务标记为 cancelled，owner 进程在下次同步时停止生成
+- 同步：每 POLL_INTERVAL 刷新各队列的排队快照，并把有变化的任务行交给 on_sync 回调
+  （app 用它转发其他进程执行的任务事件）
+
+SharedJobQueue 与 job_queue.JobQueue 的接口一致（put_nowait / get / remove / set_priority / position ...），
+app.py 按 JOB_BROKER 选择其一。排队位置来自同步快照，是近似值。
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from job_store import JobStore, decode_row
+
+LEASE_SEC = 30        # 执行中任务的租约，owner 进程每次同步时续约
+POLL_INTERVAL = 1.0   # 同步间隔（秒）：续约、刷新排队快照、转发任务变化
+SYNC_OVERLAP = 2.0    # 变化查询的时间窗口往前多取一段，避免漏掉提交稍晚的写入（on_sync 需要幂等）
+
+# 该后端在所有进程中执行中的任务数（租约未过期）
+RUNNING_SQL = "SELECT COUNT(*) FROM jobs WHERE queue_key = :key AND status = 'generating' AND lease_until >= :now"
+# 可领取：排队中，或执行中但租约已过期（owner 进程已退出）
+CLAIMABLE_SQL = "queue_key = :key AND (status = 'pending' OR (status = 'generating' AND lease_until < :now))"
+CLAIM_SQL = f"""
+    UPDATE jobs SET status = 'generating', owner = :owner, lease_until = :lease, updated_ts = :now
+    WHERE job_id = (SELECT job_id FROM jobs WHERE {CLAIMABLE_SQL} ORDER BY priority, counter LIMIT 1)
+      AND ({RUNNING_SQL}) < :limit
+    RETURNING *
+"""
+
+
+class SharedJobQueue:
+    """某个后端在共享队列中的视图，接口与 JobQueue 一致"""
+
+    def __init__(self, broker: "SQLiteJobBroker", key: str, limit: int):
+        self.broker = broker
+        self.key = key
+        self.limit = limit                # 该后端在所有进程中的并发上限
+        self._order: List[str] = []       # 排队快照（job_id，按执行顺序）
+        self._wakeup = asyncio.Event()    # 有可领取的任务时唤醒本进程的 worker
+
+    # ---------- 基本操作 ----------
+
+    def qsize(self) -> int:
+        return len(self._order)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._order
+
+    def empty(self) -> bool:
+        return not self._order
+
+    def put_nowait(self, job_id: str, priority: int, counter: int, job: dict):
+        """入队（写入在 JobStore 中合并提交，与同一任务之前的写入保持顺序）"""
+        self.broker.store.update(
+            job_id, status="pending", priority=priority, counter=counter, job_data=job,
+            queue_key=self.key, owner=None, lease_until=None,
+        )
+        if job_id not in self._order:
+            self._order.append(job_id)
+        self._wakeup.set()
+
+    async def put(self, job_id: str, priority: int, counter: int, job: dict):
+        self.put_nowait(job_id, priority, counter, job)
+
+    async def get(self) -> Tuple[int, int, dict]:
+        """领取下一个任务，返回 (priority, counter, job_data)"""
+        while True:
+            self._wakeup.clear()
+            row = await self.broker.claim(self.key, self.limit)
+            if row is not None:
+                if row["job_id"] in self._order:
+                    self._order.remove(row["job_id"])
+                return row["priority"], row["counter"], row["job_data"]
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), LEASE_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    def task_done(self):
+        """与 JobQueue 保持一致；共享队列的任务状态由 jobs 表记录，这里无需计数"""
+
+    def remove(self, job_id: str) -> bool:
+        """从队列中移除排队中的任务（已被其他进程领取时由调用方标记 cancelled，owner 同步时停止）"""
+        if job_id not in self._order:
+            return False
+        self._order.remove(job_id)
+        self.broker.store.update(job_id, queue_key=None)
+        return True
+
+    def set_priority(self, job_id: str, priority: int) -> bool:
+        if job_id not in self._order:
+            return False
+        self.broker.store.update(job_id, priority=priority)
+        # 快照里先移到最前，下次同步时按数据库中的顺序校正
+        self._order.remove(job_id)
+        self._order.insert(0, job_id)
+        return True
+
+    # ---------- 查询 ----------
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        """共享队列不在内存中保存 job_data"""
+        return None
+
+    def position(self, job_id: str) -> Optional[int]:
+        try:
+            return self._order.index(job_id) + 1
+        except ValueError:
+            return None
+
+    def positions(self) -> Dict[str, int]:
+        return {job_id: i + 1 for i, job_id in enumerate(self._order)}
+
+
+class SQLiteJobBroker:
+    """
+    多进程共享的任务队列与状态同步
+
+    Args:
+        store: 本进程的 JobStore（入队、状态变化都经它合并提交）
+        worker_id: 本进程标识（写入 jobs.owner）
+        on_sync: 每次同步后以有变化的任务行（已解析，含本进程写入的）调用
+    """
+
+    def __init__(self, store: JobStore, worker_id: str,
+                 on_sync: Optional[Callable[[List[dict]], Awaitable[None]]] = None,
+                 lease_sec: float = LEASE_SEC, poll_interval: float = POLL_INTERVAL):
+        self.store = store
+        self.pool = store.pool
+        self.worker_id = worker_id
+        self.on_sync = on_sync
+        self.lease_sec = lease_sec
+        self.poll_interval = poll_interval
+        self.queues: Dict[str, SharedJobQueue] = {}
+        self.keys: set = set()  # 最近一次同步时有可领取任务的队列
+        self._since = time.time() - SYNC_OVERLAP
+        self._task: Optional[asyncio.Task] = None
+
+    def queue(self, key: str, limit: int) -> SharedJobQueue:
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = SharedJobQueue(self, key, limit)
+        return queue
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        """停止同步，并释放本进程执行中的任务（其他进程立即接手，已生成的图片不会重复生成）"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.store.flush()
+        async with self.pool.write() as db:
+            cursor = await db.execute(
+                "UPDATE jobs SET status = 'pending', owner = NULL, lease_until = NULL, updated_ts = ? "
+                "WHERE owner = ? AND status = 'generating'",
+                (time.time(), self.worker_id),
+            )
+        if cursor.rowcount:
+            print(f"🔁 已释放 {cursor.rowcount} 个执行中的任务，交给其他进程继续")
+
+    async def claim(self, key: str, limit: int) -> Optional[dict]:
+        """领取 key 队列中的下一个任务；没有可领取的任务，或该后端在所有进程中的执行数已达上限时返回 None"""
+        await self.store.flush()  # 本进程刚入队的任务先落盘
+        now = time.time()
+        params = {"key": key, "now": now, "owner": self.worker_id, "lease": now + self.lease_sec, "limit": limit}
+        # 先用读连接判断，避免空闲 worker 反复占用写锁
+        async with self.pool.read() as db:
+            waiting = await (await db.execute(f"SELECT EXISTS(SELECT 1 FROM jobs WHERE {CLAIMABLE_SQL})", params)).fetchone()
+            running = await (await db.execute(RUNNING_SQL, params)).fetchone()
+        if not waiting[0] or running[0] >= limit:
+            return None
+        async with self.pool.write(immediate=True) as db:
+            row = await (await db.execute(CLAIM_SQL, params)).fetchone()
+        return decode_row(row) if row is not None else None
+
+    async def owned(self, job_id: str) -> Optional[dict]:
+        """
+        任务仍由本进程执行时返回任务行（已解析），否则返回 None
+
+        领取之后、开始执行之前，任务可能已被其他进程取消，或租约过期后被其他进程接手
+        """
+        await self.store.flush()
+        async with self.pool.read() as db:
+            row = await (await db.execute(
+                "SELECT * FROM jobs WHERE job_id = ? AND status = 'generating' AND owner = ?",
+                (job_id, self.worker_id),
+            )).fetchone()
+        return decode_row(row) if row is not None else None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 共享队列同步失败: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def sync(self):
+        now = time.time()
+        await self.store.flush()
+        async with self.pool.write() as db:
+            await db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'generating'",
+                (now + self.lease_sec, self.worker_id),
+            )
+        async with self.pool.read() as db:
+            pending = await (await db.execute(
+                "SELECT job_id, queue_key FROM jobs WHERE status = 'pending' AND queue_key IS NOT NULL "
+                "ORDER BY priority, counter"
+            )).fetchall()
+            expired = await (await db.execute(
+                "SELECT DISTINCT queue_key FROM jobs WHERE status = 'generating' AND lease_until < ? "
+                "AND queue_key IS NOT NULL", (now,)
+            )).fetchall()
+            changed = await (await db.execute(
+                "SELECT * FROM jobs WHERE updated_ts > ? ORDER BY updated_ts", (self._since,)
+            )).fetchall()
+        self._since = now - SYNC_OVERLAP
+
+        orders: Dict[str, List[str]] = {}
+        for row in pending:
+            orders.setdefault(row["queue_key"], []).append(row["job_id"])
+        self.keys = set(orders) | {row[0] for row in expired}
+        for key, queue in self.queues.items():
+            queue._order = orders.get(key, [])
+            if key in self.keys:
+                queue._wakeup.set()
+        if self.on_sync is not None:
+            await self.on_sync([decode_row(row) for row in changed])
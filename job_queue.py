@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+带 job_id 索引的优先级任务队列
+
+- put / get / remove / set_priority 均为 O(log n)
+- 取消和置顶使用惰性删除：旧的堆条目只打标记，出队时跳过
+- position 通过树状数组计算排名，O(log n)，无需遍历队列；树状数组按 counter 的压缩序号索引，
+  大小只跟排队中的任务数有关，与 counter 的取值跨度无关（共享队列模式下 counter 是微秒时间戳）
+"""
+
+import asyncio
+import bisect
+import heapq
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class _Fenwick:
+    """树状数组：单点加减 + 前缀和"""
+
+    def __init__(self, size: int):
+        self.tree = [0] * (size + 1)
+
+    def add(self, i: int, delta: int):
+        i += 1
+        n = len(self.tree)
+        while i < n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i: int) -> int:
+        """[0, i) 区间之和"""
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+class JobQueue:
+    """
+    按 (priority, counter) 排序的异步任务队列，priority 越小越先执行，
+    相同 priority 按 counter（入队顺序）执行。接口与 asyncio.PriorityQueue 的 get/qsize 保持一致。
+    """
+
+    def __init__(self):
+        # 堆条目: [priority, counter, seq, job_id, job, removed]，seq 保证条目之间可比较
+        self._heap: List[list] = []
+        self._seq = 0
+        self._entries: Dict[str, list] = {}
+        self._removed = 0  # 堆中已失效的条目数
+        self._getters: deque = deque()
+        # 排名索引：每个 priority 一棵树状数组，下标为 counter 在 _keys 中的序号
+        self._keys: List[int] = []  # 已分配下标的 counter（升序，可能含已出队的）
+        self._capacity = 0
+        self._ranks: Dict[int, _Fenwick] = {}
+        self._level_sizes: Dict[int, int] = {}
+
+    # ---------- 基本操作 ----------
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._entries
+
+    def empty(self) -> bool:
+        return not self._entries
+
+    def put_nowait(self, job_id: str, priority: int, counter: int, job: Any):
+        """入队（job_id 已存在时覆盖原条目）"""
+        if job_id in self._entries:
+            self.remove(job_id)
+        self._seq += 1
+        entry = [priority, counter, self._seq, job_id, job, False]
+        self._rank_add(priority, counter, 1)
+        self._entries[job_id] = entry
+        heapq.heappush(self._heap, entry)
+        self._wakeup_next()
+
+    async def put(self, job_id: str, priority: int, counter: int, job: Any):
+        self.put_nowait(job_id, priority, counter, job)
+
+    def get_nowait(self) -> Tuple[int, int, Any]:
+        """取出优先级最高的任务，返回 (priority, counter, job)"""
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry[5]:
+                self._removed -= 1
+                continue
+            priority, counter, _, job_id, job, _ = entry
+            del self._entries[job_id]
+            self._rank_add(priority, counter, -1)
+            return priority, counter, job
+        raise asyncio.QueueEmpty
+
+    async def get(self) -> Tuple[int, int, Any]:
+        """等待并取出优先级最高的任务"""
+        while not self._entries:
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except BaseException:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                # 被唤醒后又被取消，把机会让给下一个等待者
+                if self._entries and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self.get_nowait()
+
+    def task_done(self):
+        """兼容 asyncio.Queue 接口，无需计数"""
+
+    # ---------- 索引操作 ----------
+
+    def remove(self, job_id: str) -> bool:
+        """按 job_id 删除（惰性删除），任务不在队列中时返回 False"""
+        entry = self._entries.pop(job_id, None)
+        if entry is None:
+            return False
+        entry[5] = True
+        self._removed += 1
+        self._rank_add(entry[0], entry[1], -1)
+        self._maybe_compact()
+        return True
+
+    def set_priority(self, job_id: str, priority: int) -> bool:
+        """修改排队中任务的优先级（保留原 counter），任务不在队列中时返回 False"""
+        entry = self._entries.get(job_id)
+        if entry is None:
+            return False
+        if entry[0] == priority:
+            return True
+        counter, job = entry[1], entry[4]
+        self.remove(job_id)
+        self.put_nowait(job_id, priority, counter, job)
+        return True
+
+    def get_job(self, job_id: str) -> Optional[Any]:
+        entry = self._entries.get(job_id)
+        return entry[4] if entry else None
+
+    def position(self, job_id: str) -> Optional[int]:
+        """任务在队列中的位置（从 1 开始），不在队列中返回 None"""
+        entry = self._entries.get(job_id)
+        if entry is None:
+            return None
+        priority, counter = entry[0], entry[1]
+        ahead = sum(size for level, size in self._level_sizes.items() if level < priority)
+        ahead += self._ranks[priority].prefix(bisect.bisect_left(self._keys, counter))
+        return ahead + 1
+
+    def positions(self) -> Dict[str, int]:
+        """所有排队任务的位置"""
+        return {job_id: self.position(job_id) for job_id in self._entries}
+
+    # ---------- 内部实现 ----------
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def _maybe_compact(self):
+        """失效条目超过一半时重建堆，避免堆无限膨胀"""
+        if not self._entries:
+            self._heap.clear()
+            self._removed = 0
+        elif self._removed > 64 and self._removed * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if not e[5]]
+            heapq.heapify(self._heap)
+            self._removed = 0
+
+    def _rank_add(self, priority: int, counter: int, delta: int):
+        """更新排名索引（调用时该条目尚未加入 / 已移出 _entries）"""
+        if delta > 0:
+            self._ensure_capacity(counter)
+        elif not self._entries:
+            # 队列已清空：重置下标
+            self._keys = []
+            self._capacity = 0
+            self._ranks.clear()
+            self._level_sizes.clear()
+            return
+        tree = self._ranks.get(priority)
+        if tree is None:
+            tree = self._ranks[priority] = _Fenwick(self._capacity)
+        tree.add(bisect.bisect_left(self._keys, counter), delta)
+        size = self._level_sizes.get(priority, 0) + delta
+        if size:
+            self._level_sizes[priority] = size
+        else:
+            self._level_sizes.pop(priority, None)
+            self._ranks.pop(priority, None)
+
+    def _ensure_capacity(self, counter: int):
+        """
+        为 counter 分配下标：比已有 counter 都大且还有空位时直接追加（正常入队的情况），
+        否则按排队中任务的 counter 重新压缩，容量取其数量的两倍，重建所有树状数组
+        """
+        keys = self._keys
+        i = bisect.bisect_left(keys, counter)
+        if i < len(keys) and keys[i] == counter:
+            return
+        if i == len(keys) and len(keys) < self._capacity:
+            keys.append(counter)
+            return
+        self._keys = sorted({e[1] for e in self._entries.values()} | {counter})
+        self._capacity = max(64, len(self._keys) * 2)
+        self._ranks = {}
+        for entry in self._entries.values():
+            tree = self._ranks.get(entry[0])
+            if tree is None:
+                tree = self._ranks[entry[0]] = _Fenwick(self._capacity)
+            tree.add(bisect.bisect_left(self._keys, entry[1]), 1)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+任务持久化（jobs 表）
+
+每个任务一行：状态、优先级、入队顺序、时间戳，以及重新入队所需的 job_data 和前端显示用的 info。
+进程重启后，状态仍是 pending / generating 的任务会被重新排队（见 app.recover_jobs）。
+多进程部署时这张表同时是共享队列（queue_key / owner / lease_until 列，见 job_broker.py）。
+
+写入合并提交（group commit）：同一时刻到达的多次写入在一个事务里提交，
+- add() 等待提交完成后返回，接口返回时任务已经落盘
+- update() 不等待，状态变化不阻塞队列和生成流程
+所有写入按调用顺序执行，同一任务的 add 一定先于它的 update。
+"""
+
+import asyncio
+import json
+import time
+from typing import List, Optional
+
+from db_pool import DBPool
+
+ACTIVE_STATUSES = ("pending", "generating")
+TERMINAL_STATUSES = ("completed", "error", "cancelled")
+JSON_FIELDS = ("info", "job_data")
+UPDATE_FIELDS = (
+    "status", "priority", "counter", "started_ts", "finished_ts", "error", "info", "job_data",
+    "batch_total", "queue_key", "owner", "lease_until",
+)
+# info 中不持久化的字段：结果从 images 表重建，其余为运行时状态
+VOLATILE_INFO = ("results", "progress", "followers", "leader", "job_data")
+
+
+def _encode(field: str, value):
+    return json.dumps(value, ensure_ascii=False) if field in JSON_FIELDS and value is not None else value
+
+
+def persistent_info(info: dict) -> dict:
+    """active_jobs 中的任务信息去掉运行时字段"""
+    return {k: v for k, v in info.items() if k not in VOLATILE_INFO}
+
+
+def decode_row(row) -> dict:
+    """jobs 行 -> dict，info / job_data 解析为 dict"""
+    job = dict(row)
+    for field in JSON_FIELDS:
+        job[field] = json.loads(job[field]) if job[field] else {}
+    return job
+
+
+class JobStore:
+    """jobs 表的读写，写入合并提交"""
+
+    def __init__(self, pool: DBPool):
+        self.pool = pool
+        self._pending: List[tuple] = []             # 待写入的 (sql, params)
+        self._batch: Optional[asyncio.Future] = None  # 待写入这一批提交后完成，结果为异常或 None
+        self._writer: Optional[asyncio.Task] = None
+
+    def _enqueue(self, sql: str, params: tuple) -> asyncio.Future:
+        self._pending.append((sql, params))
+        if self._batch is None:
+            self._batch = asyncio.get_running_loop().create_future()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_loop())
+        return self._batch
+
+    async def _write_loop(self):
+        while self._pending:
+            await asyncio.sleep(0)  # 让同一轮事件循环中的其他写入并入这一批
+            ops, self._pending = self._pending, []
+            batch, self._batch = self._batch, None
+            error = None
+            try:
+                async with self.pool.write() as db:
+                    for sql, params in ops:
+                        await db.execute(sql, params)
+            except Exception as e:
+                print(f"⚠️ 任务状态写入失败（{len(ops)} 条）: {e}")
+                error = e
+            batch.set_result(error)
+
+    async def add(self, job_id: str, info: dict, job_data: dict):
+        """登记新任务（pending），提交后返回"""
+        error = await self._enqueue(
+            "INSERT OR REPLACE INTO jobs (job_id, status, priority, counter, api_url, queued_ts, info, job_data, updated_ts) "
+            "VALUES (?, 'pending', ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, info.get("priority", 1), info.get("counter"), job_data["api_url"], info.get("queued_ts"),
+             _encode("info", persistent_info(info)), _encode("job_data", job_data), time.time()),
+        )
+        if error is not None:
+            raise error
+
+    def update(self, job_id: str, **fields):
+        """记录状态变化（不等待提交）；进入终态时自动记录 finished_ts"""
+        if fields.get("status") in TERMINAL_STATUSES:
+            fields.setdefault("finished_ts", time.time())
+        unknown = set(fields) - set(UPDATE_FIELDS)
+        if unknown:
+            raise ValueError(f"未知的任务字段: {', '.join(sorted(unknown))}")
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        self._enqueue(
+            f"UPDATE jobs SET {assignments}, updated_ts = ? WHERE job_id = ?",
+            (*(_encode(f, v) for f, v in fields.items()), time.time(), job_id),
+        )
+
+    async def flush(self):
+        """等待已提交的写入全部落盘"""
+        if self._writer is not None:
+            await asyncio.shield(self._writer)
+
+    async def close(self):
+        await self.flush()
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        await self.flush()
+        async with self.pool.read() as db:
+            row = await (await db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,))).fetchone()
+        return decode_row(row) if row else None
+
+    async def load_active(self, unqueued_only: bool = False) -> List[dict]:
+        """
+        未结束的任务，按 (priority, counter) 排序；info / job_data 已解析
+
+        unqueued_only: 只返回不在共享队列中的任务（单进程模式下留下的）
+        """
+        await self.flush()
+        async with self.pool.read() as db:
+            rows = await (await db.execute(
+                f"SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) "
+                + ("AND queue_key IS NULL " if unqueued_only else "")
+                + "ORDER BY priority, counter IS NULL, counter",
+                ACTIVE_STATUSES,
+            )).fetchall()
+        return [decode_row(row) for row in rows]
+
+    async def max_counter(self) -> int:
+        async with self.pool.read() as db:
+            row = await (await db.execute("SELECT MAX(counter) FROM jobs")).fetchone()
+        return row[0] if row[0] is not None else -1
+
+    async def prune(self, max_age: float) -> int:
+        """删除结束超过 max_age 秒的任务，返回删除的行数"""
+        async with self.pool.write() as db:
+            cursor = await db.execute(
+                f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(TERMINAL_STATUSES))}) AND finished_ts < ?",
+                (*TERMINAL_STATUSES, time.time() - max_age),
+            )
+            return cursor.rowcount
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Prometheus 文本格式指标（/metrics）
+
+不依赖 prometheus_client，只实现用到的三种类型：
+- Counter：单调递增计数
+- Gauge：当前值；可以设置 collect 回调，在抓取时现算（队列长度等状态量不占热路径）
+- Histogram：固定桶直方图
+
+热路径上的一次更新只是一次 dict 查找加一次加法（直方图多一次 bisect）。
+
+多进程部署时每个进程只有自己的计数：各进程用 snapshot() 导出带 worker 标签的样本，
+由 app 定期写入数据库，/metrics 用 merge_snapshots() 合并所有进程的快照输出。
+"""
+
+import json
+
+import asyncio
+import bisect
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "hunyuan_"
+
+# 直方图默认桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+GENERATION_BUCKETS = (1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+LOOP_LAG_INTERVAL = 0.5   # 事件循环延迟采样间隔（秒）
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "", const: str = "") -> str:
+    parts = [const] if const else []
+    parts += [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> Iterable[Tuple[str, Tuple[str, ...], str, float]]:
+        """(后缀, 标签值, 额外标签, 值)"""
+        return ()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def sample_lines(self, const: str = "") -> List[str]:
+        """const: 附加在每个样本上的固定标签（已格式化，如 worker="..."）"""
+        return [
+            f"{self.name}{suffix}{_format_labels(self.labels, values, extra, const)} {_format_value(value)}"
+            for suffix, values, extra, value in self.samples()
+        ]
+
+    def render(self) -> List[str]:
+        return self.header() + self.sample_lines()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield "_total", key, "", value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.collect = collect  # 返回 {标签值元组: 值}，设置后忽略 set()
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else self._values
+        for key, value in values.items():
+            yield "", tuple(str(v) for v in key), "", value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}  # 标签值 -> [各桶计数..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self):
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield "_bucket", key, f'le="{_format_value(float(bound))}"', cumulative
+            yield "_bucket", key, 'le="+Inf"', series[-1]
+            yield "_sum", key, "", round(series[-2], 6)
+            yield "_count", key, "", series[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def _add(self, metric: Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Gauge:
+        return self._add(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # 某个 collect 回调出错不影响其他指标
+                lines.append(f"# {metric.name} 采集失败: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, worker: str) -> str:
+        """本进程的全部样本（带 worker 标签），JSON：[[HELP/TYPE 行...], [样本行...]] 的列表"""
+        const = f'worker="{_escape(worker)}"'
+        metrics = []
+        for metric in self._metrics:
+            try:
+                metrics.append([metric.header(), metric.sample_lines(const)])
+            except Exception as e:
+                metrics.append([metric.header(), [f"# {metric.name} 采集失败: {_escape(e)}"]])
+        return json.dumps(metrics, ensure_ascii=False)
+
+
+def merge_snapshots(snapshots: Iterable[str]) -> str:
+    """合并多个进程的 snapshot()：同名指标的 HELP / TYPE 只输出一次，样本按 worker 标签区分"""
+    merged: Dict[str, Tuple[List[str], List[str]]] = {}
+    for snapshot in snapshots:
+        for header, samples in json.loads(snapshot):
+            merged.setdefault(header[0], (header, []))[1].extend(samples)
+    lines = []
+    for header, samples in merged.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ---------- 队列与任务 ----------
+QUEUE_WAIT = REGISTRY.histogram("queue_wait_seconds", "任务从提交到开始执行的排队时间", ("backend",), GENERATION_BUCKETS)
+JOBS = REGISTRY.counter("jobs", "结束的任务数（completed / failed / cancelled）", ("outcome",))
+IMAGES = REGISTRY.counter("images", "单张图片结果数（success / cached / error / cancelled）", ("outcome",))
+
+# ---------- 后端调用 ----------
+GENERATION = REGISTRY.histogram("generation_seconds", "单次成功生成请求耗时（上传 + 排队 + 生成 + 下载）",
+                                ("backend",), GENERATION_BUCKETS)
+BACKEND_ERRORS = REGISTRY.counter("backend_errors", "后端调用失败次数（按阶段分类，含随后重试成功的）",
+                                  ("backend", "phase"))
+UPLOAD_BYTES = REGISTRY.counter("upload_bytes", "上传到后端的字节数", ("backend",))
+DOWNLOAD_BYTES = REGISTRY.counter("download_bytes", "从后端下载的结果字节数", ("backend",))
+
+# ---------- 本地资源 ----------
+DB_WRITE = REGISTRY.histogram("db_write_seconds", "数据库写事务耗时（含等待写锁）")
+EVENT_LOOP_LAG = REGISTRY.histogram("event_loop_lag_seconds", "事件循环调度延迟",
+                                    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+
+async def monitor_event_loop(interval: float = LOOP_LAG_INTERVAL):
+    """定期 sleep 并测量实际唤醒比预期晚了多久（事件循环被阻塞的程度）"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(time.perf_counter() - start - interval, 0))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生成结果缓存
+
+seed >= 0 时生成结果由 (api_url, prompt, 参考图哈希, seed, image_size, width, height, steps) 唯一确定，
+相同请求直接复用缓存的图片，不再调用后端。
+
+- 缓存文件是 output 中结果文件的硬链接（不支持时复制），删除画廊记录不影响缓存
+- 每个结果一个 json 旁注（尺寸、生成信息），启动时扫描目录恢复索引
+- 总大小超过 max_bytes 时按 LRU 淘汰
+- 多进程共用缓存目录时（shared），命中时更新旁注的修改时间作为共同的 LRU 顺序
+  （图片是 output 中文件的硬链接，改它的修改时间会让缩略图缓存失效），
+  本进程索引中没有的键会再到目录里找一次（可能是其他进程刚写入的），并定期重新扫描目录校正总大小
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from image_encoder import ORIGINAL_FORMAT, OUTPUT_FORMATS, transcode_file
+
+SHARED_RESCAN_SEC = 30   # shared 模式下重新扫描目录的最短间隔
+ORPHAN_GRACE_SEC = 600   # shared 模式下没有旁注的文件超过这个时间才清理（其他进程可能已写好图片、还没写旁注）
+
+
+def result_key(api_url: str, prompt: str, ref_hashes: List[str], seed: int,
+               image_size: str, width: int, height: int, steps: int) -> str:
+    """生成参数的缓存键"""
+    params = [api_url.rstrip('/'), prompt, list(ref_hashes), seed, image_size, width, height, steps]
+    return hashlib.sha256(json.dumps(params, ensure_ascii=False).encode()).hexdigest()[:32]
+
+
+def link_or_copy(source: Path, target: Path):
+    """硬链接（同一文件系统，不占额外空间），失败时复制"""
+    tmp = target.with_name(f".{target.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+class CachedResult:
+    """缓存命中的结果，size 与 PIL Image 的同名属性一致"""
+
+    def __init__(self, key: str, path: Path, size: tuple, info: str):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.info = info
+
+
+class ResultCache:
+    """
+    按生成参数缓存结果图片
+
+    run: 执行阻塞函数的协程（通常是编码线程池），不指定时使用 asyncio.to_thread
+    shared: 缓存目录是否与其他进程共用
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int,
+                 run: Optional[Callable[..., Awaitable]] = None, shared: bool = False):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self._run = run or asyncio.to_thread
+        self._entries: "OrderedDict[str, CachedResult]" = OrderedDict()
+        self._sizes: dict = {}  # key -> 字节数
+        self._total = 0
+        self._scanned = 0.0  # 上次扫描目录的时间（monotonic）
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _read_entry(self, key: str) -> Optional[Tuple[float, CachedResult, int]]:
+        """读取旁注和对应的文件，返回 (旁注修改时间, 条目, 字节数)；不完整时返回 None"""
+        meta_path = self.cache_dir / f"{key}.json"
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            path = self.cache_dir / f"{key}{meta['ext']}"
+            nbytes = path.stat().st_size
+            mtime = meta_path.stat().st_mtime
+        except (OSError, ValueError, KeyError):
+            return None
+        return mtime, CachedResult(key, path, tuple(meta["size"]), meta.get("info", "")), nbytes
+
+    def _scan(self) -> List[Tuple[CachedResult, int]]:
+        """扫描缓存目录（阻塞），返回按修改时间排序的 (条目, 字节数)，并清理不完整的条目和残留的临时文件"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        found = []
+        for meta_path in self.cache_dir.glob("*.json"):
+            item = self._read_entry(meta_path.stem)
+            if item is None:
+                meta_path.unlink(missing_ok=True)
+                continue
+            found.append(item)
+        found.sort(key=lambda item: item[0])
+        keys = {entry.key for _, entry, _ in found}
+        # 没有旁注的孤立文件和残留的临时文件
+        now = time.time()
+        for f in self.cache_dir.iterdir():
+            if f.suffix == ".json" or not (f.name.startswith(".") or f.stem not in keys):
+                continue
+            try:
+                if f.is_file() and (not self.shared or now - f.stat().st_mtime > ORPHAN_GRACE_SEC):
+                    f.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+        return [(entry, nbytes) for _, entry, nbytes in found]
+
+    def _apply_scan(self, found: List[Tuple[CachedResult, int]]):
+        self._entries.clear()
+        self._sizes.clear()
+        self._total = 0
+        for entry, nbytes in found:
+            self._add(entry, nbytes)
+        self._scanned = time.monotonic()
+
+    def load(self):
+        """扫描缓存目录恢复索引（按修改时间恢复 LRU 顺序）"""
+        self._apply_scan(self._scan())
+        self._evict()
+
+    def lookup(self, key: str) -> Optional[CachedResult]:
+        """查找缓存并计入命中 / 未命中"""
+        entry = self._entries.get(key)
+        if entry is not None and self.shared and not self._touch(entry):
+            self._forget(key)  # 已被其他进程淘汰
+            entry = None
+        elif entry is None and self.shared:
+            item = self._read_entry(key)  # 其他进程写入的
+            if item is not None:
+                entry = item[1]
+                self._add(entry, item[2])
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    async def store(self, key: str, source: Path, size: tuple, info: str):
+        """把刚保存的结果文件加入缓存"""
+        if not self.enabled or key in self._entries:
+            return
+        source = Path(source)
+        path = self.cache_dir / f"{key}{source.suffix}"
+        meta = {"ext": source.suffix, "size": list(size), "info": info}
+        nbytes = await self._run(self._write, source, path, meta)
+        self._add(CachedResult(key, path, tuple(size), info), nbytes)
+        if self.shared and time.monotonic() - self._scanned >= SHARED_RESCAN_SEC:
+            self._scanned = time.monotonic()
+            self._apply_scan(await self._run(self._scan))
+        self._evict(keep=key)
+
+    def _write(self, source: Path, path: Path, meta: dict) -> int:
+        link_or_copy(source, path)
+        meta_path = path.with_suffix(".json")
+        tmp = meta_path.with_name(f".{meta_path.name}.tmp")
+        tmp.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, meta_path)
+        return path.stat().st_size
+
+    def _add(self, entry: CachedResult, nbytes: int):
+        self._forget(entry.key)
+        self._entries[entry.key] = entry
+        self._sizes[entry.key] = nbytes
+        self._total += nbytes
+
+    def _evict(self, keep: Optional[str] = None):
+        while self._total > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            if key == keep:
+                break
+            self.discard(key)
+
+    def _forget(self, key: str) -> Optional[CachedResult]:
+        """只从索引中移除"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total -= self._sizes.pop(key, 0)
+        return entry
+
+    @staticmethod
+    def _touch(entry: CachedResult) -> bool:
+        """把访问时间记到旁注的修改时间上（各进程扫描时据此恢复 LRU 顺序）；已被删除时返回 False"""
+        try:
+            os.utime(entry.path.with_suffix(".json"))
+        except FileNotFoundError:
+            return False
+        return entry.path.is_file()
+
+    def discard(self, key: str):
+        entry = self._forget(key)
+        if entry is None:
+            return
+        entry.path.unlink(missing_ok=True)
+        entry.path.with_suffix(".json").unlink(missing_ok=True)
+
+    def _materialize(self, entry: CachedResult, directory: Path, stem: str, fmt: str) -> str:
+        ext = entry.path.suffix
+        wanted = None if fmt == ORIGINAL_FORMAT else OUTPUT_FORMATS.get(fmt, OUTPUT_FORMATS["png"])[1]
+        if wanted is not None and wanted != ext:
+            return transcode_file(entry.path, directory, stem, fmt)
+        filename = f"{stem}{ext}"
+        link_or_copy(entry.path, Path(directory) / filename)
+        return filename
+
+    async def materialize(self, entry: CachedResult, directory: Path, stem: str, fmt: str) -> str:
+        """把缓存结果放到 directory/stem.<ext>（格式不同时重新编码），返回文件名"""
+        return await self._run(self._materialize, entry, directory, stem, fmt)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries), "bytes": self._total, "max_bytes": self.max_bytes,
+            "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
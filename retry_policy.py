@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后端调用的重试 / 对冲 / 熔断策略
+
+- 重试：只重试 BackendError.retryable 的失败（加入队列失败、SSE 中断、下载失败等），
+  最多 max_attempts 次，间隔为带随机抖动的指数退避
+- 对冲：单次尝试超过 hedge_after 秒仍未完成时，在另一个后端上再发起一次同样的请求，
+  先成功的胜出，另一个立即取消（只在池中有多个后端时启用）
+- 熔断：每个后端一个 CircuitBreaker，连续失败 BREAKER_FAILURES 次后打开，冷却期内不再分配请求；
+  冷却结束进入半开状态，只放行一个试探请求，成功则关闭，失败则重新打开并加倍冷却时间
+"""
+
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from api_client import BackendError
+
+BREAKER_FAILURES = 5        # 连续失败几次打开熔断（并发请求的失败也算连续）
+BREAKER_COOLDOWN = 30       # 首次打开的冷却时间（秒）
+BREAKER_MAX_COOLDOWN = 300
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(BackendError):
+    """池中所有后端都处于熔断状态（快速失败，不再排队等待超时）"""
+    phase = "circuit_open"
+
+    def __init__(self, message: str):
+        super().__init__(message, retryable=False)
+
+
+class CircuitBreaker:
+    """单个后端的熔断器：closed -> open -> half_open -> closed / open"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN):
+        self.threshold = failures
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = self.CLOSED
+        self.failures = 0           # 连续失败次数
+        self.cooldown = cooldown
+        self.open_until = 0.0
+        self._trial = False         # 半开状态下是否已有试探请求在途
+
+    def allows(self) -> bool:
+        """当前是否可以分配请求"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() >= self.open_until
+        return not self._trial
+
+    def on_acquire(self):
+        """分配了一个请求（冷却结束后的第一个请求作为半开试探）"""
+        if self.state == self.OPEN and time.monotonic() >= self.open_until:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self._trial = True
+
+    def record(self, ok: Optional[bool]) -> bool:
+        """
+        记录请求结果，ok 为 None 表示请求被取消（不计入）
+
+        Returns:
+            熔断器是否因这次失败而打开
+        """
+        if ok is None:
+            self._trial = False
+            return False
+        if ok:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self._trial = False
+            return False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.state = self.OPEN
+            self.open_until = time.monotonic() + self.cooldown
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self._trial = False
+            return True
+        return False
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": max(round(self.open_until - time.monotonic(), 1), 0) if self.state == self.OPEN else 0,
+        }
+
+
+class RetryPolicy:
+    """
+    有限次重试 + 可选对冲
+
+    Args:
+        max_attempts: 每次调用最多尝试几次（含第一次）
+        base_delay / max_delay: 指数退避的基数和上限（秒），实际等待在 [0, 退避值] 内随机（full jitter）
+        hedge_after: 单次尝试超过多少秒发起对冲请求，None / 0 表示不对冲
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 20.0,
+                 hedge_after: Optional[float] = None):
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次失败后的等待时间"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    async def run(self, attempt: Callable[[], Awaitable[T]], hedge: bool = False, label: str = "",
+                  discard: Optional[Callable[[T], None]] = None) -> T:
+        """
+        按策略执行 attempt（每次调用都应重新选择后端）
+
+        Args:
+            attempt: 发起一次完整请求的协程函数
+            hedge: 是否允许对冲（池中只有一个后端时对冲没有意义）
+            label: 日志前缀
+            discard: 对冲时未被采用的成功结果交给它清理（如删除已下载的文件）
+        """
+        n = 1
+        while True:
+            try:
+                if hedge and self.hedge_after:
+                    return await self._hedged(attempt, label, discard)
+                return await attempt()
+            except BackendError as e:
+                if not e.retryable or n >= self.max_attempts:
+                    raise
+                delay = self.backoff(n)
+                print(f"🔁 {label}{e.phase} 失败，{delay:.1f}s 后重试（{n}/{self.max_attempts - 1}）: {e}")
+                await asyncio.sleep(delay)
+                n += 1
+
+    async def _hedged(self, attempt: Callable[[], Awaitable[T]], label: str,
+                      discard: Optional[Callable[[T], None]]) -> T:
+        """超过 hedge_after 仍未完成时再发起一次，取先成功的结果，其余成功结果交给 discard"""
+        tasks = {asyncio.ensure_future(attempt())}
+        started = list(tasks)
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                print(f"🪁 {label}{self.hedge_after}s 未完成，发起对冲请求")
+                tasks.add(asyncio.ensure_future(attempt()))
+                started = list(tasks)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 同一轮一起完成的、或来不及取消就已成功的另一次尝试，其结果不会被采用
+            for task in started:
+                if task is winner or task.cancelled() or task.exception() is not None:
+                    continue
+                print(f"🗑️ {label}丢弃对冲中未采用的结果")
+                if discard:
+                    discard(task.result())
@@ -18,6 +18,9 @@ const state = {
     serverPrice: 0,
     activeTasks: {},   // {taskId: {prompt, count, startedTs, status}}
     compactView: false, // 紧凑视图
+    historyRevision: null, // 画廊已同步到的 revision，null 表示需要全量加载
+    historyCursor: null,   // 下一页游标，null 表示已加载到末尾
+    historyLoadingMore: false,
 };
 
 // 根据比例和分辨率计算宽高
@@ -697,8 +700,10 @@ async function executeTask(taskId, params) {
             renderActiveTasks();
         }
         
-        // 启动轮询
+        // 启动事件订阅（或轮询）
         startTaskPolling();
+        // 事件可能在拿到 job_id 之前就已推送，补一次当前状态
+        if (jobEvents) refreshJob(taskId);
 
     } catch(e) {
         // 解析错误类型
@@ -744,11 +749,16 @@ async function retryTask(taskId) {
     await executeTask(taskId, task.params);
 }
 
-// 轮询相关
+// 任务状态推送：优先订阅 /api/events（SSE），不支持时退回轮询
+let jobEvents = null;
 let pollingTimer = null;
-const POLL_INTERVAL = 2000;  // 2秒轮询一次
+const POLL_INTERVAL = 2000;  // 轮询模式下 2 秒一次
 
 function startTaskPolling() {
+    if (window.EventSource) {
+        startJobEvents();
+        return;
+    }
     if (pollingTimer) return;  // 已经在轮询
     pollingTimer = setInterval(pollJobs, POLL_INTERVAL);
     pollJobs();  // 立即执行一次
@@ -761,6 +771,196 @@ function stopTaskPolling() {
     }
 }
 
+function findTaskByJobId(jobId) {
+    for (const [taskId, task] of Object.entries(state.activeTasks)) {
+        if (task.jobId === jobId) return [taskId, task];
+    }
+    return [null, null];
+}
+
+function startJobEvents() {
+    if (jobEvents) return;
+    jobEvents = new EventSource('/api/events');
+    const on = (name, handler) => jobEvents.addEventListener(name, (e) => {
+        try {
+            handler(JSON.parse(e.data));
+            renderActiveTasks();
+        } catch (err) {
+            console.error(`[Events] 处理 ${name} 失败:`, err);
+        }
+    });
+    
+    // 连接（或自动重连）后的全量快照
+    on('snapshot', (data) => {
+        const jobMap = {};
+        data.jobs.forEach(j => jobMap[j.job_id] = j);
+        for (const [taskId, task] of Object.entries(state.activeTasks)) {
+            if (!task.jobId) continue;
+            const serverJob = jobMap[task.jobId];
+            if (serverJob) {
+                applyServerJob(taskId, task, serverJob);
+            } else {
+                handleJobGone(taskId, task);
+            }
+        }
+    });
+    on('positions', (data) => {
+        for (const [jobId, position] of Object.entries(data.positions)) {
+            const [, task] = findTaskByJobId(jobId);
+            if (task && !task.startedTs) {
+                task.queuePosition = position;
+                task.status = `排队中 #${position}`;
+            }
+        }
+    });
+    on('started', (data) => {
+        const [, task] = findTaskByJobId(data.job_id);
+        if (!task) return;
+        task.startedTs = data.started_ts;
+        task.status = '正在生成...';
+    });
+    on('image', (data) => {
+        const [, task] = findTaskByJobId(data.job_id);
+        if (!task) return;
+        addTaskResults(task, [data.result]);
+        task.completed = data.completed;
+        task.status = `已完成 ${task.completed}/${task.count}`;
+    });
+    // 上游 Gradio 的排队位置 / 步数进度
+    on('progress', (data) => {
+        const [, task] = findTaskByJobId(data.job_id);
+        if (!task || !task.startedTs) return;
+        const done = `${task.completed || 0}/${task.count}`;
+        if (data.stage === 'queued' && data.rank != null) {
+            task.status = `上游排队 #${data.rank + 1} (${done})`;
+        } else if (data.stage === 'generating' && data.steps) {
+            task.status = `生成中 ${done} · 步数 ${data.step}/${data.steps}`;
+        }
+    });
+    on('finished', (data) => {
+        const [taskId, task] = findTaskByJobId(data.job_id);
+        if (task) finishTask(taskId, task, data.batch_total || 0);
+    });
+    on('cancelled', (data) => {
+        const [taskId, task] = findTaskByJobId(data.job_id);
+        if (task) endTask(taskId, task);
+    });
+    on('failed', (data) => {
+        const [taskId, task] = findTaskByJobId(data.job_id);
+        if (task) endTask(taskId, task, data.error || '生成失败', 'error');
+    });
+}
+
+// 把新完成的图片加入画廊（尚未入库的占位记录，下次同步时被真实记录替换）
+function addTaskResults(task, results) {
+    if (!results.length) return;
+    for (const r of results) {
+        state.history.unshift({
+            id: Date.now() + Math.random(),
+            filename: r.filename,
+            url: r.url,
+            urls: r.urls,
+            prompt: task.prompt,
+            info: r.info,
+            duration_sec: r.duration || 0,
+            batch_count: task.count,
+            seed: r.seed,
+            created_at: new Date().toISOString(),
+            width: task.width,
+            height: task.height,
+            ref_images: task.refImages || null,  // 垫图列表
+        });
+    }
+    renderGallery();
+}
+
+// 服务端已无此任务，说明已完成（被过滤掉了）
+function handleJobGone(taskId, task) {
+    console.log('[Poll] 任务已完成，从服务端消失:', task.jobId);
+    toast(`完成: ${task.prompt.slice(0, 20)}...`);
+    removeTask(taskId);
+    loadHistory();
+}
+
+function finishTask(taskId, task, batchTotal) {
+    // 回填 batch_total_sec
+    state.history.forEach(h => {
+        if (!h._batchDone && h.prompt === task.prompt) {
+            h.batch_total_sec = batchTotal;
+            h.batch_count = task.count;
+            h._batchDone = true;
+        }
+    });
+    renderGallery();
+    
+    const costStr = calcBatchCost(batchTotal, task.count);
+    toast(`完成: ${task.prompt.slice(0, 20)}... (${fmtSec(Math.round(batchTotal))}${costStr ? ', ' + costStr : ''})`);
+    
+    // 通知服务端确认完成
+    fetch(`/api/job/${task.jobId}/ack`, { method: 'POST' }).catch(() => {});
+    
+    removeTask(taskId);
+    loadHistory();
+}
+
+// 任务失败 / 取消：和完成一样确认并移出任务列表，已生成的图片留在画廊里
+function endTask(taskId, task, message, type) {
+    if (message) toast(message, type);
+    fetch(`/api/job/${task.jobId}/ack`, { method: 'POST' }).catch(() => {});
+    removeTask(taskId);
+    loadHistory();
+}
+
+// 用服务端的完整任务状态更新本地任务（轮询和快照共用）
+function applyServerJob(taskId, task, serverJob) {
+    const prevCompleted = task.completed || 0;
+    task.startedTs = serverJob.started_ts;
+    task.completed = serverJob.completed || 0;
+    
+    if (serverJob.status === 'pending') {
+        task.queuePosition = serverJob.queue_position;
+        task.status = serverJob.queue_position ? `排队中 #${serverJob.queue_position}` : '排队中...';
+    } else if (serverJob.status === 'generating') {
+        if (task.completed > 0) {
+            task.status = `已完成 ${task.completed}/${task.count}`;
+        } else {
+            task.status = '正在生成...';
+        }
+    } else if (serverJob.status === 'completed') {
+        task.status = '完成';
+    } else if (serverJob.status === 'error') {
+        task.status = '失败';
+    }
+    
+    // 处理新完成的结果
+    const newResults = serverJob.results || [];
+    addTaskResults(task, newResults.slice(prevCompleted));
+    
+    // 任务结束
+    if (serverJob.status === 'completed') {
+        finishTask(taskId, task, serverJob.batch_total || 0);
+    } else if (serverJob.status === 'error') {
+        endTask(taskId, task, serverJob.error || '生成失败', 'error');
+    } else if (serverJob.status === 'cancelled') {
+        endTask(taskId, task);
+    }
+}
+
+async function refreshJob(taskId) {
+    const task = state.activeTasks[taskId];
+    if (!task || !task.jobId) return;
+    try {
+        const resp = await fetch(`/api/job/${task.jobId}`);
+        const result = await resp.json();
+        if (result.success && state.activeTasks[taskId]) {
+            applyServerJob(taskId, task, result.data);
+            renderActiveTasks();
+        }
+    } catch (e) {
+        console.error('刷新任务失败:', e);
+    }
+}
+
 async function pollJobs() {
     const activeTasks = Object.entries(state.activeTasks);
     if (activeTasks.length === 0) {
@@ -773,9 +973,8 @@ async function pollJobs() {
         const result = await resp.json();
         if (!result.success) return;
         
-        const serverJobs = result.data;
         const jobMap = {};
-        serverJobs.forEach(j => jobMap[j.job_id] = j);
+        result.data.forEach(j => jobMap[j.job_id] = j);
         
         // 更新每个本地任务状态
         for (const [taskId, task] of activeTasks) {
@@ -783,80 +982,10 @@ async function pollJobs() {
             
             const serverJob = jobMap[task.jobId];
             if (!serverJob) {
-                // 服务端已无此任务，说明已完成（被过滤掉了）
-                console.log('[Poll] 任务已完成，从服务端消失:', task.jobId);
-                toast(`完成: ${task.prompt.slice(0, 20)}...`);
-                removeTask(taskId);
-                loadHistory();
+                handleJobGone(taskId, task);
                 continue;
             }
-            
-            // 更新状态
-            const prevCompleted = task.completed || 0;
-            task.startedTs = serverJob.started_ts;
-            task.completed = serverJob.completed || 0;
-            
-            if (serverJob.status === 'pending') {
-                task.status = '排队中...';
-            } else if (serverJob.status === 'generating') {
-                if (task.completed > 0) {
-                    task.status = `已完成 ${task.completed}/${task.count}`;
-                } else {
-                    task.status = '正在生成...';
-                }
-            } else if (serverJob.status === 'completed') {
-                task.status = '完成';
-            } else if (serverJob.status === 'error') {
-                task.status = '失败';
-                toast(serverJob.error || '生成失败', 'error');
-            }
-            
-            // 处理新完成的结果
-            const newResults = serverJob.results || [];
-            if (newResults.length > prevCompleted) {
-                for (let i = prevCompleted; i < newResults.length; i++) {
-                    const r = newResults[i];
-                    state.history.unshift({
-                        id: Date.now() + Math.random(),
-                        filename: r.filename,
-                        url: r.url,
-                        prompt: task.prompt,
-                        info: r.info,
-                        duration_sec: r.duration || 0,
-                        batch_count: task.count,
-                        seed: r.seed,
-                        created_at: new Date().toISOString(),
-                        width: task.width,
-                        height: task.height,
-                        ref_images: task.refImages || null,  // 垫图列表
-                    });
-                }
-                renderGallery();
-            }
-            
-            // 任务完成
-            if (serverJob.status === 'completed') {
-                const batchTotal = serverJob.batch_total || 0;
-                
-                // 回填 batch_total_sec
-                state.history.forEach(h => {
-                    if (!h._batchDone && h.prompt === task.prompt) {
-                        h.batch_total_sec = batchTotal;
-                        h.batch_count = task.count;
-                        h._batchDone = true;
-                    }
-                });
-                renderGallery();
-                
-                const costStr = calcBatchCost(batchTotal, task.count);
-                toast(`完成: ${task.prompt.slice(0, 20)}... (${fmtSec(Math.round(batchTotal))}${costStr ? ', ' + costStr : ''})`);
-                
-                // 通知服务端确认完成
-                fetch(`/api/job/${task.jobId}/ack`, { method: 'POST' }).catch(() => {});
-                
-                removeTask(taskId);
-                loadHistory();
-            }
+            applyServerJob(taskId, task, serverJob);
         }
         
         renderActiveTasks();
@@ -1168,19 +1297,118 @@ document.addEventListener('click', (e) => {
 
 // ============ 历史 ============
 
+// 画廊卡片使用缩略图，点开后再加载原图
+function thumbnailUrl(item, fallback) {
+    return (item.urls && item.urls.thumb) || fallback;
+}
+
+function isGalleryItem(item) {
+    return item.status === 'completed' && item.filename;
+}
+
+function compareHistory(a, b) {
+    // 本地占位记录（尚未入库）没有 sort_order，排在最前面
+    const sa = a.sort_order ?? -Infinity;
+    const sb = b.sort_order ?? -Infinity;
+    return sa !== sb ? sa - sb : a.id - b.id;
+}
+
 async function loadHistory() {
     try {
-        const resp = await fetch('/api/history');
+        if (state.historyRevision !== null) {
+            await syncHistory();
+            return;
+        }
+        // 首次加载：第一页，列表视图不需要 info 字段
+        const resp = await fetch('/api/history?fields=list');
         const result = await resp.json();
         if (result.success) {
-            state.history = result.data.filter(item => item.status === 'completed' && item.filename);
+            state.history = result.data.filter(isGalleryItem);
+            state.historyRevision = result.revision;
+            state.historyCursor = result.next_cursor;
             renderGallery();
+            if (state.historyCursor && galleryMoreVisible()) loadMoreHistory();
         }
     } catch(e) {
         console.error('加载历史失败:', e);
     }
 }
 
+// 加载下一页（画廊滚动到底部附近时触发）
+async function loadMoreHistory() {
+    if (!state.historyCursor || state.historyLoadingMore) return;
+    state.historyLoadingMore = true;
+    try {
+        const resp = await fetch(`/api/history?fields=list&cursor=${encodeURIComponent(state.historyCursor)}`);
+        const result = await resp.json();
+        if (!result.success) return;
+        const known = new Set(state.history.map(item => item.id));
+        const rows = result.data.filter(row => isGalleryItem(row) && !known.has(row.id));
+        state.history = [...state.history, ...rows].sort(compareHistory);
+        state.historyCursor = result.next_cursor;
+        renderGallery();
+    } catch (e) {
+        console.error('加载更多历史失败:', e);
+    } finally {
+        state.historyLoadingMore = false;
+    }
+    // 一页不足以填满屏幕时继续加载
+    if (state.historyCursor && galleryMoreVisible()) loadMoreHistory();
+}
+
+const GALLERY_MORE_MARGIN = 600;  // 距离底部多少像素时开始加载下一页
+
+function galleryMoreVisible() {
+    const sentinel = $('#gallery-more');
+    return sentinel && sentinel.getBoundingClientRect().top < window.innerHeight + GALLERY_MORE_MARGIN;
+}
+
+function initGalleryPaging() {
+    const sentinel = $('#gallery-more');
+    if (!sentinel) return;
+    new IntersectionObserver((entries) => {
+        if (entries.some(e => e.isIntersecting)) loadMoreHistory();
+    }, { rootMargin: `0px 0px ${GALLERY_MORE_MARGIN}px 0px` }).observe(sentinel);
+}
+
+// 增量同步：只拉取上次同步之后新增 / 修改 / 排序变化 / 删除的记录
+async function syncHistory() {
+    let changed = false;
+    let hasMore = true;
+    while (hasMore) {
+        const resp = await fetch(`/api/history?since=${state.historyRevision}&fields=list`);
+        const result = await resp.json();
+        if (!result.success) return;
+        
+        const deleted = new Set(result.deleted);
+        const byId = new Map(state.history.map(item => [item.id, item]));
+        const byFilename = new Map(state.history.map(item => [item.filename, item]));
+        // 未加载完所有页时，只接收落在已加载范围内的记录
+        const loaded = state.history.filter(item => item.sort_order != null);
+        const lastOrder = state.historyCursor && loaded.length ? loaded[loaded.length - 1].sort_order : Infinity;
+        
+        for (const row of result.data) {
+            const existing = byId.get(row.id) || byFilename.get(row.filename);
+            if (existing) {
+                byId.delete(existing.id);
+                byFilename.delete(existing.filename);
+            }
+            if (isGalleryItem(row) && (existing || row.sort_order <= lastOrder)) {
+                byId.set(row.id, existing ? { ...existing, ...row } : row);
+            }
+        }
+        for (const id of deleted) byId.delete(id);
+        
+        if (result.data.length || deleted.size) {
+            state.history = [...byId.values()].sort(compareHistory);
+            changed = true;
+        }
+        state.historyRevision = result.revision;
+        hasMore = result.has_more;
+    }
+    if (changed) renderGallery();
+}
+
 function renderGallery() {
     const items = state.history;
     const hasActiveTasks = Object.keys(state.activeTasks).length > 0;
@@ -1207,6 +1435,7 @@ function renderGallery() {
 
     dom.gallery.innerHTML = items.map(item => {
         const url = item.url || `/output/${item.filename}`;
+        const thumbUrl = thumbnailUrl(item, url);
         const time = formatTime(item.created_at);
         const prompt = item.prompt || '';
         const duration = item.duration_sec ? fmtSec(Math.round(item.duration_sec)) : '';
@@ -1239,7 +1468,7 @@ function renderGallery() {
         return `
             <div class="card" data-id="${item.id}" draggable="true">
                 <div class="card-image">
-                    <img src="${url}" alt="${escapeHtml(prompt)}" loading="lazy" onclick="openModal('${safeUrl}', ${item.id})">
+                    <img src="${thumbUrl}" alt="${escapeHtml(prompt)}" loading="lazy" onclick="openModal('${safeUrl}', ${item.id})">
                     <button class="card-delete-btn" onclick="deleteImage(${item.id}, event)" title="删除">
                         <svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><polyline points="3 6 5 6 21 6"/><path d="M19 6v14a2 2 0 0 1-2 2H7a2 2 0 0 1-2-2V6m3 0V4a2 2 0 0 1 2-2h4a2 2 0 0 1 2 2v2"/></svg>
                     </button>
@@ -1941,6 +2170,7 @@ function renderGalleryForSelectMode() {
     
     dom.gallery.innerHTML = items.map(item => {
         const url = item.url || `/output/${item.filename}`;
+        const thumbUrl = thumbnailUrl(item, url);
         const prompt = item.prompt || '';
         const selectedIndex = galleryMode.selectedImages.findIndex(img => img.id === item.id);
         const isSelected = selectedIndex >= 0;
@@ -1951,7 +2181,7 @@ function renderGalleryForSelectMode() {
         return `
             <div class="${cardClass}" data-id="${item.id}" data-url="${escapeAttr(url)}" data-prompt="${escapeAttr(prompt)}" onclick="toggleImageSelect(${item.id}, this)">
                 <div class="card-image">
-                    <img src="${url}" alt="${escapeHtml(prompt)}" loading="lazy">
+                    <img src="${thumbUrl}" alt="${escapeHtml(prompt)}" loading="lazy">
                     <div class="select-badge">
                         <span class="select-badge-num">${isSelected ? selectedIndex + 1 : ''}</span>
                     </div>
@@ -3942,9 +4172,9 @@ function initGalleryDrag() {
                     state.history.splice(newTargetIndex + 1, 0, draggedItem);
                 }
                 
-                // 重新渲染并保存
+                // 重新渲染并保存（单次拖拽只提交移动操作）
                 renderGallery();
-                await saveGalleryOrder();
+                await saveGalleryMove(draggedItem);
             }
         }
         
@@ -3961,8 +4191,11 @@ function initGalleryDrag() {
     });
 }
 
+// 提交已加载部分的完整顺序（未加载的记录服务端保持原顺序排在后面）
 async function saveGalleryOrder() {
-    const order = state.history.map(item => item.id);
+    // 尚未入库的占位记录没有真实 id，等同步后由真实记录替换
+    const order = state.history.filter(item => item.sort_order != null).map(item => item.id);
+    if (!order.length) return;
     try {
         const res = await fetch('/api/reorder', {
             method: 'POST',
@@ -3972,6 +4205,41 @@ async function saveGalleryOrder() {
         const data = await res.json();
         if (!data.success) {
             console.error('保存排序失败:', data.error);
+            return;
+        }
+        // 服务端重新编号了 sort_order，同步最新值
+        await loadHistory();
+    } catch (err) {
+        console.error('保存排序失败:', err);
+    }
+}
+
+// 把单张图片的新位置提交给服务端：只发送相邻两张的 id，服务端通常只改一行
+async function saveGalleryMove(item) {
+    if (item.sort_order == null) {
+        // 尚未入库的占位记录，退回完整顺序提交
+        await saveGalleryOrder();
+        return;
+    }
+    const persisted = state.history.filter(h => h.sort_order != null);
+    const index = persisted.indexOf(item);
+    const after = index > 0 ? persisted[index - 1].id : null;
+    const before = index < persisted.length - 1 ? persisted[index + 1].id : null;
+    try {
+        const res = await fetch('/api/reorder', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ move: { id: item.id, after, before } })
+        });
+        const data = await res.json();
+        if (!data.success) {
+            console.error('保存排序失败:', data.error);
+            return;
+        }
+        item.sort_order = data.sort_order;
+        if (data.rebalanced) {
+            // 服务端重新编号了全部记录，同步最新的 sort_order
+            await loadHistory();
         }
     } catch (err) {
         console.error('保存排序失败:', err);
@@ -4096,4 +4364,5 @@ document.addEventListener('DOMContentLoaded', () => {
     initKeyboardShortcuts();
     initGalleryDrag();
     initGalleryImport();
+    initGalleryPaging();
 });
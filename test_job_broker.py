@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""job_broker：两个“进程”（各自的连接池和 JobStore）共用一个数据库时的领取、并发上限、租约和同步"""
+
+import asyncio
+import time
+
+from app import _migrate_jobs, _migrate_shared_queue
+from db_pool import DBPool
+from job_broker import SQLiteJobBroker
+from job_store import JobStore
+
+KEY = "http://backend"
+
+
+class Worker:
+    """一个进程的连接池、JobStore 和 broker"""
+
+    def __init__(self, path, worker_id: str, lease_sec: float = 30):
+        self.pool = DBPool(path, readers=1)
+        self.store = JobStore(self.pool)
+        self.synced = []
+        self.broker = SQLiteJobBroker(self.store, worker_id, on_sync=self._on_sync, lease_sec=lease_sec)
+
+    async def _on_sync(self, rows):
+        self.synced.extend(rows)
+
+    async def open(self):
+        await self.pool.open()
+        async with self.pool.write() as db:
+            await _migrate_jobs(db)
+            await _migrate_shared_queue(db)
+        return self
+
+    async def close(self):
+        await self.broker.close()
+        await self.store.close()
+        await self.pool.close()
+
+    async def submit(self, job_id: str, priority: int = 1, counter: int = 0, limit: int = 1):
+        job_data = {"api_url": KEY, "count": 1}
+        await self.store.add(job_id, {"priority": priority, "counter": counter, "queued_ts": time.time()}, job_data)
+        self.broker.queue(KEY, limit).put_nowait(job_id, priority, counter, job_data)
+        await self.store.flush()
+
+    async def row(self, job_id: str) -> dict:
+        return await self.store.get(job_id)
+
+
+def two_workers(lease_sec: float = 30):
+    """在同一个数据库上启动两个 Worker 运行 test(a, b)"""
+    def decorate(test):
+        def wrapper(tmp_path):
+            async def main():
+                path = tmp_path / "jobs.db"
+                a = await Worker(path, "a", lease_sec).open()
+                b = await Worker(path, "b", lease_sec).open()
+                try:
+                    await test(a, b)
+                finally:
+                    await a.close()
+                    await b.close()
+            asyncio.run(main())
+        wrapper.__name__ = test.__name__
+        return wrapper
+    return decorate
+
+
+@two_workers()
+async def test_claims_in_priority_then_counter_order(a, b):
+    await a.submit("late", priority=1, counter=2, limit=3)
+    await a.submit("early", priority=1, counter=1, limit=3)
+    await a.submit("urgent", priority=0, counter=3, limit=3)
+    claimed = [(await b.broker.claim(KEY, 3))["job_id"] for _ in range(3)]
+    assert claimed == ["urgent", "early", "late"]
+    assert await b.broker.claim(KEY, 3) is None
+    row = await a.row("early")
+    assert row["status"] == "generating"
+    assert row["owner"] == "b"
+    assert row["lease_until"] > time.time()
+
+
+@two_workers()
+async def test_backend_limit_applies_across_processes(a, b):
+    await a.submit("j1", counter=1)
+    await a.submit("j2", counter=2)
+    assert (await a.broker.claim(KEY, 1))["job_id"] == "j1"
+    assert await b.broker.claim(KEY, 1) is None       # a 占满了上限
+    a.store.update("j1", status="completed")
+    await a.store.flush()
+    assert (await b.broker.claim(KEY, 1))["job_id"] == "j2"
+
+
+@two_workers()
+async def test_removed_job_is_not_claimable(a, b):
+    await a.submit("j1")
+    assert a.broker.queue(KEY, 1).remove("j1")
+    await a.store.flush()
+    assert await b.broker.claim(KEY, 1) is None
+
+
+@two_workers(lease_sec=0.2)
+async def test_expired_lease_is_reclaimed(a, b):
+    await a.submit("j1")
+    assert (await a.broker.claim(KEY, 1))["owner"] == "a"
+    assert await b.broker.claim(KEY, 1) is None
+    await asyncio.sleep(0.3)                            # a 没有续约（相当于进程已崩溃）
+    row = await b.broker.claim(KEY, 1)
+    assert row["job_id"] == "j1"
+    assert row["owner"] == "b"
+
+
+@two_workers(lease_sec=0.3)
+async def test_sync_renews_lease(a, b):
+    await a.submit("j1")
+    await a.broker.claim(KEY, 1)
+    for _ in range(3):
+        await asyncio.sleep(0.15)
+        await a.broker.sync()
+    assert await b.broker.claim(KEY, 1) is None        # 已超过最初的租约，但一直在续约
+    assert (await a.row("j1"))["owner"] == "a"
+
+
+@two_workers()
+async def test_close_releases_running_jobs(a, b):
+    await a.submit("j1")
+    await a.broker.claim(KEY, 1)
+    await a.broker.close()
+    row = await b.row("j1")
+    assert row["status"] == "pending"
+    assert row["owner"] is None
+    assert (await b.broker.claim(KEY, 1))["job_id"] == "j1"
+
+
+@two_workers()
+async def test_sync_shares_queue_snapshot_and_changes(a, b):
+    queue = b.broker.queue(KEY, 1)
+    await a.submit("j1", counter=1)
+    await a.submit("j2", counter=2)
+    await b.broker.sync()
+    assert queue.positions() == {"j1": 1, "j2": 2}
+    assert KEY in b.broker.keys
+    assert {row["job_id"] for row in b.synced} == {"j1", "j2"}
+    assert all(isinstance(row["job_data"], dict) for row in b.synced)
+
+    await a.broker.claim(KEY, 1)
+    await b.broker.sync()
+    assert queue.positions() == {"j2": 1}
+    assert [row["status"] for row in b.synced if row["job_id"] == "j1"][-1] == "generating"
+
+
+@two_workers()
+async def test_get_wakes_up_when_another_process_enqueues(a, b):
+    queue = b.broker.queue(KEY, 1)
+    getter = asyncio.create_task(queue.get())
+    await asyncio.sleep(0.05)
+    assert not getter.done()
+    await a.submit("j1", counter=7)
+    await b.broker.sync()                               # 同步发现新任务后唤醒 get()
+    priority, counter, job_data = await asyncio.wait_for(getter, 2)
+    assert (priority, counter, job_data["api_url"]) == (1, 7, KEY)
+    assert (await a.row("j1"))["owner"] == "b"
+
+
+@two_workers()
+async def test_job_cancelled_between_claim_and_adopt_is_not_owned(a, b):
+    await a.submit("j1")
+    assert (await b.broker.claim(KEY, 1))["job_id"] == "j1"
+    assert (await b.broker.owned("j1"))["owner"] == "b"
+    a.store.update("j1", status="cancelled")           # 其他进程在 adopt_job 之前取消
+    await a.store.flush()
+    assert await b.broker.owned("j1") is None
+
+
+@two_workers(lease_sec=0.2)
+async def test_reclaimed_job_is_no_longer_owned(a, b):
+    await a.submit("j1")
+    await a.broker.claim(KEY, 1)
+    await asyncio.sleep(0.3)
+    await b.broker.claim(KEY, 1)
+    assert await a.broker.owned("j1") is None
+    assert (await b.broker.owned("j1"))["job_id"] == "j1"
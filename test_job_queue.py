@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""job_queue.JobQueue：出队顺序、取消 / 置顶后的位置、排名索引的容量"""
+
+import asyncio
+import random
+
+import pytest
+
+from job_queue import JobQueue
+
+
+def expected_positions(queue: JobQueue) -> dict:
+    """按定义逐个比较 (priority, counter) 得到的位置（相同键并列）"""
+    entries = [(job_id, entry[0], entry[1]) for job_id, entry in queue._entries.items()]
+    return {
+        job_id: 1 + sum((p, c) < (priority, counter) for _, p, c in entries)
+        for job_id, priority, counter in entries
+    }
+
+
+def drain(queue: JobQueue) -> list:
+    order = []
+    while not queue.empty():
+        order.append(queue.get_nowait()[2])
+    return order
+
+
+def test_orders_by_priority_then_counter():
+    queue = JobQueue()
+    queue.put_nowait("a", 1, 0, "a")
+    queue.put_nowait("b", 1, 1, "b")
+    queue.put_nowait("c", 0, 2, "c")
+    queue.put_nowait("d", 2, 3, "d")
+    assert queue.positions() == {"c": 1, "a": 2, "b": 3, "d": 4}
+    assert drain(queue) == ["c", "a", "b", "d"]
+
+
+def test_put_existing_job_replaces_entry():
+    queue = JobQueue()
+    queue.put_nowait("a", 1, 0, "old")
+    queue.put_nowait("b", 1, 1, "b")
+    queue.put_nowait("a", 1, 2, "new")
+    assert len(queue) == 2
+    assert queue.get_job("a") == "new"
+    assert drain(queue) == ["b", "new"]
+
+
+def test_remove_updates_positions():
+    queue = JobQueue()
+    for i, job_id in enumerate("abcd"):
+        queue.put_nowait(job_id, 1, i, job_id)
+    assert queue.remove("b")
+    assert not queue.remove("b")
+    assert "b" not in queue
+    assert queue.position("b") is None
+    assert queue.positions() == {"a": 1, "c": 2, "d": 3}
+    assert drain(queue) == ["a", "c", "d"]
+
+
+def test_set_priority_keeps_counter():
+    queue = JobQueue()
+    for i, job_id in enumerate("abcd"):
+        queue.put_nowait(job_id, 1, i, job_id)
+    assert queue.set_priority("d", 0)
+    assert queue.set_priority("c", 0)
+    assert not queue.set_priority("x", 0)
+    # 同为 priority 0 时仍按原入队顺序
+    assert queue.positions() == {"c": 1, "d": 2, "a": 3, "b": 4}
+    assert drain(queue) == ["c", "d", "a", "b"]
+
+
+def test_lazy_deletion_compacts_heap():
+    queue = JobQueue()
+    for i in range(200):
+        queue.put_nowait(f"j{i}", 1, i, i)
+    for i in range(150):
+        queue.remove(f"j{i}")
+    assert len(queue._heap) < 200
+    assert drain(queue) == list(range(150, 200))
+    assert queue._heap == []
+
+
+def test_positions_match_definition_under_random_operations():
+    rng = random.Random(4)
+    queue = JobQueue()
+    next_id = 0
+    for step in range(5000):
+        op = rng.random()
+        if op < 0.45 or queue.empty():
+            next_id += 1
+            # 乱序、重复的 counter（恢复的任务 / 合并任务沿用主任务的 counter）
+            counter = rng.choice([next_id, rng.randint(0, next_id)])
+            queue.put_nowait(f"j{next_id}", rng.randint(0, 3), counter, next_id)
+        elif op < 0.65:
+            queue.get_nowait()
+        elif op < 0.8:
+            queue.remove(rng.choice(list(queue._entries)))
+        else:
+            queue.set_priority(rng.choice(list(queue._entries)), rng.randint(0, 3))
+        if step % 50 == 0:
+            assert queue.positions() == expected_positions(queue)
+
+
+def test_index_size_does_not_depend_on_counter_span():
+    queue = JobQueue()
+    base = 1_700_000_000_000_000  # 共享队列模式下的微秒时间戳
+    queue.put_nowait("a", 1, base, "a")
+    queue.put_nowait("b", 1, base + 5 * 3600 * 1_000_000, "b")
+    queue.put_nowait("c", 1, 3, "c")
+    assert queue._capacity <= 64
+    assert all(len(tree.tree) <= 65 for tree in queue._ranks.values())
+    assert queue.positions() == {"c": 1, "a": 2, "b": 3}
+
+
+def test_get_waits_for_put():
+    async def main():
+        queue = JobQueue()
+        getter = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+        queue.put_nowait("a", 1, 0, "job")
+        return await asyncio.wait_for(getter, 1)
+
+    assert asyncio.run(main()) == (1, 0, "job")
+
+
+def test_cancelled_getter_passes_wakeup_on():
+    async def main():
+        queue = JobQueue()
+        first = asyncio.create_task(queue.get())
+        second = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        queue.put_nowait("a", 1, 0, "job")
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await asyncio.wait_for(second, 1)
+
+    assert asyncio.run(main()) == (1, 0, "job")
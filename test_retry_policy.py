@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""retry_policy：熔断器状态转换、退避、重试和对冲"""
+
+import asyncio
+
+import pytest
+
+import retry_policy
+from api_client import BackendError
+from retry_policy import CircuitBreaker, RetryPolicy
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(retry_policy.time, "monotonic", clock)
+    return clock
+
+
+# ---------- CircuitBreaker ----------
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failures=3, cooldown=10)
+    assert not breaker.record(False)
+    assert not breaker.record(False)
+    assert breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allows()
+    assert breaker.snapshot()["retry_in"] == 10
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker(failures=3, cooldown=10)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record(True)
+    assert not breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_requests_are_not_counted(clock):
+    breaker = CircuitBreaker(failures=1, cooldown=10)
+    assert not breaker.record(None)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_half_open_allows_a_single_trial(clock):
+    breaker = CircuitBreaker(failures=1, cooldown=10)
+    breaker.record(False)
+    clock.now += 10
+    assert breaker.allows()
+    breaker.on_acquire()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allows()  # 试探请求在途时不再分配
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allows()
+
+
+def test_failed_trial_reopens_with_doubled_cooldown(clock):
+    breaker = CircuitBreaker(failures=1, cooldown=10, max_cooldown=30)
+    breaker.record(False)                      # 冷却 10s
+    for cooldown in (20, 30, 30):              # 之后每次试探失败冷却加倍，直到上限
+        clock.now += 100
+        breaker.on_acquire()
+        assert breaker.record(False)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.open_until - clock.now == cooldown
+    clock.now += 100
+    breaker.on_acquire()
+    breaker.record(True)
+    assert breaker.cooldown == 10              # 恢复后冷却时间重置
+
+
+def test_cancelled_trial_frees_half_open_slot(clock):
+    breaker = CircuitBreaker(failures=1, cooldown=10)
+    breaker.record(False)
+    clock.now += 10
+    breaker.on_acquire()
+    breaker.record(None)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allows()
+
+
+# ---------- RetryPolicy ----------
+
+def test_backoff_is_capped_full_jitter(monkeypatch):
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda low, high: high)
+    policy = RetryPolicy(base_delay=1, max_delay=5)
+    assert [policy.backoff(n) for n in range(1, 6)] == [1, 2, 4, 5, 5]
+
+
+def run_with(policy: RetryPolicy, results: list, hedge: bool = False):
+    """results 依次作为每次尝试的结果：异常则抛出，(延迟, 值) 则等待后返回"""
+    calls = []
+
+    async def attempt():
+        item = results[len(calls)]
+        calls.append(item)
+        if isinstance(item, Exception):
+            raise item
+        delay, value = item
+        await asyncio.sleep(delay)
+        return value
+
+    async def main():
+        return await policy.run(attempt, hedge=hedge)
+
+    return asyncio.run(main()), calls
+
+
+def test_retries_retryable_errors_until_success():
+    policy = RetryPolicy(max_attempts=3, base_delay=0)
+    result, calls = run_with(policy, [BackendError("a"), BackendError("b"), (0, "ok")])
+    assert result == "ok"
+    assert len(calls) == 3
+
+
+def test_gives_up_after_max_attempts():
+    policy = RetryPolicy(max_attempts=2, base_delay=0)
+    with pytest.raises(BackendError, match="second"):
+        run_with(policy, [BackendError("first"), BackendError("second"), (0, "never")])
+
+
+def test_does_not_retry_non_retryable_errors():
+    policy = RetryPolicy(max_attempts=3, base_delay=0)
+    with pytest.raises(BackendError, match="bad request"):
+        run_with(policy, [BackendError("bad request", retryable=False), (0, "never")])
+
+
+def test_hedge_wins_when_first_attempt_is_slow():
+    policy = RetryPolicy(hedge_after=0.05)
+    result, calls = run_with(policy, [(5, "slow"), (0, "hedged")], hedge=True)
+    assert result == "hedged"
+    assert len(calls) == 2
+
+
+def test_no_hedge_when_first_attempt_is_fast():
+    policy = RetryPolicy(hedge_after=0.5)
+    result, calls = run_with(policy, [(0, "fast"), (0, "unused")], hedge=True)
+    assert result == "fast"
+    assert len(calls) == 1
+
+
+def test_hedge_falls_back_to_the_other_attempt_on_failure():
+    policy = RetryPolicy(max_attempts=1, hedge_after=0.05)
+
+    async def main():
+        calls = []
+
+        async def attempt():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                await asyncio.sleep(0.1)
+                raise BackendError("first failed")
+            await asyncio.sleep(0.2)
+            return "second"
+
+        return await policy.run(attempt, hedge=True), calls
+
+    result, calls = asyncio.run(main())
+    assert result == "second"
+    assert calls == [0, 1]
+
+
+def test_hedge_cancels_the_losing_attempt():
+    policy = RetryPolicy(hedge_after=0.05)
+    cancelled = []
+
+    async def main():
+        async def attempt():
+            if not cancelled:
+                cancelled.append(False)
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled[0] = True
+                    raise
+            return "hedged"
+
+        return await policy.run(attempt, hedge=True)
+
+    assert asyncio.run(main()) == "hedged"
+    assert cancelled == [True]
+
+
+def test_hedge_discards_the_other_result_when_both_succeed():
+    policy = RetryPolicy(hedge_after=0.05)
+    discarded = []
+
+    async def main():
+        calls = []
+        both_started = asyncio.Event()
+
+        async def attempt():
+            n = len(calls) + 1
+            calls.append(n - 1)
+            if n == 2:
+                both_started.set()
+            # 对冲请求发出后两次尝试同时完成，落在同一个 done 集合里
+            await both_started.wait()
+            return f"r{n}"
+
+        result = await policy.run(attempt, hedge=True, discard=discarded.append)
+        return result, calls
+
+    result, calls = asyncio.run(main())
+    assert calls == [0, 1]
+    assert result in ("r1", "r2")
+    assert discarded == [{"r1": "r2", "r2": "r1"}[result]]